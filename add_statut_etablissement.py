@@ -13,6 +13,8 @@ Classification :
 import pandas as pd
 import sys
 
+from casemix_engine import write_snapshot
+
 sys.stdout.reconfigure(encoding='utf-8')
 
 print("=== Ajout du Statut Établissement (Public/Privé) - V2 FIABLE ===\n")
@@ -163,4 +165,8 @@ df_casemix.to_parquet('data_casemix_2022_2024.parquet', index=False)
 print(f"   Fichier sauvegarde : data_casemix_2022_2024.parquet")
 print(f"   Colonnes ajoutees : Statut_Etablissement, Statut_Detail")
 
+# Instantané Arrow non compressé (memory-map partagé par les processus du dashboard)
+write_snapshot(df_casemix, 'data_casemix_2022_2024.arrow')
+print(f"   Instantane Arrow : data_casemix_2022_2024.arrow")
+
 print("\nTermine avec succes !")
@@ -14,7 +14,19 @@ from pathlib import Path
 import numpy as np
 import json
 import base64
+from io import BytesIO
 import gc  # Garbage collector pour libérer mémoire
+import os
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from casemix_engine import (
+    CasemixEngine, TOUS_ETABLISSEMENTS, DIMENSIONS_VARIATION, NIVEAUX_PROFIL, NIVEAUX_MARCHE, NIVEAUX_GEO, NIVEAUX_HIERARCHIE, DIMENSIONS_TARIF, GRILLES_TARIF, HORIZON_PREVISION, load_dataset, snapshot_path, compute_top_k,
+    build_variation_engine, get_variation_table, compute_search_mask
+)
 
 # Configuration de la page
 st.set_page_config(
@@ -809,15 +821,220 @@ COLORS = {
     'palette': ['#823B8A', '#307E84', '#BB7702', '#075289']  # Palette principale
 }
 
+# ========================================
+# TÉLÉMÉTRIE (TEMPS PAR SECTION, SUCCÈS CACHE)
+# ========================================
+# Agrégats du processus (toutes sessions) + détail du rerun courant.
+# Panneau debug : ?debug=1 dans l'URL. Logs JSON (une ligne par rerun) :
+# CASEMIX_TELEMETRY_LOG=chemin/du/fichier.jsonl
+
+TELEMETRIE_FENETRE = 1000  # Dernières mesures conservées par section (percentiles glissants)
+
+class Telemetrie:
+    """Mesures agrégées de tous les reruns du processus, thread-safe"""
+
+    def __init__(self, log_path=None):
+        self._lock = threading.Lock()
+        self._durees = {}      # section -> dernières durées (ms)
+        self._compteurs = {}   # section -> appels, succès/échecs cache, lignes
+        self._reruns = deque(maxlen=TELEMETRIE_FENETRE)
+        self.logger = logging.getLogger('casemix.telemetrie')
+        if log_path and not self.logger.handlers:
+            handler = logging.FileHandler(log_path, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def ajouter(self, mesures):
+        """Cumule des mesures de sections"""
+        with self._lock:
+            for mesure in mesures:
+                section = mesure['section']
+                self._durees.setdefault(section, deque(maxlen=TELEMETRIE_FENETRE)).append(mesure['duree_ms'])
+                compteur = self._compteurs.setdefault(section, {'appels': 0, 'hits': 0, 'misses': 0, 'lignes': 0})
+                compteur['appels'] += 1
+                if mesure.get('cache') == 'hit':
+                    compteur['hits'] += 1
+                elif mesure.get('cache') == 'miss':
+                    compteur['misses'] += 1
+                compteur['lignes'] += mesure.get('lignes', 0)
+
+    def enregistrer_rerun(self, duree_ms, mesures, contexte):
+        """Cumule un rerun complet et l'écrit en JSON si les logs sont activés"""
+        self.ajouter(mesures)
+        with self._lock:
+            self._reruns.append(duree_ms)
+            p95_rerun = float(np.percentile(self._reruns, 95))
+        if self.logger.handlers:
+            self.logger.info(json.dumps({
+                'evenement': 'rerun',
+                'horodatage': pd.Timestamp.now().isoformat(timespec='milliseconds'),
+                'duree_ms': round(duree_ms, 1),
+                'p95_rerun_ms': round(p95_rerun, 1),
+                **contexte,
+                'sections': mesures
+            }, ensure_ascii=False, default=str))
+
+    def stats_reruns(self):
+        """Latence des reruns (fenêtre glissante, toutes sessions)"""
+        with self._lock:
+            durees = np.array(self._reruns)
+        if len(durees) == 0:
+            return {'nb': 0, 'p50_ms': 0.0, 'p95_ms': 0.0}
+        return {'nb': len(durees), 'p50_ms': float(np.percentile(durees, 50)), 'p95_ms': float(np.percentile(durees, 95))}
+
+    def stats_sections(self):
+        """Tableau par section : appels, p50/p95/max, taux de succès cache, lignes traitées"""
+        with self._lock:
+            lignes = []
+            for section, durees in self._durees.items():
+                compteur = self._compteurs[section]
+                acces_cache = compteur['hits'] + compteur['misses']
+                lignes.append({
+                    'Section': section,
+                    'Appels': compteur['appels'],
+                    'p50 (ms)': np.percentile(durees, 50),
+                    'p95 (ms)': np.percentile(durees, 95),
+                    'Max (ms)': max(durees),
+                    'Succès cache': compteur['hits'] / acces_cache if acces_cache else None,
+                    'Lignes': compteur['lignes']
+                })
+        return pd.DataFrame(lignes).sort_values('p95 (ms)', ascending=False) if lignes else pd.DataFrame()
+
+@st.cache_resource
+def get_telemetrie():
+    """Instance unique de la télémétrie pour le processus"""
+    return Telemetrie(os.environ.get('CASEMIX_TELEMETRY_LOG'))
+
+class MesuresRerun:
+    """Mesures d'un rerun : une entrée par section (durée, lignes, taille, cache)"""
+
+    def __init__(self, telemetrie):
+        self.telemetrie = telemetrie
+        self.debut = time.perf_counter()
+        self.mesures = []
+        self.termine = False
+
+    @contextmanager
+    def mesurer(self, section, **infos):
+        mesure = {'section': section, **infos}
+        debut = time.perf_counter()
+        try:
+            yield mesure
+        finally:
+            mesure['duree_ms'] = round((time.perf_counter() - debut) * 1000, 2)
+            if self.termine:
+                # Hors rerun (ex. fichier d'export généré au clic) : agrégats seulement
+                self.telemetrie.ajouter([mesure])
+            else:
+                self.mesures.append(mesure)
+
+    def terminer(self, **contexte):
+        """Clôt le rerun et le transmet aux agrégats du processus"""
+        duree_ms = (time.perf_counter() - self.debut) * 1000
+        self.termine = True
+        self.telemetrie.enregistrer_rerun(duree_ms, self.mesures, contexte)
+        return duree_ms
+
+mesures_rerun = MesuresRerun(get_telemetrie())
+
+def plotly_chart(fig, **kwargs):
+    """st.plotly_chart mesuré (sérialisation et envoi de la figure)"""
+    with mesures_rerun.mesurer('figure', traces=len(fig.data)):
+        st.plotly_chart(fig, **kwargs)
+
+def format_milliers(valeur, format_spec=',.0f'):
+    """Nombre avec espace comme séparateur de milliers (à appliquer au nombre seul, pas au texte)"""
+    return format(valeur, format_spec).replace(',', ' ')
+
+# ========================================
+# PROFILAGE À LA DEMANDE (ADMIN)
+# ========================================
+# Panneau visible avec ?admin=<CASEMIX_ADMIN_TOKEN>. Une fois armé, le rerun suivant
+# est profilé en entier : pyinstrument si installé (échantillonnage, flame graph HTML),
+# sinon cProfile (fichier .prof, lisible avec snakeviz). Sans armement : aucun coût.
+
+PROFILS_DIR = Path('profils')
+
+def est_admin():
+    """Accès admin : jeton du .env passé en paramètre d'URL"""
+    jeton = os.environ.get('CASEMIX_ADMIN_TOKEN')
+    return bool(jeton) and st.query_params.get('admin') == jeton
+
+class ProfilRerun:
+    """Profil d'un rerun complet du script"""
+
+    def __init__(self):
+        try:
+            from pyinstrument import Profiler
+            self.moteur = 'pyinstrument'
+            self.profiler = Profiler(interval=0.001)
+            self.profiler.start()
+        except ImportError:
+            import cProfile
+            self.moteur = 'cprofile'
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def abandonner(self):
+        """Arrêt sans sauvegarde (rerun interrompu par st.stop ou une exception)"""
+        if self.moteur == 'pyinstrument':
+            if self.profiler.is_running:
+                self.profiler.stop()
+        else:
+            self.profiler.disable()
+
+    def terminer(self, contexte):
+        """Arrête le profil, l'écrit dans profils/ avec son contexte et renvoie le fichier à télécharger"""
+        nom = f"profil_{pd.Timestamp.now():%Y%m%d_%H%M%S}_{contexte['etablissement']}"
+        PROFILS_DIR.mkdir(exist_ok=True)
+        if self.moteur == 'pyinstrument':
+            self.profiler.stop()
+            contenu = self.profiler.output_html().encode('utf-8')
+            fichier, mime = f"{nom}.html", 'text/html'
+            (PROFILS_DIR / fichier).write_bytes(contenu)
+            resume = self.profiler.output_text(unicode=True, color=False)
+        else:
+            import pstats
+            from io import StringIO
+            self.profiler.disable()
+            self.profiler.dump_stats(PROFILS_DIR / f"{nom}.prof")
+            contenu = (PROFILS_DIR / f"{nom}.prof").read_bytes()
+            fichier, mime = f"{nom}.prof", 'application/octet-stream'
+            flux = StringIO()
+            pstats.Stats(self.profiler, stream=flux).sort_stats('cumulative').print_stats(30)
+            resume = flux.getvalue()
+        (PROFILS_DIR / f"{nom}.json").write_text(
+            json.dumps({'moteur': self.moteur, 'fichier': fichier, **contexte}, ensure_ascii=False, indent=2, default=str),
+            encoding='utf-8'
+        )
+        return {'fichier': fichier, 'mime': mime, 'contenu': contenu, 'resume': resume, 'contexte': contexte}
+
+# Profil resté actif après un rerun interrompu : arrêté et ignoré
+if 'profil_actif' in st.session_state:
+    st.session_state.pop('profil_actif').abandonner()
+
+profil_rerun = None
+if st.session_state.pop('profil_arme', False):
+    profil_rerun = ProfilRerun()
+    st.session_state.profil_actif = profil_rerun
+
 # ========================================
 # CHARGEMENT DES DONNÉES
 # ========================================
 
-@st.cache_data(ttl=3600, show_spinner="Chargement initial des donnees...")
 def load_data():
-    """Charge les donnees depuis le fichier Parquet optimise (7x plus rapide!)"""
+    """Charge les donnees : instantane Arrow memory-mappe s'il existe, sinon Parquet"""
     data_file = Path("data_casemix_2022_2024.parquet")
 
+    # Instantané produit par l'ETL : lecture quasi instantanée, pages partagées entre processus
+    if snapshot_path(data_file).exists():
+        try:
+            return load_dataset(data_file)
+        except Exception as e:
+            st.warning(f"Instantané Arrow illisible, lecture du Parquet : {str(e)}")
+
     if not data_file.exists():
         st.error("Fichier data_casemix_2022_2024.parquet introuvable")
         st.info("Verifiez que Git LFS est correctement configure")
@@ -830,16 +1047,9 @@ def load_data():
         st.info("Git LFS n'a pas telecharge le fichier. Verifiez packages.txt et la configuration LFS.")
         st.stop()
 
-    # Fonction de chargement avec cache pour performance optimale
-    @st.cache_data(ttl=3600, show_spinner="🔄 Chargement des données...")
-    def load_data_cached(file_path):
-        """Charge le parquet avec cache de 1h pour éviter rechargement"""
-        return pd.read_parquet(file_path)
-
     # Lecture du fichier Parquet (beaucoup plus rapide que CSV!)
     try:
-        df = load_data_cached(data_file)
-        # Pas d'index - le filtrage direct est plus rapide pour des MultiIndex non-unique
+        df = load_dataset(data_file)
     except Exception as e:
         st.error(f"Erreur lors de la lecture du Parquet : {str(e)}")
         st.stop()
@@ -847,6 +1057,19 @@ def load_data():
     # Les donnees sont deja nettoyees et typees dans le Parquet
     return df
 
+@st.cache_resource(show_spinner="Chargement initial des donnees...")
+def get_backend():
+    """Moteur d'agrégation : service partagé si CASEMIX_SERVICE_URL est défini, sinon local
+
+    En mode service, ce processus ne charge pas le dataset : il ne reçoit que
+    les agrégats (Arrow IPC) et les lignes de la sélection courante.
+    """
+    service_url = os.environ.get('CASEMIX_SERVICE_URL')
+    if service_url:
+        from casemix_service import ServiceClient
+        return ServiceClient(service_url)
+    return CasemixEngine(load_data())
+
 @st.cache_data
 def load_finess_mapping():
     """Charge le mapping FINESS"""
@@ -858,25 +1081,143 @@ def load_finess_mapping():
         return {}
 
 # Chargement des données
-with st.spinner('Chargement des données...'):
-    df = load_data()
+with st.spinner('Chargement des données...'), mesures_rerun.mesurer('chargement'):
+    backend = get_backend()
     finess_mapping = load_finess_mapping()
 
+# ========================================
+# CACHE DE RÉSULTATS PARTAGÉ (PROCESSUS)
+# ========================================
+# Un seul cache pour toutes les sessions : une vue demandée par plusieurs
+# utilisateurs n'est calculée qu'une fois. Budget en octets, éviction LRU.
+
+CACHE_BUDGET_MB = int(os.environ.get('CASEMIX_CACHE_MB', '512'))
+
+def estimer_taille(obj):
+    """Taille approximative en octets d'un résultat (DataFrame, array, dict...)"""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        taille = obj.memory_usage(index=True, deep=True)
+        return int(taille.sum()) if isinstance(obj, pd.DataFrame) else int(taille)
+    if isinstance(obj, np.ndarray):
+        return int(obj.nbytes)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(estimer_taille(k) + estimer_taille(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(estimer_taille(v) for v in obj)
+    return sys.getsizeof(obj)
+
+class ResultCache:
+    """Cache LRU borné en octets, thread-safe, avec invalidation par namespace/requête"""
+
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.taille_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # (namespace, requete) -> (valeur, taille)
+        self._lock = threading.Lock()
+        self._en_cours = {}  # verrous par clé : un seul calcul pour des requêtes simultanées
+
+    def get_or_compute(self, namespace, requete, compute_func):
+        """Retourne le résultat en cache ou le calcule (une seule fois par clé)"""
+        key = (namespace, requete)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            verrou = self._en_cours.setdefault(key, threading.Lock())
+
+        with verrou:
+            with self._lock:
+                # Calculé par une autre session pendant l'attente du verrou
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][0]
+                self.misses += 1
+            try:
+                valeur = compute_func()
+                self._stocker(key, valeur)
+            finally:
+                with self._lock:
+                    self._en_cours.pop(key, None)
+        return valeur
+
+    def _stocker(self, key, valeur):
+        taille = estimer_taille(valeur)
+        with self._lock:
+            if taille > self.budget_bytes:
+                return  # Trop gros pour le budget : servi sans être conservé
+            if key in self._entries:
+                self.taille_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (valeur, taille)
+            self.taille_bytes += taille
+            while self.taille_bytes > self.budget_bytes:
+                _, (_, taille_evincee) = self._entries.popitem(last=False)
+                self.taille_bytes -= taille_evincee
+                self.evictions += 1
+
+    def invalidate(self, namespace=None, requete=None):
+        """Supprime les entrées d'un namespace et/ou d'une requête (tout si aucun filtre)"""
+        with self._lock:
+            cles = [
+                (ns, req) for ns, req in self._entries
+                if (namespace is None or ns == namespace) and (requete is None or req == requete)
+            ]
+            for key in cles:
+                self.taille_bytes -= self._entries.pop(key)[1]
+        return len(cles)
+
+    def stats(self):
+        """Statistiques d'utilisation (entrées, taille, taux de succès)"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entrees': len(self._entries),
+                'taille_mb': self.taille_bytes / (1024 * 1024),
+                'budget_mb': self.budget_bytes / (1024 * 1024),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'taux_succes': self.hits / total if total else 0.0
+            }
+
+@st.cache_resource
+def get_result_cache():
+    """Instance unique du cache de résultats pour le processus"""
+    return ResultCache(CACHE_BUDGET_MB * 1024 * 1024)
+
+def canonical_query(finess, annees):
+    """Clé canonique d'une sélection (années triées, indépendante de l'ordre de saisie)"""
+    return (str(finess), tuple(sorted(int(a) for a in annees)))
+
+def get_or_compute_mesure(namespace, requete, compute_func):
+    """Accès au cache partagé mesuré : durée, succès/échec, lignes et taille du résultat"""
+    with mesures_rerun.mesurer(namespace) as mesure:
+        calcule = []
+        def calc():
+            calcule.append(True)
+            return compute_func()
+        resultat = get_result_cache().get_or_compute(namespace, requete, calc)
+        mesure['cache'] = 'miss' if calcule else 'hit'
+        donnees = resultat[0] if isinstance(resultat, tuple) else resultat
+        if isinstance(donnees, pd.DataFrame):
+            mesure['lignes'] = len(donnees)
+        if calcule:
+            mesure['taille_ko'] = round(estimer_taille(resultat) / 1024, 1)
+    return resultat
+
 # ========================================
 # SIDEBAR - FILTRES (AVEC CACHE POUR LES LISTES)
 # ========================================
 
-# OPTIMISATION CRITIQUE: Calculer les listes de filtres UNE SEULE FOIS
-@st.cache_data
+# OPTIMISATION CRITIQUE: Listes de filtres calculées UNE SEULE FOIS par le moteur
 def get_filter_options():
-    """Calcule les options de filtres une seule fois au lieu de à chaque rerun"""
+    """Options de filtres et volumétrie (précalculées par le moteur, partagées)"""
     try:
-        return {
-            'annees': sorted(df['Annee'].unique()),
-            'finess': sorted(df['Finess'].unique()),
-            'da': ['Tous'] + sorted([x for x in df['DA'].unique() if x != 'Non renseigné']) if 'DA' in df.columns else ['Tous'],
-            'classif': ['Tous'] + sorted([x for x in df['Classif PKCS'].unique() if x != 'Non renseigné']) if 'Classif PKCS' in df.columns else ['Tous']
-        }
+        return get_or_compute_mesure('options', ('national',), backend.options)
     except Exception as e:
         st.error(f"Erreur lors du calcul des options de filtres: {str(e)}")
         st.stop()
@@ -902,12 +1243,23 @@ with st.sidebar:
 
     # Filtre établissement avec option "Tous les établissements"
     def format_etablissement(finess):
-        if finess == "Tous les établissements":
+        if finess == TOUS_ETABLISSEMENTS:
             return finess
         nom = finess_mapping.get(finess, 'Inconnu')  # FIX CRITIQUE: Ne JAMAIS filtrer df ici!
         return f"{finess} - {nom}"
 
-    etablissement_options = ['Tous les établissements'] + filter_opts['finess']
+    # Filtre région : restreint la liste des établissements et la carte
+    region_selectionnee = st.selectbox(
+        "Région",
+        options=['Toutes les régions'] + filter_opts['regions'],
+        help="Limite la liste des établissements et la carte à une région"
+    )
+    region_filtre = region_selectionnee if region_selectionnee != 'Toutes les régions' else None
+
+    finess_region = filter_opts['finess']
+    if region_filtre is not None:
+        finess_region = [f for f in finess_region if filter_opts['finess_region'].get(f) == region_filtre]
+    etablissement_options = [TOUS_ETABLISSEMENTS] + finess_region
 
     # Définir l'index par défaut : CLINIQUE AMBULATOIRE CENDANEG (010007300)
     default_finess = '010007300'
@@ -924,32 +1276,38 @@ with st.sidebar:
     st.markdown("---")
 
     # Statistiques
-    st.info(f"**Données chargées**\n\n{len(df):,} lignes\n\n{df['Finess'].nunique()} établissements")
+    st.info(f"**Données chargées**\n\n{filter_opts['nb_lignes']:,} lignes\n\n{filter_opts['nb_etablissements']} établissements")
 
-    # Bouton reset
+    # Bouton reset : invalide uniquement les résultats de la sélection courante
+    # (st.cache_data.clear() viderait les caches de toutes les sessions)
     if st.button("Réinitialiser", width="stretch"):
-        st.cache_data.clear()
+        get_result_cache().invalidate(requete=canonical_query(etablissement_selectionne, annees_selectionnees or []))
+        st.session_state.pop('last_cache_key', None)
         st.rerun()
 
+    cache_stats = get_result_cache().stats()
+    st.caption(
+        f"Cache résultats : {cache_stats['entrees']} entrées • "
+        f"{cache_stats['taille_mb']:.0f}/{cache_stats['budget_mb']:.0f} Mo • "
+        f"succès {cache_stats['taux_succes']:.0%}"
+    )
+
 # ========================================
 # FILTRAGE ULTRA-OPTIMISE AVEC SESSION STATE
 # ========================================
 
 def filter_data_ultra_fast(finess, annees):
-    """Filtrage ultra-rapide avec masque booleen - OPTIMISÉ MÉMOIRE"""
+    """Lignes de la sélection (slice par établissement côté moteur) - OPTIMISÉ MÉMOIRE"""
     # Si "Tous les établissements" est sélectionné, ne pas filtrer par Finess
-    if finess == "Tous les établissements":
+    if finess == TOUS_ETABLISSEMENTS:
         # PROTECTION: Bloquer si trop de données sans filtre année
         if not annees:
-            # Retourner seulement l'année la plus récente par défaut pour éviter crash
-            annee_max = df['Annee'].max()
+            # Le moteur ne retourne que l'année la plus récente pour éviter crash
+            annee_max = max(filter_opts['annees'])
             st.warning(f"⚠️ 'Tous les établissements' sans filtre année charge trop de données. Affichage de {annee_max} uniquement.")
-            mask = df['Annee'] == annee_max
-            return df[mask]
         else:
-            mask = df['Annee'].isin(annees)
-            # Si toujours trop de lignes, limiter
-            nb_lignes_estimees = mask.sum()
+            # Volume connu d'avance (comptage par année) : refus avant tout transfert
+            nb_lignes_estimees = sum(filter_opts['lignes_par_annee'].get(int(a), 0) for a in annees)
             if nb_lignes_estimees > 1000000:
                 st.error(f"""
                 🚫 **Volume trop important** : {nb_lignes_estimees:,} lignes
@@ -957,24 +1315,16 @@ def filter_data_ultra_fast(finess, annees):
                 Pour éviter un crash, veuillez sélectionner **une seule année** ou un établissement spécifique.
                 """)
                 st.stop()
-            return df[mask]
-
-    # Filtrage direct par Finess avec masque booleen
-    mask = (df['Finess'] == finess)
-
-    # Filtrer par années
-    if annees:
-        mask &= df['Annee'].isin(annees)
 
-    # Un seul filtrage à la fin - PAS de .copy() pour économiser mémoire
-    return df[mask]
+    # Un seul filtrage côté moteur - PAS de .copy() pour économiser mémoire
+    return backend.selection(finess, annees)
 
 # Utilisation de session_state pour garder le dernier filtrage en memoire
 # Sécurité: s'assurer que les variables sont bien définies
 if not annees_selectionnees:
     annees_selectionnees = []
 
-cache_key = f"{etablissement_selectionne}_{tuple(annees_selectionnees)}"
+cache_key = canonical_query(etablissement_selectionne, annees_selectionnees)
 
 if 'last_cache_key' not in st.session_state or st.session_state.last_cache_key != cache_key:
     try:
@@ -983,10 +1333,12 @@ if 'last_cache_key' not in st.session_state or st.session_state.last_cache_key !
             del st.session_state.df_filtered
             gc.collect()  # Force garbage collection
 
-        st.session_state.df_filtered = filter_data_ultra_fast(
-            etablissement_selectionne,
-            tuple(annees_selectionnees)
-        )
+        with mesures_rerun.mesurer('filtrage') as mesure:
+            st.session_state.df_filtered = filter_data_ultra_fast(
+                etablissement_selectionne,
+                tuple(annees_selectionnees)
+            )
+            mesure['lignes'] = len(st.session_state.df_filtered)
         st.session_state.last_cache_key = cache_key
 
         # Libérer mémoire après filtrage
@@ -1066,51 +1418,22 @@ if df_filtered.empty:
 # KPIS PRINCIPAUX OPTIMISES
 # ========================================
 
-# Calcul direct des KPIs sur les donnees filtrees (deja en session_state)
-total_effectif = df_filtered['Effectif'].sum()
-dms_moyenne = (df_filtered['DMS'] * df_filtered['Effectif']).sum() / total_effectif if total_effectif > 0 else 0
-age_moyen = (df_filtered['Age_Moyen'] * df_filtered['Effectif']).sum() / total_effectif if total_effectif > 0 else 0
-taux_deces = (df_filtered['Taux_Deces'] * df_filtered['Effectif']).sum() / total_effectif if total_effectif > 0 else 0
-nb_ghm = df_filtered['Code_GHM'].nunique()
-
-# Calcul des deltas vs année précédente
-delta_effectif = None
-delta_dms = None
-delta_age = None
-delta_deces = None
-delta_ghm = None
-
-if annees_selectionnees and len(annees_selectionnees) >= 1:
-    annee_max = max(annees_selectionnees)
-    annee_prec = annee_max - 1
-    # Vérifier si l'année précédente existe dans les données
-    if etablissement_selectionne == "Tous les établissements":
-        df_annee_cur = df[df['Annee'] == annee_max]
-        df_annee_prec = df[df['Annee'] == annee_prec]
-    else:
-        df_annee_cur = df[(df['Finess'] == etablissement_selectionne) & (df['Annee'] == annee_max)]
-        df_annee_prec = df[(df['Finess'] == etablissement_selectionne) & (df['Annee'] == annee_prec)]
-
-    if len(df_annee_prec) > 0 and len(df_annee_cur) > 0:
-        eff_cur = df_annee_cur['Effectif'].sum()
-        eff_prec = df_annee_prec['Effectif'].sum()
-        if eff_prec > 0:
-            delta_effectif = f"{(eff_cur - eff_prec) / eff_prec * 100:+.1f}%"
-
-        dms_cur = (df_annee_cur['DMS'] * df_annee_cur['Effectif']).sum() / eff_cur if eff_cur > 0 else 0
-        dms_prec = (df_annee_prec['DMS'] * df_annee_prec['Effectif']).sum() / eff_prec if eff_prec > 0 else 0
-        if dms_prec > 0:
-            delta_dms = f"{dms_cur - dms_prec:+.2f} j"
-
-        age_cur = (df_annee_cur['Age_Moyen'] * df_annee_cur['Effectif']).sum() / eff_cur if eff_cur > 0 else 0
-        age_prec = (df_annee_prec['Age_Moyen'] * df_annee_prec['Effectif']).sum() / eff_prec if eff_prec > 0 else 0
-        delta_age = f"{age_cur - age_prec:+.1f} ans"
-
-        dec_cur = (df_annee_cur['Taux_Deces'] * df_annee_cur['Effectif']).sum() / eff_cur if eff_cur > 0 else 0
-        dec_prec = (df_annee_prec['Taux_Deces'] * df_annee_prec['Effectif']).sum() / eff_prec if eff_prec > 0 else 0
-        delta_deces = f"{dec_cur - dec_prec:+.3f}%"
-
-        delta_ghm = f"{df_annee_cur['Code_GHM'].nunique() - df_annee_prec['Code_GHM'].nunique():+d}"
+# KPIs et écarts vs année précédente calculés par le moteur (cache partagé par sélection)
+kpis = get_or_compute_mesure(
+    'kpis', cache_key, lambda: backend.kpis(etablissement_selectionne, annees_selectionnees)
+)
+total_effectif = kpis['effectif']
+dms_moyenne = kpis['dms']
+age_moyen = kpis['age_moyen']
+taux_deces = kpis['taux_deces']
+nb_ghm = kpis['nb_ghm']
+
+# Formatage des deltas vs année précédente
+delta_effectif = f"{kpis['delta_effectif_pct']:+.1f}%" if kpis['delta_effectif_pct'] is not None else None
+delta_dms = f"{kpis['delta_dms']:+.2f} j" if kpis['delta_dms'] is not None else None
+delta_age = f"{kpis['delta_age']:+.1f} ans" if kpis['delta_age'] is not None else None
+delta_deces = f"{kpis['delta_deces']:+.3f}%" if kpis['delta_deces'] is not None else None
+delta_ghm = f"{kpis['delta_ghm']:+d}" if kpis['delta_ghm'] is not None else None
 
 st.markdown('<div class="section-title">Indicateurs Clés</div>', unsafe_allow_html=True)
 
@@ -1131,68 +1454,206 @@ with col4:
 with col5:
     st.metric("Taux Décès", f"{taux_deces:.2f}%", delta=delta_deces, delta_color="inverse")
 
+# Indices standardisés (référence : DMS et mortalité nationales des mêmes GHM et années)
+if etablissement_selectionne != TOUS_ETABLISSEMENTS:
+    _, performance = get_or_compute_mesure(
+        'performance', cache_key, lambda: backend.performance(etablissement_selectionne, annees_selectionnees)
+    )
+    col1, col2, col3, col4, col5 = st.columns(5)
+
+    with col3:
+        ip_dms = performance['ip_dms']
+        st.metric(
+            "IP-DMS", f"{ip_dms:.3f}" if ip_dms is not None else "N/A",
+            delta=f"{(ip_dms - 1) * 100:+.1f}% vs national" if ip_dms is not None else None, delta_color="inverse",
+            help="Journées observées / journées attendues à la DMS nationale des mêmes GHM et années"
+        )
+
+    with col4:
+        st.metric(
+            "Journées économisables", f"{performance['journees_economisables']:,.0f} j",
+            help="Excédent de journées par rapport à la DMS nationale, cumulé par année"
+        )
+
+    with col5:
+        smr = performance['smr']
+        st.metric(
+            "Mortalité standardisée", f"{smr:.2f}" if smr is not None else "N/A",
+            delta=f"{performance['deces_observes']:.0f} décès obs. / {performance['deces_attendus']:.1f} att.", delta_color="off",
+            help="Décès observés / décès attendus au taux national des mêmes GHM et années"
+        )
+
 st.markdown("---")
 
 # ========================================
-# FONCTIONS DE CALCUL CACHEES AVEC SESSION STATE (CRUCIAL!)
+# FONCTIONS DE CALCUL CACHEES (CACHE PARTAGÉ, CLÉ LÉGÈRE)
 # ========================================
 # PROBLEME: @st.cache_data hash le DataFrame (lent sur 2.2M lignes)
-# SOLUTION: Utiliser session_state avec une clé légère
+# SOLUTION: Clé canonique de la sélection + cache LRU partagé entre sessions
+# Les résultats sont partagés : ne jamais les modifier en place (.copy() avant)
 
 def compute_cached(cache_key_suffix, compute_func):
-    """Wrapper générique pour cache en session_state"""
-    full_key = f"computed_{cache_key}_{cache_key_suffix}"
+    """Wrapper générique : namespace = type de calcul, requête = sélection canonique"""
+    return get_or_compute_mesure(cache_key_suffix, cache_key, compute_func)
 
-    if full_key not in st.session_state:
-        st.session_state[full_key] = compute_func()
+def compute_top_libelles(top_n=10):
+    """Cache le top N des libellés (exact, sans échantillonnage)"""
+    return compute_cached(
+        f"top{top_n}", lambda: backend.top_libelles(etablissement_selectionne, annees_selectionnees, top_n)
+    )
 
-    return st.session_state[full_key]
+def compute_detailed_table():
+    """Cache le tableau détaillé (top 20) avec moyennes pondérées par l'effectif"""
+    return compute_cached(
+        "detailed", lambda: backend.detail_libelles(etablissement_selectionne, annees_selectionnees, 20)
+    )
 
-def compute_top_libelles(df_filtered, top_n=10):
-    """Cache le top N des libellés"""
-    def calc():
-        # Optimisation : si trop de lignes, échantillonner d'abord
-        df_work = df_filtered
-        if len(df_filtered) > 1000000:
-            # Garder seulement les lignes avec les effectifs les plus élevés
-            df_work = df_filtered.nlargest(500000, 'Effectif')
-        return df_work.groupby('Libelle', as_index=False, sort=False).agg({
-            'Effectif': 'sum'
-        }).nlargest(top_n, 'Effectif')
-    return compute_cached(f"top{top_n}", calc)
-
-def compute_detailed_table(df_filtered):
-    """Cache le tableau détaillé avec weighted averages"""
-    def calc():
-        df_temp = df_filtered.reset_index(drop=True)
-        return df_temp.groupby('Libelle', as_index=False).agg({
-            'Effectif': 'sum',
-            'DMS': lambda x: np.average(x, weights=df_temp.loc[x.index, 'Effectif']) if df_temp.loc[x.index, 'Effectif'].sum() > 0 else 0,
-            'Age_Moyen': lambda x: np.average(x, weights=df_temp.loc[x.index, 'Effectif']) if df_temp.loc[x.index, 'Effectif'].sum() > 0 else 0,
-            'Taux_Deces': lambda x: np.average(x, weights=df_temp.loc[x.index, 'Effectif']) if df_temp.loc[x.index, 'Effectif'].sum() > 0 else 0
-        }).sort_values('Effectif', ascending=False).head(20)
-    return compute_cached("detailed", calc)
-
-def compute_evolution_data(df_filtered):
+def compute_references_libelles():
+    """Cache les moyennes nationales attendues par libellé (mêmes GHM et années que la sélection)"""
+    return compute_cached(
+        "references_libelle",
+        lambda: backend.references_selection(etablissement_selectionne, annees_selectionnees, 'Libelle')
+    )
+
+def compute_top_ghm_ca(statut, top_n=30):
+    """Cache le top N des GHM par CA estimé (Public ou Privé) et les KPIs financiers du statut"""
+    suffixe = 'Public' if statut == 'Public' else 'Prive'
+    return compute_cached(
+        f"top_ca_{suffixe}",
+        lambda: backend.financier(etablissement_selectionne, annees_selectionnees, statut, top_n)
+    )
+
+def compute_evolution_data():
     """Cache les données d'évolution temporelle"""
-    def calc():
-        df_temp = df_filtered.reset_index(drop=True)
-        return df_temp.groupby('Annee', as_index=False).agg({
-            'Effectif': 'sum',
-            'DMS': lambda x: np.average(x, weights=df_temp.loc[x.index, 'Effectif']) if df_temp.loc[x.index, 'Effectif'].sum() > 0 else 0,
-            'Age_Moyen': lambda x: np.average(x, weights=df_temp.loc[x.index, 'Effectif']) if df_temp.loc[x.index, 'Effectif'].sum() > 0 else 0,
-            'Taux_Deces': lambda x: np.average(x, weights=df_temp.loc[x.index, 'Effectif']) if df_temp.loc[x.index, 'Effectif'].sum() > 0 else 0
-        })
-    return compute_cached("evol", calc)
+    return compute_cached("evol", lambda: backend.evolution(etablissement_selectionne, annees_selectionnees))
+
+def compute_hierarchie_ghm():
+    """Cache l'arbre MCO → GHM de la sélection (tous les niveaux, sommes additives)"""
+    return compute_cached("hierarchie", lambda: backend.hierarchie_ghm(etablissement_selectionne, annees_selectionnees))
 
 def compute_classification_data(df_filtered, column_name):
     """Cache les données de classification (DA ou PKCS)"""
     def calc():
         if column_name not in df_filtered.columns:
             return pd.DataFrame()
-        return df_filtered[df_filtered[column_name] != 'Non renseigné'].groupby(column_name)['Effectif'].sum().reset_index().sort_values('Effectif', ascending=False).head(10)
+        return compute_top_k(df_filtered[df_filtered[column_name] != 'Non renseigné'], column_name, 'Effectif', 10, sums=['Effectif'])
     return compute_cached(f"class_{column_name}", calc)
 
+# ========================================
+# MOTEUR DE VARIATIONS ANNUELLES
+# ========================================
+
+def compute_variation_engine(dimension):
+    """Cache le moteur de variations de la sélection pour une dimension"""
+    return compute_cached(
+        f"variation_{dimension}",
+        lambda: build_variation_engine(backend.variation_pivot(dimension, etablissement_selectionne, annees_selectionnees))
+    )
+
+def get_national_variation_engine(dimension):
+    """Moteur de variations sur l'ensemble national, toutes années (partagé entre sessions)"""
+    return get_or_compute_mesure(
+        f"variation_{dimension}", ('national',),
+        lambda: build_variation_engine(backend.variation_pivot(dimension, TOUS_ETABLISSEMENTS, []))
+    )
+
+# ========================================
+# COMPARAISON ET RECHERCHE GHM (INDEX DU MOTEUR)
+# ========================================
+# Les index sont construits une fois par le moteur ; ici, seuls les résultats
+# de lookup transitent et sont mis en cache par requête.
+
+MAX_ETAB_COMPARAISON = 300  # Comparaison à l'échelle d'une région entière
+
+def get_ghm_options():
+    """GHM triés par effectif national décroissant (Code_GHM, Libelle, Effectif)"""
+    return get_or_compute_mesure('ghm_options', ('national',), backend.ghm_options)
+
+def get_ghm_etablissements(code_ghm):
+    """Établissements actifs sur un GHM, effectif indexé par Finess (ordre décroissant)"""
+    return get_or_compute_mesure(
+        'ghm_etablissements', (code_ghm,),
+        lambda: backend.comparaison_etablissements(code_ghm).set_index('Finess')['Effectif']
+    )
+
+def get_ghm_comparaison(code_ghm, finess_list):
+    """Effectif et moyennes pondérées par (Finess, Annee) pour un GHM et des établissements"""
+    return get_or_compute_mesure(
+        'ghm_comparaison', (code_ghm, tuple(sorted(finess_list))),
+        lambda: backend.comparaison(code_ghm, finess_list)
+    )
+
+def search_ghm(recherche):
+    """Codes GHM correspondant à la recherche (insensible aux accents, approchée)"""
+    return get_or_compute_mesure(
+        'recherche', (recherche.strip(),), lambda: backend.recherche_ghm(recherche)
+    )
+
+NB_PAIRS = 10  # Établissements similaires proposés
+
+def get_etablissements_similaires(finess, annee, niveau):
+    """Établissements au casemix le plus proche (index de voisins précalculé par le moteur)"""
+    return get_or_compute_mesure(
+        'pairs', (str(finess), annee, niveau),
+        lambda: backend.etablissements_similaires(finess, annee, NB_PAIRS, niveau)
+    )
+
+def get_valeurs_tarif(dimension):
+    """Valeurs possibles d'une dimension de règle tarifaire"""
+    return get_or_compute_mesure('valeurs_tarif', (dimension,), lambda: backend.valeurs_tarif(dimension))
+
+def get_simulation_tarifs(regles, annee, grille, horizon=0):
+    """Impact par établissement d'un jeu de règles (clé : règles normalisées, année, grille, horizon)"""
+    regles = tuple(regles)
+    return get_or_compute_mesure(
+        'simulation_tarifs', (regles, annee, grille, horizon),
+        lambda: backend.simulation_tarifs(
+            [{'dimension': d, 'valeur': v, 'variation_pct': p, 'grille': g} for d, v, p, g in regles], annee, grille, horizon
+        )
+    )
+
+def get_previsions(finess):
+    """Effectif observé puis projeté (intervalle à 80 %) d'un établissement ou national"""
+    return get_or_compute_mesure('previsions', (str(finess),), lambda: backend.previsions(finess))
+
+def get_previsions_racines(finess):
+    """Tendances et projections par racine GHM d'un établissement"""
+    return get_or_compute_mesure('previsions_racines', (str(finess),), lambda: backend.previsions_racines(finess))
+
+def get_decomposition_ca(annee_base, annee_cible, grille):
+    """Effets prix / volume / structure de tous les établissements (partagé, réutilisé par l'export)"""
+    return get_or_compute_mesure(
+        'decomposition_ca', (annee_base, annee_cible, grille),
+        lambda: backend.decomposition_ca(annee_base, annee_cible, grille)
+    )
+
+def get_regions():
+    """Départements et leur région (departement.csv)"""
+    return get_or_compute_mesure('regions', ('national',), backend.regions)
+
+def get_activites_marche(niveau):
+    """Activités (GHM, racines ou DA) triées par effectif national"""
+    return get_or_compute_mesure('activites_marche', (niveau,), lambda: backend.activites_marche(niveau))
+
+def get_concentration(niveau, annee, activite=None):
+    """HHI par département pour une activité, ou moyen pondéré toutes activités (index précalculé)"""
+    return get_or_compute_mesure(
+        'concentration', (niveau, annee, activite), lambda: backend.concentration(niveau, annee, activite)
+    )
+
+def get_parts_de_marche(niveau, activite, finess_list):
+    """Parts de marché départementales, rang, HHI et spécialisation d'établissements sur une activité"""
+    return get_or_compute_mesure(
+        'parts_de_marche', (niveau, activite, tuple(sorted(finess_list))),
+        lambda: backend.parts_de_marche(niveau, activite, finess_list)
+    )
+
+def get_ghm_references(code_ghm, departement=None):
+    """Références nationales (moyenne, P10-P90) et départementales d'un GHM par année (précalculées)"""
+    return get_or_compute_mesure(
+        'references', (code_ghm, departement), lambda: backend.references(code_ghm, departement)
+    )
+
 # ========================================
 # HELPER POUR HOVER DATA AMÉLIORÉ
 # ========================================
@@ -1212,6 +1673,127 @@ def get_enhanced_hover_data(include_ca=False):
         hover['Tarif_Prive'] = ':,.0f €'
     return hover
 
+# ========================================
+# EXPORTS GÉNÉRÉS À LA DEMANDE
+# ========================================
+
+EXPORT_CHUNK_ROWS = 50000  # Taille des blocs d'écriture (mémoire bornée)
+
+def compute_excel_column_widths(data, max_width=50):
+    """Largeurs Excel depuis les statistiques de colonnes (sans parcourir les cellules)"""
+    widths = []
+    for col in data.columns:
+        serie = data[col].dropna()
+        if serie.empty:
+            longueur = 0
+        elif pd.api.types.is_numeric_dtype(serie):
+            # La valeur la plus longue est l'un des extrêmes
+            longueur = max(len(str(serie.min())), len(str(serie.max())))
+        else:
+            # Longueurs calculées sur les valeurs distinctes uniquement
+            longueur = pd.Series(serie.unique()).astype(str).str.len().max()
+        widths.append(min(max(longueur, len(str(col))) + 2, max_width))
+    return widths
+
+def build_excel_export(data, sheet_name='Données Casemix'):
+    """Classeur Excel en mode write-only : lignes écrites en flux, par blocs"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill, Alignment
+    from openpyxl.utils import get_column_letter
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet_name)
+
+    # En write-only, largeurs et volets doivent être fixés avant la première ligne
+    for i, width in enumerate(compute_excel_column_widths(data), start=1):
+        worksheet.column_dimensions[get_column_letter(i)].width = width
+    worksheet.freeze_panes = 'A2'
+
+    # Formatage de l'en-tête
+    header_fill = PatternFill(start_color='823B8A', end_color='823B8A', fill_type='solid')
+    header_font = Font(bold=True, color='FFFFFF', size=11)
+    header = []
+    for col in data.columns:
+        cell = WriteOnlyCell(worksheet, value=str(col))
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = Alignment(horizontal='center', vertical='center')
+        header.append(cell)
+    worksheet.append(header)
+
+    for debut in range(0, len(data), EXPORT_CHUNK_ROWS):
+        bloc = data.iloc[debut:debut + EXPORT_CHUNK_ROWS].astype(object)
+        bloc = bloc.where(bloc.notna(), None)
+        for row in bloc.itertuples(index=False, name=None):
+            worksheet.append(row)
+
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+# Formats d'export : libellé, extension, type MIME
+FORMATS_EXPORT = {
+    'csv': ("CSV", "csv", "text/csv"),
+    'csv.gz': ("CSV compressé (gzip)", "csv.gz", "application/gzip"),
+    'zip': ("CSV compressé (zip)", "zip", "application/zip"),
+    'xlsx': ("Excel", "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    'parquet': ("Parquet", "parquet", "application/vnd.apache.parquet"),
+    'arrow': ("Arrow IPC", "arrow", "application/vnd.apache.arrow.file")
+}
+
+def write_csv_chunks(data, stream):
+    """Écrit le CSV (séparateur ;, BOM UTF-8 pour Excel) bloc par bloc dans un flux binaire"""
+    for debut in range(0, max(len(data), 1), EXPORT_CHUNK_ROWS):
+        bloc = data.iloc[debut:debut + EXPORT_CHUNK_ROWS]
+        texte = bloc.to_csv(index=False, sep=';', header=(debut == 0))
+        stream.write(texte.encode('utf-8-sig' if debut == 0 else 'utf-8'))
+
+def build_data_export(data, format_export, base_name='casemix'):
+    """Construit le fichier d'export dans le format demandé, en écriture par blocs"""
+    if format_export == 'xlsx':
+        return build_excel_export(data)
+
+    output = BytesIO()
+    if format_export == 'csv':
+        write_csv_chunks(data, output)
+    elif format_export == 'csv.gz':
+        import gzip
+        with gzip.GzipFile(fileobj=output, mode='wb') as stream:
+            write_csv_chunks(data, stream)
+    elif format_export == 'zip':
+        import zipfile
+        with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(f"{base_name}.csv", 'w', force_zip64=True) as stream:
+                write_csv_chunks(data, stream)
+    elif format_export in ('parquet', 'arrow'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.Schema.from_pandas(data, preserve_index=False)
+        if format_export == 'parquet':
+            writer = pq.ParquetWriter(output, schema, compression='zstd')
+        else:
+            writer = pa.ipc.new_file(output, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+        with writer:
+            # Un row group / record batch par bloc
+            for debut in range(0, len(data), EXPORT_CHUNK_ROWS):
+                bloc = data.iloc[debut:debut + EXPORT_CHUNK_ROWS]
+                writer.write_table(pa.Table.from_pandas(bloc, schema=schema, preserve_index=False))
+    else:
+        raise ValueError(f"Format d'export inconnu : {format_export}")
+    return output.getvalue()
+
+def get_cached_export(selection_hash, format_export, data):
+    """Fichier d'export mis en cache par empreinte de sélection (namespace 'export')"""
+    return get_or_compute_mesure(
+        'export', (selection_hash, format_export), lambda: build_data_export(data, format_export)
+    )
+
+def compute_selection_hash(*params):
+    """Empreinte stable d'une sélection (paramètres simples sérialisables)"""
+    import hashlib
+    return hashlib.sha1(json.dumps(params, default=str).encode('utf-8')).hexdigest()
+
 # ========================================
 # ONGLETS
 # ========================================
@@ -1227,7 +1809,7 @@ tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
 ])
 
 # TAB 1: VUE D'ENSEMBLE (FUSION DES 2 ANCIENS ONGLETS)
-with tab1:
+with tab1, mesures_rerun.mesurer('onglet_vue_ensemble'):
     st.markdown('<div class="section-title">Vue d\'ensemble de l\'activité</div>', unsafe_allow_html=True)
 
     # Première ligne: Top 10 + Distributions
@@ -1235,7 +1817,7 @@ with tab1:
 
     with col1:
         # Top 10 Libellés
-        df_top = compute_top_libelles(df_filtered, 10)
+        df_top = compute_top_libelles(10)
 
         fig = px.bar(
             df_top,
@@ -1256,7 +1838,7 @@ with tab1:
             xaxis=dict(title='Effectif'),
             margin=dict(l=20, r=20, t=40, b=20)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        plotly_chart(fig, use_container_width=True)
 
     with col2:
         # Distribution de l'âge (pondérée par Effectif)
@@ -1287,7 +1869,7 @@ with tab1:
             showlegend=False,
             margin=dict(l=20, r=20, t=40, b=20)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        plotly_chart(fig, use_container_width=True)
 
         # Répartition DMS (pondérée par Effectif)
         fig = go.Figure()
@@ -1316,12 +1898,12 @@ with tab1:
             showlegend=False,
             margin=dict(l=20, r=20, t=40, b=20)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        plotly_chart(fig, use_container_width=True)
 
     # Analyses détaillées
     st.markdown('<div class="section-title">Analyses Détaillées</div>', unsafe_allow_html=True)
 
-    df_detail = compute_detailed_table(df_filtered)
+    df_detail = compute_detailed_table()
     col1, col2 = st.columns(2)
 
     with col1:
@@ -1348,7 +1930,7 @@ with tab1:
             height=400,
             margin=dict(l=20, r=20, t=40, b=20)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        plotly_chart(fig, use_container_width=True)
 
     with col2:
         # Taux de décès
@@ -1373,16 +1955,18 @@ with tab1:
                 xaxis=dict(title='Taux de décès (%)'),
                 margin=dict(l=20, r=20, t=40, b=20)
             )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
         else:
             st.info("Pas de données de mortalité disponibles")
 
     # Heatmap de corrélation
     st.markdown('<div class="section-title">Matrice de Corrélation</div>', unsafe_allow_html=True)
-    df_corr = df_filtered[['Effectif', 'DMS', 'Age_Moyen', 'Sexe_Ratio', 'Taux_Deces']].dropna()
+    # Pondérée par l'effectif, fusion des moments précalculés (sans repasser sur les lignes)
+    correlation, nb_lignes_corr = compute_cached(
+        "correlation", lambda: backend.correlation(etablissement_selectionne, annees_selectionnees)
+    )
 
-    if len(df_corr) > 10:
-        correlation = df_corr.corr()
+    if correlation is not None and nb_lignes_corr > 10:
         fig = go.Figure(data=go.Heatmap(
             z=correlation.values,
             x=['Effectif', 'DMS', 'Âge', 'Sexe Ratio', 'Taux Décès'],
@@ -1395,21 +1979,102 @@ with tab1:
             colorbar=dict(title="Corrélation")
         ))
         fig.update_layout(
-            title="Corrélation entre les Indicateurs",
+            title="Corrélation entre les Indicateurs (pondérée par l'effectif)",
             height=400,
             margin=dict(l=20, r=20, t=40, b=20)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        plotly_chart(fig, use_container_width=True)
+
+    # Classification GHM : l'arbre de la sélection est calculé une fois, seul le niveau affiché est tracé
+    st.markdown('<div class="section-title">Classification GHM (MCO → GHM)</div>', unsafe_allow_html=True)
+    df_hierarchie = compute_hierarchie_ghm()
+    noeuds_selection = set(df_hierarchie['Noeud'])
+    # Chemin d'exploration conservé tant que ses nœuds existent dans la sélection
+    chemin_hierarchie = [n for n in st.session_state.get('hierarchie_chemin', []) if n in noeuds_selection]
+    noeud_courant = chemin_hierarchie[-1] if chemin_hierarchie else ''
+    df_niveau = df_hierarchie[df_hierarchie['Parent'] == noeud_courant]
+    libelles_noeuds = dict(zip(df_hierarchie['Noeud'], df_hierarchie['Libelle']))
+
+    def remonter_hierarchie(profondeur):
+        st.session_state.hierarchie_chemin = chemin_hierarchie[:profondeur]
+
+    def descendre_hierarchie():
+        noeud = st.session_state.hierarchie_descendre
+        if noeud is not None:
+            st.session_state.hierarchie_chemin = chemin_hierarchie + [noeud]
+        st.session_state.hierarchie_descendre = None
+
+    # Fil d'Ariane : retour à n'importe quel niveau parent
+    cols_ariane = st.columns(len(chemin_hierarchie) + 1)
+    cols_ariane[0].button("🏠 Toutes activités", key="hierarchie_racine", on_click=remonter_hierarchie, args=(0,), width="stretch")
+    for i, noeud in enumerate(chemin_hierarchie):
+        cols_ariane[i + 1].button(
+            libelles_noeuds[noeud][:40], key=f"hierarchie_ariane_{i}", on_click=remonter_hierarchie, args=(i + 1,),
+            disabled=i == len(chemin_hierarchie) - 1, width="stretch"
+        )
+
+    if len(df_niveau) > 0:
+        niveau_affiche = df_niveau['Niveau'].iloc[0]
+        col_type, col_descendre = st.columns([1, 3])
+        with col_type:
+            type_hierarchie = st.radio("Affichage", options=['Treemap', 'Sunburst'], horizontal=True, key="hierarchie_type")
+        with col_descendre:
+            if niveau_affiche != 'Code_GHM':
+                st.selectbox(
+                    f"Descendre au niveau inférieur ({NIVEAUX_HIERARCHIE[niveau_affiche]})",
+                    options=df_niveau['Noeud'].tolist(),
+                    index=None,
+                    format_func=libelles_noeuds.get,
+                    placeholder="Choisir un nœud...",
+                    on_change=descendre_hierarchie,
+                    key="hierarchie_descendre"
+                )
+
+        # Nœud courant au centre, ses enfants autour : un seul niveau envoyé au navigateur
+        libelle_courant = libelles_noeuds.get(noeud_courant, 'Toutes activités')
+        trace = go.Treemap if type_hierarchie == 'Treemap' else go.Sunburst
+        palette_hierarchie = [COLORS['secondary'], COLORS['tertiary'], COLORS['primary'], COLORS['quaternary']]
+        fig = go.Figure(trace(
+            ids=['racine'] + df_niveau['Noeud'].tolist(),
+            labels=[libelle_courant] + df_niveau['Libelle'].tolist(),
+            parents=[''] + ['racine'] * len(df_niveau),
+            values=[df_niveau['Effectif'].sum()] + df_niveau['Effectif'].tolist(),
+            branchvalues='total',
+            customdata=np.column_stack([
+                np.r_[np.nan, df_niveau['DMS']], np.r_[np.nan, df_niveau['Age_Moyen']],
+                np.r_[np.nan, df_niveau['Taux_Deces']], np.r_[df_niveau['Nb_GHM'].sum(), df_niveau['Nb_GHM']]
+            ]),
+            hovertemplate=(
+                "<b>%{label}</b><br>Effectif : %{value:,}<br>DMS : %{customdata[0]:.1f} j<br>"
+                "Âge moyen : %{customdata[1]:.0f} ans<br>Décès : %{customdata[2]:.2f}%<br>GHM : %{customdata[3]:.0f}<extra></extra>"
+            ),
+            marker=dict(colors=['white'] + [palette_hierarchie[i % len(palette_hierarchie)] for i in range(len(df_niveau))]),
+            textinfo='label+percent parent' if type_hierarchie == 'Treemap' else 'label+percent root'
+        ))
+        fig.update_layout(
+            title=f"{NIVEAUX_HIERARCHIE[niveau_affiche]} - {libelle_courant}",
+            height=500,
+            margin=dict(l=20, r=20, t=40, b=20)
+        )
+        plotly_chart(fig, use_container_width=True)
+    else:
+        st.info("Aucune activité à ce niveau pour la sélection")
 
     # Tableau détaillé
     st.markdown('<div class="section-title">Tableau Détaillé (Top 20)</div>', unsafe_allow_html=True)
     df_display = df_detail.copy()
     df_display['% du Total'] = (df_display['Effectif'] / total_effectif * 100).round(1)
-    df_display = df_display[['Libelle', 'Effectif', '% du Total', 'DMS', 'Age_Moyen', 'Taux_Deces']]
-    df_display.columns = ['Libellé GHM', 'Effectif', '% Total', 'DMS (j)', 'Âge', 'Décès (%)']
-    df_display['DMS (j)'] = df_display['DMS (j)'].round(1)
-    df_display['Âge'] = df_display['Âge'].round(0)
-    df_display['Décès (%)'] = df_display['Décès (%)'].round(2)
+    if etablissement_selectionne != TOUS_ETABLISSEMENTS:
+        # Moyennes nationales des mêmes GHM et années : comparaison à case-mix identique
+        df_display = df_display.merge(compute_references_libelles(), on='Libelle', how='left')
+        df_display = df_display[['Libelle', 'Effectif', '% du Total', 'DMS', 'DMS_National', 'Age_Moyen', 'Age_Moyen_National', 'Taux_Deces', 'Taux_Deces_National']]
+        df_display.columns = ['Libellé GHM', 'Effectif', '% Total', 'DMS (j)', 'DMS nat. (j)', 'Âge', 'Âge nat.', 'Décès (%)', 'Décès nat. (%)']
+    else:
+        df_display = df_display[['Libelle', 'Effectif', '% du Total', 'DMS', 'Age_Moyen', 'Taux_Deces']]
+        df_display.columns = ['Libellé GHM', 'Effectif', '% Total', 'DMS (j)', 'Âge', 'Décès (%)']
+    df_display = df_display.round({
+        'DMS (j)': 1, 'DMS nat. (j)': 1, 'Âge': 0, 'Âge nat.': 0, 'Décès (%)': 2, 'Décès nat. (%)': 2
+    })
     st.dataframe(
         df_display,
         width="stretch",
@@ -1418,7 +2083,7 @@ with tab1:
     )
 
 # TAB 2: SÉLECTION FILTRÉE
-with tab2:
+with tab2, mesures_rerun.mesurer('onglet_selection'):
     st.markdown('<div class="section-title">Sélection Filtrée - Analyse Approfondie</div>', unsafe_allow_html=True)
 
     # Message différent selon si "Tous les établissements" est sélectionné
@@ -1507,7 +2172,7 @@ with tab2:
             yaxis=dict(title='Effectif'),
             margin=dict(l=20, r=20, t=40, b=40)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        plotly_chart(fig, use_container_width=True)
 
         # Statistiques de la sélection
         col1, col2, col3, col4 = st.columns(4)
@@ -1519,11 +2184,48 @@ with tab2:
             st.metric("DMS moyenne", f"{(df_selection_filtree['DMS'] * df_selection_filtree['Effectif']).sum() / df_selection_filtree['Effectif'].sum():.1f} j" if df_selection_filtree['Effectif'].sum() > 0 else "N/A")
         with col4:
             st.metric("Âge moyen", f"{(df_selection_filtree['Age_Moyen'] * df_selection_filtree['Effectif']).sum() / df_selection_filtree['Effectif'].sum():.0f} ans" if df_selection_filtree['Effectif'].sum() > 0 else "N/A")
+
+        # GHM filtré : sélection vs références nationales et départementales (précalculées)
+        if ghm_filter != 'Tous':
+            st.markdown('<div class="section-title">Références du GHM (vs national)</div>', unsafe_allow_html=True)
+            dept_reference = None
+            if etablissement_selectionne != TOUS_ETABLISSEMENTS:
+                dept_reference = filter_opts['finess_departement'].get(etablissement_selectionne)
+            df_ref = get_ghm_references(ghm_filter, dept_reference).set_index('Annee')
+            selection_annee = compute_top_k(
+                df_selection_filtree, 'Annee', 'Effectif', df_selection_filtree['Annee'].nunique(),
+                sums=['Effectif'], weighted_means=['DMS', 'Age_Moyen', 'Taux_Deces']
+            ).set_index('Annee')
+
+            lignes_ref = []
+            for metrique, label in [('DMS', 'DMS (j)'), ('Age_Moyen', 'Âge moyen'), ('Taux_Deces', 'Décès (%)')]:
+                for annee in sorted(selection_annee.index):
+                    if annee not in df_ref.index:
+                        continue
+                    ref = df_ref.loc[annee]
+                    ligne = {
+                        'Indicateur': label,
+                        'Année': str(annee),
+                        'Sélection': selection_annee.loc[annee, metrique],
+                        'National': ref[f'{metrique}_National']
+                    }
+                    if dept_reference is not None:
+                        ligne[f'Dépt. {dept_reference}'] = ref[f'{metrique}_Departement']
+                    for quantile, nom in [('P10', 'P10'), ('P25', 'P25'), ('Mediane', 'Médiane'), ('P75', 'P75'), ('P90', 'P90')]:
+                        ligne[nom] = ref[f'{metrique}_{quantile}']
+                    lignes_ref.append(ligne)
+
+            if lignes_ref:
+                st.caption(
+                    "National et département : moyennes pondérées par l'effectif. "
+                    f"P10 à P90 : distribution des valeurs des établissements ({int(df_ref['Nb_Etablissements'].max())} établissements max. sur ce GHM)."
+                )
+                st.dataframe(pd.DataFrame(lignes_ref).round(2), width="stretch", hide_index=True)
     else:
         st.warning("⚠️ Aucune donnée ne correspond à cette sélection de filtres.")
 
 # TAB 3: ANALYSE FINANCIÈRE
-with tab3:
+with tab3, mesures_rerun.mesurer('onglet_financier'):
     st.markdown('<div class="section-title">💰 Analyse Financière et Valorisation</div>', unsafe_allow_html=True)
 
     # Vérifier si les colonnes de tarifs et statut existent
@@ -1565,20 +2267,18 @@ with tab3:
     if statut_etablissement in ["Public", "Mixte"]:
         st.markdown('<div class="section-title">🏥 Analyse Établissement Public</div>', unsafe_allow_html=True)
 
-        # Filtrer uniquement les données publiques
-        if statut_etablissement == "Mixte":
-            df_public = df_filtered[df_filtered['Statut_Etablissement'] == 'Public'].copy()
-        else:
-            df_public = df_filtered.copy()
+        # Top 30 GHM par CA (exact, un seul passage) : alimente le top 15, le nuage et le top 20
+        # En vue multi-établissements, le moteur ne retient que les établissements publics
+        top_ghm_public, kpis_public = compute_top_ghm_ca('Public')
 
-        if len(df_public) == 0:
+        if kpis_public['nb_lignes'] == 0:
             st.info("Aucune donnée disponible pour les établissements publics.")
         else:
             # KPIs Publics
-            ca_public_total = df_public['CA_Public_Estime'].sum()
-            tarif_moyen_public = df_public['Tarif_Public'].mean()
-            effectif_total_public = df_public['Effectif'].sum()
-            nb_ghm_public = df_public['Code_GHM'].nunique()
+            ca_public_total = kpis_public['ca_total']
+            tarif_moyen_public = kpis_public['tarif_moyen']
+            effectif_total_public = kpis_public['effectif_total']
+            nb_ghm_public = kpis_public['nb_ghm']
 
             col1, col2, col3, col4 = st.columns(4)
             with col1:
@@ -1598,11 +2298,7 @@ with tab3:
             with col1:
                 st.markdown("### 💰 Top 15 GHM par CA Public")
 
-                top_ca_public = df_public.groupby(['Code_GHM', 'Libelle']).agg({
-                    'CA_Public_Estime': 'sum',
-                    'Effectif': 'sum',
-                    'Tarif_Public': 'mean'
-                }).reset_index().sort_values('CA_Public_Estime', ascending=False).head(15)
+                top_ca_public = top_ghm_public.head(15)
 
                 fig = px.bar(
                     top_ca_public,
@@ -1623,18 +2319,13 @@ with tab3:
                     xaxis=dict(title='Chiffre d\'Affaires (€)'),
                     margin=dict(l=20, r=20, t=20, b=20)
                 )
-                st.plotly_chart(fig, use_container_width=True)
+                plotly_chart(fig, use_container_width=True)
 
             with col2:
                 st.markdown("### 📊 Volume vs Valorisation (Public)")
 
-                # Agréger par GHM
-                ghm_public = df_public.groupby(['Code_GHM', 'Libelle']).agg({
-                    'Effectif': 'sum',
-                    'CA_Public_Estime': 'sum',
-                    'Tarif_Public': 'mean',
-                    'DMS': 'mean'
-                }).reset_index().nlargest(30, 'CA_Public_Estime')
+                # Top 30 GHM par CA (déjà agrégé)
+                ghm_public = top_ghm_public
 
                 fig = px.scatter(
                     ghm_public,
@@ -1657,17 +2348,12 @@ with tab3:
                     height=600,
                     margin=dict(l=20, r=20, t=20, b=20)
                 )
-                st.plotly_chart(fig, use_container_width=True)
+                plotly_chart(fig, use_container_width=True)
 
             # Tableau récapitulatif Public
             st.markdown("### 📋 Tableau Récapitulatif GHM Public (Top 20 par CA)")
 
-            recap_public = df_public.groupby(['Code_GHM', 'Libelle']).agg({
-                'Effectif': 'sum',
-                'CA_Public_Estime': 'sum',
-                'Tarif_Public': 'mean',
-                'DMS': 'mean'
-            }).reset_index().sort_values('CA_Public_Estime', ascending=False).head(20)
+            recap_public = top_ghm_public.head(20).copy()
 
             recap_public['% CA'] = (recap_public['CA_Public_Estime'] / ca_public_total * 100).round(1)
 
@@ -1689,20 +2375,18 @@ with tab3:
     if statut_etablissement in ["Privé", "Mixte"]:
         st.markdown('<div class="section-title">🏥 Analyse Établissement Privé</div>', unsafe_allow_html=True)
 
-        # Filtrer uniquement les données privées
-        if statut_etablissement == "Mixte":
-            df_prive = df_filtered[df_filtered['Statut_Etablissement'] == 'Privé'].copy()
-        else:
-            df_prive = df_filtered.copy()
+        # Top 30 GHM par CA (exact, un seul passage) : alimente le top 15, le nuage et le top 20
+        # En vue multi-établissements, le moteur ne retient que les établissements privés
+        top_ghm_prive, kpis_prive = compute_top_ghm_ca('Privé')
 
-        if len(df_prive) == 0:
+        if kpis_prive['nb_lignes'] == 0:
             st.info("Aucune donnée disponible pour les établissements privés.")
         else:
             # KPIs Privés
-            ca_prive_total = df_prive['CA_Prive_Estime'].sum()
-            tarif_moyen_prive = df_prive['Tarif_Prive'].mean()
-            effectif_total_prive = df_prive['Effectif'].sum()
-            nb_ghm_prive = df_prive['Code_GHM'].nunique()
+            ca_prive_total = kpis_prive['ca_total']
+            tarif_moyen_prive = kpis_prive['tarif_moyen']
+            effectif_total_prive = kpis_prive['effectif_total']
+            nb_ghm_prive = kpis_prive['nb_ghm']
 
             col1, col2, col3, col4 = st.columns(4)
             with col1:
@@ -1722,11 +2406,7 @@ with tab3:
             with col1:
                 st.markdown("### 💳 Top 15 GHM par CA Privé")
 
-                top_ca_prive = df_prive.groupby(['Code_GHM', 'Libelle']).agg({
-                    'CA_Prive_Estime': 'sum',
-                    'Effectif': 'sum',
-                    'Tarif_Prive': 'mean'
-                }).reset_index().sort_values('CA_Prive_Estime', ascending=False).head(15)
+                top_ca_prive = top_ghm_prive.head(15)
 
                 fig = px.bar(
                     top_ca_prive,
@@ -1747,18 +2427,13 @@ with tab3:
                     xaxis=dict(title='Chiffre d\'Affaires (€)'),
                     margin=dict(l=20, r=20, t=20, b=20)
                 )
-                st.plotly_chart(fig, use_container_width=True)
+                plotly_chart(fig, use_container_width=True)
 
             with col2:
                 st.markdown("### 📊 Volume vs Valorisation (Privé)")
 
-                # Agréger par GHM
-                ghm_prive = df_prive.groupby(['Code_GHM', 'Libelle']).agg({
-                    'Effectif': 'sum',
-                    'CA_Prive_Estime': 'sum',
-                    'Tarif_Prive': 'mean',
-                    'DMS': 'mean'
-                }).reset_index().nlargest(30, 'CA_Prive_Estime')
+                # Top 30 GHM par CA (déjà agrégé)
+                ghm_prive = top_ghm_prive
 
                 fig = px.scatter(
                     ghm_prive,
@@ -1781,17 +2456,12 @@ with tab3:
                     height=600,
                     margin=dict(l=20, r=20, t=20, b=20)
                 )
-                st.plotly_chart(fig, use_container_width=True)
+                plotly_chart(fig, use_container_width=True)
 
             # Tableau récapitulatif Privé
             st.markdown("### 📋 Tableau Récapitulatif GHM Privé (Top 20 par CA)")
 
-            recap_prive = df_prive.groupby(['Code_GHM', 'Libelle']).agg({
-                'Effectif': 'sum',
-                'CA_Prive_Estime': 'sum',
-                'Tarif_Prive': 'mean',
-                'DMS': 'mean'
-            }).reset_index().sort_values('CA_Prive_Estime', ascending=False).head(20)
+            recap_prive = top_ghm_prive.head(20).copy()
 
             recap_prive['% CA'] = (recap_prive['CA_Prive_Estime'] / ca_prive_total * 100).round(1)
 
@@ -1807,18 +2477,289 @@ with tab3:
 
             st.dataframe(recap_prive, use_container_width=True, hide_index=True, height=400)
 
+    # ========== DÉCOMPOSITION DE L'ÉVOLUTION DU CA ==========
+    st.markdown('<div class="section-title">📐 Décomposition de l\'Évolution du CA</div>', unsafe_allow_html=True)
+
+    if len(filter_opts['annees']) < 2:
+        st.info("Au moins deux années sont nécessaires pour décomposer l'évolution du CA.")
+    else:
+        col_base, col_cible, col_grille = st.columns(3)
+        with col_base:
+            annee_base_ca = st.selectbox("Année de base", options=filter_opts['annees'], index=0, key="decomp_base")
+        with col_cible:
+            annee_cible_ca = st.selectbox(
+                "Année cible", options=filter_opts['annees'], index=len(filter_opts['annees']) - 1, key="decomp_cible"
+            )
+        with col_grille:
+            grille_ca = st.selectbox(
+                "Grille de valorisation", options=list(GRILLES_TARIF), format_func=GRILLES_TARIF.get, key="decomp_grille"
+            )
+
+        df_decomp, synthese_decomp = get_decomposition_ca(annee_base_ca, annee_cible_ca, grille_ca)
+
+        # Établissement sélectionné, ou somme de tous les établissements
+        valeurs_decomp = {cle: synthese_decomp[cle] for cle in ['ca_base', 'effet_prix', 'effet_volume', 'effet_structure', 'ca_cible']}
+        titre_decomp = "Tous les établissements"
+        if etablissement_selectionne != TOUS_ETABLISSEMENTS:
+            ligne_decomp = df_decomp[df_decomp['Finess'] == etablissement_selectionne]
+            if len(ligne_decomp) > 0:
+                ligne_decomp = ligne_decomp.iloc[0]
+                valeurs_decomp = {
+                    'ca_base': ligne_decomp['CA_Base'], 'effet_prix': ligne_decomp['Effet_Prix'],
+                    'effet_volume': ligne_decomp['Effet_Volume'], 'effet_structure': ligne_decomp['Effet_Structure'],
+                    'ca_cible': ligne_decomp['CA_Cible']
+                }
+                titre_decomp = finess_mapping.get(etablissement_selectionne, etablissement_selectionne)
+
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            variation_decomp = valeurs_decomp['ca_cible'] - valeurs_decomp['ca_base']
+            st.metric(
+                f"Variation CA {annee_base_ca} → {annee_cible_ca}", f"{variation_decomp/1e6:+,.2f} M€".replace(',', ' '),
+                f"{variation_decomp / valeurs_decomp['ca_base'] * 100:+.1f}%" if valeurs_decomp['ca_base'] > 0 else None
+            )
+        with col2:
+            st.metric("Effet prix (tarifs)", f"{valeurs_decomp['effet_prix']/1e6:+,.2f} M€".replace(',', ' '))
+        with col3:
+            st.metric("Effet volume", f"{valeurs_decomp['effet_volume']/1e6:+,.2f} M€".replace(',', ' '))
+        with col4:
+            st.metric("Effet structure (case-mix)", f"{valeurs_decomp['effet_structure']/1e6:+,.2f} M€".replace(',', ' '))
+
+        fig = go.Figure(go.Waterfall(
+            x=[f"CA {annee_base_ca}", "Effet prix", "Effet volume", "Effet structure", f"CA {annee_cible_ca}"],
+            measure=['absolute', 'relative', 'relative', 'relative', 'total'],
+            y=[valeurs_decomp['ca_base'], valeurs_decomp['effet_prix'], valeurs_decomp['effet_volume'], valeurs_decomp['effet_structure'], 0],
+            text=[f"{v/1e6:,.2f} M€".replace(',', ' ') for v in valeurs_decomp.values()],
+            textposition='outside',
+            connector={'line': {'color': COLORS['quaternary']}},
+            increasing={'marker': {'color': COLORS['secondary']}},
+            decreasing={'marker': {'color': COLORS['primary']}},
+            totals={'marker': {'color': COLORS['tertiary']}}
+        ))
+        fig.update_layout(
+            title=f"Du CA {annee_base_ca} au CA {annee_cible_ca} - {titre_decomp}",
+            yaxis_title="CA estimé (€)",
+            height=450,
+            showlegend=False,
+            margin=dict(l=20, r=20, t=50, b=20)
+        )
+        plotly_chart(fig, use_container_width=True)
+
+        st.caption(
+            "Chaque année est revalorisée aux tarifs de l'autre. Prix : évolution des tarifs GHS à activité constante. "
+            "Volume : évolution du nombre de séjours à structure constante. Structure : déformation du case-mix vers "
+            "des GHM mieux ou moins bien valorisés. Les trois effets somment exactement la variation."
+        )
+
+        df_decomp_display = df_decomp.assign(Etablissement=df_decomp['Finess'].map(finess_mapping).fillna('Inconnu'))[[
+            'Finess', 'Etablissement', 'Statut', 'Effectif_Base', 'Effectif_Cible', 'CA_Base', 'CA_Cible',
+            'Variation', 'Variation_Pct', 'Effet_Prix', 'Effet_Volume', 'Effet_Structure'
+        ]].rename(columns={
+            'Etablissement': 'Établissement', 'Effectif_Base': f'Effectif {annee_base_ca}', 'Effectif_Cible': f'Effectif {annee_cible_ca}',
+            'CA_Base': f'CA {annee_base_ca} (€)', 'CA_Cible': f'CA {annee_cible_ca} (€)', 'Variation': 'Variation (€)',
+            'Variation_Pct': 'Variation (%)', 'Effet_Prix': 'Effet prix (€)', 'Effet_Volume': 'Effet volume (€)',
+            'Effet_Structure': 'Effet structure (€)'
+        })
+        st.dataframe(
+            df_decomp_display,
+            width="stretch",
+            hide_index=True,
+            height=400,
+            column_config={
+                col: st.column_config.NumberColumn(format="%+.0f" if 'Effet' in col or 'Variation (€)' in col else "%.0f")
+                for col in df_decomp_display.columns if '(€)' in col
+            } | {'Variation (%)': st.column_config.NumberColumn(format="%+.1f")}
+        )
+        st.download_button(
+            label="📥 Exporter la décomposition (CSV)",
+            data=lambda: get_or_compute_mesure(
+                'decomposition_ca_csv', (annee_base_ca, annee_cible_ca, grille_ca),
+                lambda: df_decomp_display.to_csv(index=False, sep=';', decimal=',').encode('utf-8-sig')
+            ),
+            file_name=f"decomposition_ca_{annee_base_ca}_{annee_cible_ca}_{grille_ca}.csv",
+            mime="text/csv",
+            on_click="ignore"
+        )
+
+    # ========== SIMULATEUR DE CAMPAGNE TARIFAIRE ==========
+    st.markdown('<div class="section-title">🧮 Simulateur de Campagne Tarifaire</div>', unsafe_allow_html=True)
+    st.info(
+        "Impact d'une évolution des tarifs GHS sur **tous les établissements**, à volumes constants de l'année de référence "
+        "ou à volumes projetés (onglet Évolution). "
+        "Les règles qui se recouvrent se cumulent (ex. -2 % sur la chirurgie puis +1 % sur un DA chirurgical = -1,02 %)."
+    )
+
+    # Règles éditables ; l'exemple remplace le tableau (nouvelle version de l'éditeur)
+    REGLES_VIDES = pd.DataFrame({
+        'Dimension': pd.Series(dtype='str'), 'Valeur': pd.Series(dtype='str'),
+        'Variation (%)': pd.Series(dtype='float'), 'Grille': pd.Series(dtype='str')
+    })
+    if 'regles_tarif_initiales' not in st.session_state:
+        st.session_state.regles_tarif_initiales = REGLES_VIDES
+        st.session_state.regles_tarif_version = 0
+
+    def charger_regles(regles):
+        st.session_state.regles_tarif_initiales = regles
+        st.session_state.regles_tarif_version += 1
+
+    col_exemple, col_vider, _ = st.columns([1, 1, 2])
+    col_exemple.button(
+        "Exemple : chirurgie -2 %, médecine +1 %", width="stretch",
+        on_click=charger_regles, args=(pd.DataFrame({
+            'Dimension': ['MCO', 'MCO'], 'Valeur': ['Chirurgie', 'Médecine'],
+            'Variation (%)': [-2.0, 1.0], 'Grille': ['Toutes', 'Toutes']
+        }),)
+    )
+    col_vider.button("Vider les règles", width="stretch", on_click=charger_regles, args=(REGLES_VIDES,))
+
+    df_regles = st.data_editor(
+        st.session_state.regles_tarif_initiales,
+        num_rows="dynamic",
+        width="stretch",
+        hide_index=True,
+        key=f"regles_tarif_{st.session_state.regles_tarif_version}",
+        column_config={
+            'Dimension': st.column_config.SelectboxColumn(options=list(DIMENSIONS_TARIF), required=True),
+            'Valeur': st.column_config.TextColumn(help="Code GHM, racine, libellé de DA, CAS ou MCO (voir la liste ci-dessous)", required=True),
+            'Variation (%)': st.column_config.NumberColumn(min_value=-100.0, max_value=100.0, step=0.1, format="%.2f", required=True),
+            'Grille': st.column_config.SelectboxColumn(options=['Toutes', 'Public', 'Privé'], default='Toutes')
+        }
+    )
+
+    with st.expander("📖 Valeurs possibles par dimension"):
+        dimension_aide = st.selectbox("Dimension", options=list(DIMENSIONS_TARIF), format_func=DIMENSIONS_TARIF.get, key="sim_dimension_aide")
+        st.dataframe(pd.DataFrame({'Valeur': get_valeurs_tarif(dimension_aide)}), width="stretch", hide_index=True, height=250)
+
+    col_annee_sim, col_volumes_sim, col_grille_sim = st.columns(3)
+    with col_volumes_sim:
+        # Volumes projetés : appliqués à la dernière année observée (tarifs et CA actuel de cette année)
+        annee_derniere = max(filter_opts['annees'])
+        horizon_sim = st.selectbox(
+            "Volumes", options=list(range(HORIZON_PREVISION + 1)), key="sim_horizon",
+            format_func=lambda h: "Observés" if h == 0 else f"Projetés {annee_derniere + h}"
+        )
+    with col_annee_sim:
+        annee_sim = st.selectbox(
+            "Année de référence (volumes et tarifs)", options=filter_opts['annees'][::-1], key="sim_annee",
+            disabled=horizon_sim > 0
+        )
+        if horizon_sim > 0:
+            annee_sim = annee_derniere
+    with col_grille_sim:
+        grille_sim = st.selectbox(
+            "Grille de valorisation simulée", options=list(GRILLES_TARIF), format_func=GRILLES_TARIF.get, key="sim_grille",
+            help="Permet de valoriser les établissements privés aux tarifs publics et inversement"
+        )
+
+    regles_sim = [
+        (r['Dimension'], str(r['Valeur']).strip(), float(r['Variation (%)']), None if r['Grille'] in (None, 'Toutes') else r['Grille'])
+        for _, r in df_regles.dropna(subset=['Dimension', 'Valeur', 'Variation (%)']).iterrows()
+    ]
+
+    if not regles_sim and grille_sim == 'statut' and horizon_sim == 0:
+        st.caption("Ajoutez au moins une règle, choisissez une autre grille ou des volumes projetés pour lancer la simulation.")
+    else:
+        try:
+            df_sim, synthese_sim = get_simulation_tarifs(regles_sim, annee_sim, grille_sim, horizon_sim)
+        except ValueError as e:
+            st.error(f"⚠️ {e}")
+            df_sim = None
+
+        if df_sim is not None:
+            # Volumes projetés : l'effet volume est affiché à part de l'impact des règles
+            colonnes_sim = st.columns(5 if horizon_sim else 4)
+            col1, col2, col3, col4 = colonnes_sim[0], colonnes_sim[-3], colonnes_sim[-2], colonnes_sim[-1]
+            with col1:
+                st.metric(f"CA actuel {annee_sim}", f"{synthese_sim['ca_actuel']/1e6:,.1f} M€".replace(',', ' '))
+            if horizon_sim:
+                with colonnes_sim[1]:
+                    st.metric(
+                        f"Effet volume {synthese_sim['annee_volumes']}",
+                        f"{synthese_sim['effet_volume']/1e6:+,.1f} M€".replace(',', ' '),
+                        f"{synthese_sim['effet_volume_pct']:+.2f}%" if synthese_sim['effet_volume_pct'] is not None else None,
+                        help="CA aux volumes projetés et aux tarifs actuels, moins le CA actuel"
+                    )
+            with col2:
+                st.metric(
+                    f"CA simulé {synthese_sim['annee_volumes']}" if horizon_sim else "CA simulé",
+                    f"{synthese_sim['ca_simule']/1e6:,.1f} M€".replace(',', ' '),
+                    f"{synthese_sim['impact_pct']:+.2f}%" if synthese_sim['impact_pct'] is not None else None
+                )
+            with col3:
+                st.metric(
+                    "Impact des règles", f"{synthese_sim['impact']/1e6:+,.1f} M€".replace(',', ' '),
+                    help="À volumes projetés" if horizon_sim else None
+                )
+            with col4:
+                st.metric(
+                    "Établissements perdants / gagnants",
+                    f"{synthese_sim['nb_etablissements_perdants']} / {synthese_sim['nb_etablissements_gagnants']}"
+                )
+
+            df_sim_display = df_sim.assign(Etablissement=df_sim['Finess'].map(finess_mapping).fillna('Inconnu'))
+            if etablissement_selectionne != TOUS_ETABLISSEMENTS:
+                ligne_etab = df_sim_display[df_sim_display['Finess'] == etablissement_selectionne]
+                if len(ligne_etab) > 0:
+                    ligne_etab = ligne_etab.iloc[0]
+                    st.success(
+                        f"🏥 **{ligne_etab['Etablissement']}** : {format_milliers(ligne_etab['Impact'], '+,.0f')} € "
+                        f"({ligne_etab['Impact_Pct']:+.2f}%) - rang {ligne_etab.name + 1} / {format_milliers(len(df_sim_display), ',')} "
+                        "(du plus pénalisé au plus favorisé)"
+                    )
+
+            # Classement : les plus pénalisés et les plus favorisés
+            df_extremes = pd.concat([df_sim_display.head(10), df_sim_display.tail(10)]).drop_duplicates('Finess')
+            fig = px.bar(
+                df_extremes.sort_values('Impact'),
+                x='Impact',
+                y='Etablissement',
+                orientation='h',
+                color='Impact',
+                color_continuous_scale=[[0, COLORS['primary']], [0.5, 'white'], [1, COLORS['secondary']]],
+                color_continuous_midpoint=0,
+                hover_data={'Statut': True, 'CA_Actuel': ':,.0f', 'CA_Simule': ':,.0f', 'Impact_Pct': ':+.2f'},
+                labels={'Impact': 'Impact (€)', 'Etablissement': '', 'CA_Actuel': 'CA actuel (€)', 'CA_Simule': 'CA simulé (€)', 'Impact_Pct': 'Impact (%)'},
+                title="Établissements les plus pénalisés et les plus favorisés"
+            )
+            fig.update_layout(height=600, showlegend=False, margin=dict(l=20, r=20, t=40, b=20))
+            plotly_chart(fig, use_container_width=True)
+
+            colonnes_volume = ['CA_Projete', 'Effet_Volume'] if horizon_sim else []
+            st.dataframe(
+                df_sim_display[['Finess', 'Etablissement', 'Statut', 'Effectif', 'CA_Actuel'] + colonnes_volume + ['CA_Simule', 'Impact', 'Impact_Pct']].rename(columns={
+                    'Etablissement': 'Établissement', 'CA_Actuel': 'CA actuel (€)', 'CA_Simule': 'CA simulé (€)',
+                    'CA_Projete': 'CA volumes projetés (€)', 'Effet_Volume': 'Effet volume (€)',
+                    'Impact': 'Impact (€)', 'Impact_Pct': 'Impact (%)'
+                }),
+                width="stretch",
+                hide_index=True,
+                height=400,
+                column_config={
+                    'CA actuel (€)': st.column_config.NumberColumn(format="%.0f"),
+                    'CA volumes projetés (€)': st.column_config.NumberColumn(format="%.0f"),
+                    'Effet volume (€)': st.column_config.NumberColumn(format="%+.0f"),
+                    'CA simulé (€)': st.column_config.NumberColumn(format="%.0f"),
+                    'Impact (€)': st.column_config.NumberColumn(format="%+.0f"),
+                    'Impact (%)': st.column_config.NumberColumn(format="%+.2f")
+                }
+            )
+            st.caption(
+                f"{format_milliers(synthese_sim['nb_lignes_touchees'])} lignes GHM × établissement concernées par les règles. "
+                "Statut inconnu : valorisé à la grille publique."
+            )
+
 # TAB 4: CARTE DE FRANCE INTERACTIVE
-with tab4:
+with tab4, mesures_rerun.mesurer('onglet_carte'):
     st.markdown('<div class="section-title">Répartition Géographique de l\'Activité Hospitalière</div>', unsafe_allow_html=True)
 
     st.info("🌍 **Vue d'ensemble nationale** : Cette carte affiche l'activité de tous les établissements. Utilisez les filtres ci-dessous pour affiner votre analyse.")
 
-    # Filtres dédiés pour la carte
-    col_filter1, col_filter2, col_filter3 = st.columns(3)
+    # Filtres dédiés pour la carte (dans la région choisie en barre latérale)
+    col_filter1, col_filter2, col_filter3, col_filter4 = st.columns(4)
 
     with col_filter1:
         # Filtre par établissement
-        etab_options_map = ['Tous les établissements'] + sorted(df['Finess'].unique().tolist())
+        etab_options_map = [TOUS_ETABLISSEMENTS] + finess_region
         etab_filter_map = st.selectbox(
             "Filtrer par établissement",
             options=etab_options_map,
@@ -1827,7 +2768,8 @@ with tab4:
 
     with col_filter2:
         # Filtre par département
-        dept_options_map = ['Tous les départements'] + sorted(df['Nom_Departement'].dropna().unique().tolist())
+        departements_map = filter_opts['departements_region'].get(region_filtre, []) if region_filtre else filter_opts['departements']
+        dept_options_map = ['Tous les départements'] + departements_map
         dept_filter_map = st.selectbox(
             "Filtrer par département",
             options=dept_options_map,
@@ -1836,24 +2778,32 @@ with tab4:
 
     with col_filter3:
         # Filtre par année
-        annee_options_map = ['Toutes les années'] + sorted(df['Annee'].unique().tolist())
+        annee_options_map = ['Toutes les années'] + filter_opts['annees']
         annee_filter_map = st.selectbox(
             "Filtrer par année",
             options=annee_options_map,
             key="map_annee_filter"
         )
 
-    # Appliquer les filtres
-    df_map = df.copy()
-
-    if etab_filter_map != 'Tous les établissements':
-        df_map = df_map[df_map['Finess'] == etab_filter_map]
-
-    if dept_filter_map != 'Tous les départements':
-        df_map = df_map[df_map['Nom_Departement'] == dept_filter_map]
+    with col_filter4:
+        # Maille de la carte : les régions sont colorées sur le contour de leurs départements
+        maille_map = st.radio(
+            "Maille",
+            options=['Departement', 'Region'],
+            format_func=NIVEAUX_GEO.get,
+            horizontal=True,
+            key="map_maille",
+            disabled=etab_filter_map != TOUS_ETABLISSEMENTS or dept_filter_map != 'Tous les départements'
+        )
 
-    if annee_filter_map != 'Toutes les années':
-        df_map = df_map[df_map['Annee'] == annee_filter_map]
+    # Filtres de la carte transmis au moteur (agrégats géographiques précalculés, sans copie du dataset)
+    filtres_carte = (
+        etab_filter_map if etab_filter_map != TOUS_ETABLISSEMENTS else None,
+        dept_filter_map if dept_filter_map != 'Tous les départements' else None,
+        annee_filter_map if annee_filter_map != 'Toutes les années' else None,
+        region_filtre
+    )
+    carte_regionale = maille_map == 'Region' and filtres_carte[0] is None and filtres_carte[1] is None
 
     # Charger le GeoJSON des départements
     geojson_path = Path("departements.geojson")
@@ -1863,43 +2813,49 @@ with tab4:
         with open(geojson_path, 'r', encoding='utf-8') as f:
             departements_geojson = json.load(f)
 
-        # Agréger les données par département
-        if 'Departement_Number' in df_map.columns and 'Nom_Departement' in df_map.columns:
-            df_dept = df_map.groupby(['Departement_Number', 'Nom_Departement'], as_index=False).agg({
-                'Effectif': 'sum',
-                'DMS': lambda x: np.average(x, weights=df_map.loc[x.index, 'Effectif']) if df_map.loc[x.index, 'Effectif'].sum() > 0 else 0,
-                'Age_Moyen': lambda x: np.average(x, weights=df_map.loc[x.index, 'Effectif']) if df_map.loc[x.index, 'Effectif'].sum() > 0 else 0,
-                'Taux_Deces': lambda x: np.average(x, weights=df_map.loc[x.index, 'Effectif']) if df_map.loc[x.index, 'Effectif'].sum() > 0 else 0
-            })
-
-            # Calculer le nombre d'établissements par département
-            df_nb_etab = df_map.groupby('Departement_Number')['Finess'].nunique().reset_index()
-            df_nb_etab.columns = ['Departement_Number', 'Nb_Etablissements']
-            df_dept = df_dept.merge(df_nb_etab, on='Departement_Number', how='left')
+        # Agréger les données par département (moyennes pondérées, nb d'établissements)
+        if filter_opts['departements']:
+            df_dept, meta_carte = get_or_compute_mesure(
+                'carte', filtres_carte, lambda: backend.departements(*filtres_carte)
+            )
 
             # Titre dynamique selon les filtres
             titre_filtre = []
-            if etab_filter_map != 'Tous les établissements':
+            if region_filtre is not None:
+                titre_filtre.append(f"Région: {region_filtre}")
+            if etab_filter_map != TOUS_ETABLISSEMENTS:
                 titre_filtre.append(f"Établissement: {finess_mapping.get(etab_filter_map, etab_filter_map)}")
             if dept_filter_map != 'Tous les départements':
                 titre_filtre.append(f"Département: {dept_filter_map}")
             if annee_filter_map != 'Toutes les années':
                 titre_filtre.append(f"Année: {annee_filter_map}")
 
-            titre_carte = "Répartition de l'activité par département"
+            titre_carte = f"Répartition de l'activité par {'région' if carte_regionale else 'département'}"
             if titre_filtre:
                 titre_carte += f" - {' | '.join(titre_filtre)}"
 
+            if carte_regionale:
+                # Agrégat de chaque région reporté sur ses départements (le GeoJSON est départemental)
+                df_region = get_or_compute_mesure(
+                    'rollup', ('Region', filtres_carte[2], region_filtre, None),
+                    lambda: backend.rollup('Region', filtres_carte[2], region=region_filtre)
+                )
+                df_carte = get_regions()[['Departement_Number', 'Region']].merge(df_region, on='Region')
+                hover_carte = 'Region'
+            else:
+                df_carte = df_dept
+                hover_carte = 'Nom_Departement'
+
             # Créer la carte choropleth
             fig_map = px.choropleth(
-                df_dept,
+                df_carte,
                 geojson=departements_geojson,
                 locations='Departement_Number',
                 featureidkey="properties.code",
                 color='Effectif',
-                hover_name='Nom_Departement',
+                hover_name=hover_carte,
                 hover_data={
-                    'Departement_Number': True,
+                    'Departement_Number': not carte_regionale,
                     'Effectif': ':,',
                     'Nb_Etablissements': True,
                     'DMS': ':.1f',
@@ -1934,7 +2890,7 @@ with tab4:
                 }
             )
 
-            st.plotly_chart(fig_map, use_container_width=True, config={'responsive': True})
+            plotly_chart(fig_map, use_container_width=True, config={'responsive': True})
 
             # Tableau récapitulatif des départements
             st.markdown("### 📊 Top 10 Départements par Effectif")
@@ -1960,6 +2916,46 @@ with tab4:
 
             st.dataframe(df_dept_display, use_container_width=True, hide_index=True)
 
+            # Exploration : niveau sous la zone choisie (national → régions → départements → établissements)
+            if etab_filter_map == TOUS_ETABLISSEMENTS:
+                if filtres_carte[1] is not None:
+                    niveau_detail, titre_detail = 'Etablissement', f"Établissements - {dept_filter_map}"
+                elif region_filtre is not None:
+                    niveau_detail, titre_detail = 'Departement', f"Départements - {region_filtre}"
+                else:
+                    niveau_detail, titre_detail = 'Region', "Régions"
+                st.markdown(f"### 🧭 Exploration : {titre_detail}")
+
+                df_detail = get_or_compute_mesure(
+                    'rollup', (niveau_detail, filtres_carte[2], region_filtre, filtres_carte[1]),
+                    lambda: backend.rollup(niveau_detail, filtres_carte[2], region=region_filtre, departement=filtres_carte[1])
+                )
+                colonnes_zone = {'Region': ['Region'], 'Departement': ['Nom_Departement'], 'Etablissement': ['Finess']}[niveau_detail]
+                df_detail_display = df_detail[colonnes_zone + ['Effectif', 'Nb_Etablissements', 'DMS', 'Age_Moyen', 'Taux_Deces']].copy()
+                if niveau_detail == 'Etablissement':
+                    df_detail_display.insert(1, 'Établissement', df_detail['Finess'].map(finess_mapping).fillna('Inconnu'))
+                    df_detail_display = df_detail_display.drop(columns=['Nb_Etablissements'])
+                df_detail_display.insert(
+                    df_detail_display.columns.get_loc('Effectif') + 1, 'Part (%)',
+                    df_detail['Effectif'] / max(df_detail['Effectif'].sum(), 1) * 100
+                )
+                st.dataframe(
+                    df_detail_display.rename(columns={
+                        'Region': 'Région', 'Nom_Departement': 'Département', 'Nb_Etablissements': 'Nb étab.',
+                        'DMS': 'DMS moy.', 'Age_Moyen': 'Âge moy.', 'Taux_Deces': 'Taux décès (%)'
+                    }),
+                    width="stretch",
+                    hide_index=True,
+                    column_config={
+                        'Part (%)': st.column_config.ProgressColumn(min_value=0, max_value=100, format="%.1f%%"),
+                        'DMS moy.': st.column_config.NumberColumn(format="%.1f"),
+                        'Âge moy.': st.column_config.NumberColumn(format="%.0f"),
+                        'Taux décès (%)': st.column_config.NumberColumn(format="%.2f")
+                    }
+                )
+                if niveau_detail != 'Etablissement':
+                    st.caption("Choisissez une région (barre latérale) puis un département (filtre de la carte) pour descendre d'un niveau.")
+
             # KPIs géographiques
             st.markdown("### 🎯 Indicateurs Géographiques")
             col1, col2, col3, col4 = st.columns(4)
@@ -1976,32 +2972,141 @@ with tab4:
                 st.metric("Concentration Top 3", f"{concentration:.1f}%")
 
             with col4:
-                nb_etab_total = df_map['Finess'].nunique()
+                nb_etab_total = meta_carte['nb_etablissements']
                 st.metric("Établissements", f"{nb_etab_total}")
 
+            # Concentration du marché par département (index précalculé, sans scan par requête)
+            st.markdown("### 🏛️ Concentration du Marché (HHI)")
+            col_niveau, col_activite = st.columns([1, 3])
+
+            with col_niveau:
+                niveau_marche = st.selectbox(
+                    "Niveau d'activité",
+                    options=list(NIVEAUX_MARCHE),
+                    format_func=NIVEAUX_MARCHE.get,
+                    key="map_niveau_marche"
+                )
+
+            with col_activite:
+                libelles_ghm = dict(zip(get_ghm_options()['Code_GHM'], get_ghm_options()['Libelle']))
+                activite_marche = st.selectbox(
+                    "Activité",
+                    options=[None] + get_activites_marche(niveau_marche),
+                    format_func=lambda x: "Toutes les activités (HHI moyen pondéré)" if x is None else (
+                        f"{x} - {libelles_ghm.get(x, '')}" if niveau_marche == 'Code_GHM' else x
+                    ),
+                    key=f"map_activite_marche_{niveau_marche}"
+                )
+
+            annee_marche = annee_filter_map if annee_filter_map != 'Toutes les années' else max(filter_opts['annees'])
+            df_hhi = get_concentration(niveau_marche, annee_marche, activite_marche)
+
+            if len(df_hhi) > 0:
+                hover_hhi = {'Departement_Number': True, 'HHI': ':,.0f', 'Effectif': ':,', 'Nb_Etablissements': True}
+                if activite_marche is not None:
+                    df_hhi = df_hhi.assign(Leader=df_hhi['Finess_Leader'].map(finess_mapping).fillna(df_hhi['Finess_Leader']))
+                    hover_hhi.update({'Leader': True, 'Part_Leader': ':.0%'})
+                else:
+                    hover_hhi['Nb_Marches'] = True
+
+                fig_hhi = px.choropleth(
+                    df_hhi,
+                    geojson=departements_geojson,
+                    locations='Departement_Number',
+                    featureidkey="properties.code",
+                    color='HHI',
+                    range_color=(0, 10000),
+                    hover_name='Nom_Departement',
+                    hover_data=hover_hhi,
+                    color_continuous_scale=[[0, COLORS['secondary']], [0.25, COLORS['tertiary']], [1, COLORS['primary']]],
+                    labels={
+                        'HHI': 'HHI', 'Effectif': 'Effectif', 'Nb_Etablissements': 'Nb établissements',
+                        'Part_Leader': 'Part du leader', 'Nb_Marches': 'Nb activités', 'Departement_Number': 'Département'
+                    },
+                    title=f"Concentration par département ({annee_marche})"
+                )
+                fig_hhi.update_geos(fitbounds="locations", visible=False)
+                fig_hhi.update_layout(height=600, margin={"r": 0, "t": 50, "l": 0, "b": 0})
+                plotly_chart(fig_hhi, use_container_width=True, config={'responsive': True})
+                st.caption(
+                    "HHI = somme des carrés des parts de marché des établissements du département × 10 000 "
+                    "(< 1 500 : peu concentré, 1 500-2 500 : modérément, > 2 500 : très concentré). "
+                    "Toutes activités : moyenne des HHI de chaque activité pondérée par son effectif."
+                )
+            else:
+                st.info(f"Aucune activité {activite_marche} en {annee_marche}.")
+
         else:
             st.error("Les colonnes 'Departement_Number' et 'Nom_Departement' sont manquantes dans les données.")
 
 # TAB 5: CLASSIFICATIONS
-with tab5:
+with tab5, mesures_rerun.mesurer('onglet_comparaison'):
     st.markdown('<div class="section-title">Comparaison Multi-Établissements</div>', unsafe_allow_html=True)
 
-    st.markdown("""
+    st.markdown(f"""
     <div style="background: linear-gradient(135deg, #F0F8FF, #FFF9E6); padding: 10px 14px; border-radius: 6px; border-left: 4px solid #307E84; font-size: 0.82rem; margin-bottom: 16px;">
-        Comparez l'activité de plusieurs établissements sur un même GHM. Sélectionnez un code GHM et jusqu'à 10 établissements.
+        Comparez l'activité de plusieurs établissements sur un même GHM. Sélectionnez un code GHM et jusqu'à {MAX_ETAB_COMPARAISON} établissements (ou un département entier).
     </div>
     """, unsafe_allow_html=True)
 
+    # Établissements au profil de casemix le plus proche : proposés pour la comparaison
+    pairs_finess = []
+    if etablissement_selectionne != TOUS_ETABLISSEMENTS:
+        # Une année choisie : profil de cette année ; sinon profil toutes années confondues
+        annee_profil = annees_selectionnees[0] if len(annees_selectionnees) == 1 else None
+        nom_etab_pairs = finess_mapping.get(etablissement_selectionne, etablissement_selectionne)
+        with st.expander(f"👥 Établissements au profil similaire à {nom_etab_pairs}"):
+            niveau_profil = st.radio(
+                "Profil comparé",
+                options=list(NIVEAUX_PROFIL),
+                format_func=lambda x: f"Parts d'effectif par {NIVEAUX_PROFIL[x]}",
+                horizontal=True,
+                key="niveau_profil_pairs"
+            )
+            df_pairs = get_etablissements_similaires(etablissement_selectionne, annee_profil, niveau_profil)
+            pairs_finess = df_pairs['Finess'].tolist()
+            if len(df_pairs) > 0:
+                df_pairs_display = pd.DataFrame({
+                    'Établissement': df_pairs['Finess'].map(finess_mapping).fillna('Inconnu'),
+                    'FINESS': df_pairs['Finess'],
+                    'Département': df_pairs['Finess'].map(filter_opts['finess_departement']),
+                    'Similarité': df_pairs['Similarite'],
+                    'Séjours': df_pairs['Effectif']
+                })
+                st.dataframe(
+                    df_pairs_display,
+                    width="stretch",
+                    hide_index=True,
+                    column_config={'Similarité': st.column_config.ProgressColumn(min_value=0, max_value=1, format="%.2f")}
+                )
+                st.caption(
+                    f"Similarité cosinus des parts d'effectif ({'année ' + str(annee_profil) if annee_profil else 'toutes années'}). "
+                    "Présélection « Établissements similaires » ci-dessous pour les comparer sur un GHM."
+                )
+            else:
+                st.info("Pas d'activité pour cet établissement sur la période.")
+
+    # Index GHM précalculé par le moteur : chaque comparaison est un lookup, sans scan du dataset
+    df_ghm_options = get_ghm_options()
+
     # Sélection du GHM à comparer
     col_ghm, col_metric = st.columns([3, 1])
 
     with col_ghm:
         # Liste des GHM disponibles triée par effectif total
-        ghm_effectifs = df.groupby('Code_GHM')['Effectif'].sum().sort_values(ascending=False)
+        ghm_effectifs = df_ghm_options.set_index('Code_GHM')['Effectif']
         ghm_options = ghm_effectifs.index.tolist()
 
         # Créer un label avec le libellé
-        ghm_libelle_map = df.drop_duplicates('Code_GHM').set_index('Code_GHM')['Libelle'].to_dict()
+        ghm_libelle_map = dict(zip(df_ghm_options['Code_GHM'], df_ghm_options['Libelle']))
+
+        # Recherche insensible aux accents pour restreindre la liste
+        recherche_ghm = st.text_input("Rechercher un GHM", "", placeholder="Code ou mots du libellé", key="ghm_compare_search")
+        if recherche_ghm:
+            ghm_trouves = set(search_ghm(recherche_ghm))
+            ghm_options = [code for code in ghm_options if code in ghm_trouves] or ghm_options
+            if len(ghm_options) == len(ghm_effectifs):
+                st.caption("Aucun GHM trouvé : liste complète affichée.")
 
         def format_ghm(code):
             lib = ghm_libelle_map.get(code, '')
@@ -2024,12 +3129,8 @@ with tab5:
             key="metric_compare_select"
         )
 
-    # Filtrer les données pour ce GHM
-    df_ghm = df[df['Code_GHM'] == ghm_compare].copy()
-    df_ghm['Finess'] = df_ghm['Finess'].astype(str)
-
-    # Top établissements par effectif sur ce GHM
-    top_etab_ghm = df_ghm.groupby('Finess')['Effectif'].sum().sort_values(ascending=False)
+    # Top établissements par effectif sur ce GHM (lookup dans l'index)
+    top_etab_ghm = get_ghm_etablissements(ghm_compare)
     etab_options_compare = top_etab_ghm.index.tolist()
 
     def format_etab_compare(finess):
@@ -2037,31 +3138,48 @@ with tab5:
         eff = top_etab_ghm.get(finess, 0)
         return f"{nom} ({finess}) - {int(eff):,} séjours"
 
+    # Présélection rapide : top N ou tous les établissements d'un département
+    finess_departement = filter_opts['finess_departement']
+    depts_ghm = sorted({finess_departement.get(f) for f in etab_options_compare} - {None}, key=str)
+    preselection_options = ['Top 3', 'Top 10', 'Top 50'] + [f"Département : {d}" for d in depts_ghm]
+    # Établissement sélectionné et ses pairs, limités à ceux actifs sur le GHM
+    etab_et_pairs = [f for f in [etablissement_selectionne] + pairs_finess if f in top_etab_ghm.index]
+    if pairs_finess:
+        preselection_options.insert(0, 'Établissements similaires')
+
+    def appliquer_preselection():
+        choix = st.session_state.compare_preselection
+        if choix == 'Établissements similaires':
+            selection = etab_et_pairs
+        elif choix.startswith('Top '):
+            selection = etab_options_compare[:int(choix[4:])]
+        else:
+            dept = choix.split(' : ', 1)[1]
+            selection = [f for f in etab_options_compare if finess_departement.get(f) == dept]
+        st.session_state.etab_compare_multiselect = selection[:MAX_ETAB_COMPARAISON]
+
+    st.selectbox(
+        "Présélection rapide",
+        options=preselection_options,
+        index=None,
+        placeholder="Top N ou département entier...",
+        on_change=appliquer_preselection,
+        key="compare_preselection"
+    )
+
     etab_selectionnes = st.multiselect(
-        "Établissements à comparer (max 10)",
+        f"Établissements à comparer (max {MAX_ETAB_COMPARAISON})",
         options=etab_options_compare,
-        default=etab_options_compare[:3] if len(etab_options_compare) >= 3 else etab_options_compare,
-        max_selections=10,
+        default=None if 'etab_compare_multiselect' in st.session_state else (etab_et_pairs if len(etab_et_pairs) > 1 else etab_options_compare[:3]),
+        max_selections=MAX_ETAB_COMPARAISON,
         format_func=format_etab_compare,
         key="etab_compare_multiselect"
     )
 
     if etab_selectionnes and ghm_compare:
-        # Filtrer les données
-        df_compare = df_ghm[df_ghm['Finess'].isin(etab_selectionnes)]
-
-        # Agréger par établissement et année
-        if metric_compare == "Effectif":
-            df_pivot = df_compare.groupby(['Finess', 'Annee'])['Effectif'].sum().reset_index()
-        else:
-            # Moyenne pondérée par effectif
-            def weighted_agg(group):
-                eff = group['Effectif'].sum()
-                if eff > 0:
-                    return (group[metric_compare] * group['Effectif']).sum() / eff
-                return 0
-            df_pivot = df_compare.groupby(['Finess', 'Annee']).apply(weighted_agg).reset_index(name=metric_compare)
-            df_pivot['Effectif'] = df_compare.groupby(['Finess', 'Annee'])['Effectif'].sum().values
+        # Effectif et moyennes pondérées par établissement et année (sommes précalculées)
+        df_pivot = get_ghm_comparaison(ghm_compare, etab_selectionnes)
+        df_pivot = df_pivot[['Finess', 'Annee', 'Effectif'] + ([metric_compare] if metric_compare != 'Effectif' else [])]
 
         # Ajouter nom établissement
         df_pivot['Etablissement'] = df_pivot['Finess'].map(finess_mapping).fillna('Inconnu')
@@ -2069,6 +3187,12 @@ with tab5:
 
         metric_labels = {"Effectif": "Nombre de séjours", "DMS": "DMS (jours)", "Age_Moyen": "Âge moyen (ans)", "Taux_Deces": "Taux de décès (%)"}
 
+        # Références nationales du GHM (moyenne pondérée et distribution des établissements)
+        df_ref_compare = None
+        if metric_compare != 'Effectif':
+            df_ref_compare = get_ghm_references(ghm_compare)
+            df_ref_compare = df_ref_compare[df_ref_compare['Annee'].astype(str).isin(df_pivot['Annee'])]
+
         # Graphique principal : barres groupées par établissement, couleur = année
         fig = px.bar(
             df_pivot,
@@ -2080,7 +3204,11 @@ with tab5:
             text=metric_compare,
             color_discrete_sequence=COLORS['palette'] + ['#A0A0A0', '#D4A574', '#6B8E9B']
         )
-        fig.update_traces(texttemplate='%{text:,.0f}' if metric_compare == 'Effectif' else '%{text:.1f}', textposition='outside')
+        # Étiquettes de valeur illisibles au-delà d'une quinzaine d'établissements
+        fig.update_traces(
+            texttemplate='%{text:,.0f}' if metric_compare == 'Effectif' else '%{text:.1f}',
+            textposition='outside' if len(etab_selectionnes) <= 15 else 'none'
+        )
         fig.update_layout(
             height=500,
             xaxis=dict(title=''),
@@ -2088,7 +3216,18 @@ with tab5:
             legend_title="Année",
             margin=dict(l=20, r=20, t=60, b=20)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        if df_ref_compare is not None and len(df_ref_compare) > 0:
+            # Dernière année : moyenne nationale et intervalle interquartile des établissements
+            ref_derniere = df_ref_compare.iloc[-1]
+            fig.add_hrect(
+                y0=ref_derniere[f'{metric_compare}_P25'], y1=ref_derniere[f'{metric_compare}_P75'],
+                fillcolor=COLORS['secondary'], opacity=0.1, line_width=0
+            )
+            fig.add_hline(
+                y=ref_derniere[f'{metric_compare}_National'], line_dash='dash', line_color=COLORS['secondary'],
+                annotation_text=f"National {ref_derniere['Annee']} (bande : P25-P75)", annotation_position='top left'
+            )
+        plotly_chart(fig, use_container_width=True)
 
         # Tableau récapitulatif
         st.markdown('<div class="section-title">Tableau récapitulatif</div>', unsafe_allow_html=True)
@@ -2099,6 +3238,15 @@ with tab5:
             values=metric_compare,
             aggfunc='sum' if metric_compare == 'Effectif' else 'mean'
         ).reset_index()
+        if df_ref_compare is not None and len(df_ref_compare) > 0:
+            lignes_nationales = pd.DataFrame({
+                'Etablissement': ['Moyenne nationale', 'Médiane nationale'],
+                **{
+                    str(ligne['Annee']): [ligne[f'{metric_compare}_National'], ligne[f'{metric_compare}_Mediane']]
+                    for _, ligne in df_ref_compare.iterrows()
+                }
+            })
+            df_recap = pd.concat([df_recap, lignes_nationales], ignore_index=True)
 
         # Ajouter variation si possible
         annees_dispo = sorted(df_pivot['Annee'].unique())
@@ -2111,16 +3259,44 @@ with tab5:
 
         st.dataframe(df_recap, use_container_width=True, height=min(400, 40 + len(df_recap) * 35))
 
+        # Position de chaque établissement sur son marché départemental du GHM
+        st.markdown('<div class="section-title">Parts de marché départementales</div>', unsafe_allow_html=True)
+        df_parts = get_parts_de_marche('Code_GHM', ghm_compare, etab_selectionnes)
+        if len(df_parts) > 0:
+            df_parts_display = pd.DataFrame({
+                'Établissement': df_parts['Finess'].map(finess_mapping).fillna('Inconnu'),
+                'Année': df_parts['Annee'].astype(str),
+                'Département': df_parts['Nom_Departement'],
+                'Séjours': df_parts['Effectif'],
+                'Part de marché': df_parts['Part'] * 100,
+                'Rang': df_parts['Rang'].astype(str) + ' / ' + df_parts['Nb_Etablissements'].astype(str),
+                'HHI dépt.': df_parts['HHI'].round(0),
+                'Spécialisation': df_parts['Indice_Specialisation']
+            })
+            st.dataframe(
+                df_parts_display,
+                width="stretch",
+                hide_index=True,
+                column_config={
+                    'Part de marché': st.column_config.ProgressColumn(min_value=0, max_value=100, format="%.1f%%"),
+                    'Spécialisation': st.column_config.NumberColumn(format="%.2f")
+                }
+            )
+            st.caption(
+                "Part et rang parmi les établissements du département sur ce GHM. Spécialisation : écart du portefeuille "
+                "de GHM de l'établissement au mix national (indice de Krugman, 0 = identique, 1 = totalement différent)."
+            )
+
     elif not etab_selectionnes:
         st.info("Sélectionnez au moins un établissement pour afficher la comparaison.")
 
 # TAB 6: ÉVOLUTION TEMPORELLE
-with tab6:
+with tab6, mesures_rerun.mesurer('onglet_evolution'):
     st.markdown('<div class="section-title">Évolution Temporelle</div>', unsafe_allow_html=True)
 
     if len(annees_selectionnees) > 1:
         # Évolution globale (CACHE - évite recalcul weighted averages!)
-        df_evol = compute_evolution_data(df_filtered)
+        df_evol = compute_evolution_data()
 
         # Graphiques sur 2 colonnes
         col1, col2 = st.columns(2)
@@ -2141,7 +3317,7 @@ with tab6:
                 yaxis=dict(title='Effectif'),
                 margin=dict(l=20, r=20, t=40, b=20)
             )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
 
         with col2:
             fig = px.line(
@@ -2159,7 +3335,7 @@ with tab6:
                 yaxis=dict(title='DMS (jours)'),
                 margin=dict(l=20, r=20, t=40, b=20)
             )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
 
         col3, col4 = st.columns(2)
 
@@ -2179,7 +3355,7 @@ with tab6:
                 yaxis=dict(title='Âge (années)'),
                 margin=dict(l=20, r=20, t=40, b=20)
             )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
 
         with col4:
             fig = px.line(
@@ -2197,115 +3373,219 @@ with tab6:
                 yaxis=dict(title='Taux de décès (%)'),
                 margin=dict(l=20, r=20, t=40, b=20)
             )
-            st.plotly_chart(fig, use_container_width=True)
+            plotly_chart(fig, use_container_width=True)
+
+    else:
+        st.info("Sélectionnez plusieurs années pour voir l'évolution temporelle")
 
-        # Top 5 libellés évolution
-        st.markdown('<div class="section-title">Évolution des Principaux Libellés</div>', unsafe_allow_html=True)
+    # Moteur de variations : un seul pivot dimension × Annee, toutes paires d'années
+    # En vue nationale, pivot précalculé sur toutes les années (indépendant du filtrage)
+    vue_nationale = etablissement_selectionne == TOUS_ETABLISSEMENTS
 
-        top5_libelles = df_filtered.groupby('Libelle')['Effectif'].sum().nlargest(5).index
-        df_top5_evol = df_filtered[df_filtered['Libelle'].isin(top5_libelles)]
-        df_top5_evol = df_top5_evol.groupby(['Annee', 'Libelle'])['Effectif'].sum().reset_index()
+    if len(annees_selectionnees) > 1 or vue_nationale:
+        st.markdown('<div class="section-title">Évolution des Principaux Éléments</div>', unsafe_allow_html=True)
+
+        dimensions_dispo = [d for d in DIMENSIONS_VARIATION if d in df_filtered.columns]
+        dimension_variation = st.selectbox(
+            "Niveau d'analyse",
+            options=dimensions_dispo,
+            format_func=lambda x: DIMENSIONS_VARIATION[x],
+            key="variation_dimension"
+        )
+        label_dimension = DIMENSIONS_VARIATION[dimension_variation]
+
+        if vue_nationale:
+            engine_variation = get_national_variation_engine(dimension_variation)
+        else:
+            engine_variation = compute_variation_engine(dimension_variation)
+
+        # Années comparables : celles de la sélection si plusieurs, sinon toutes (vue nationale)
+        annees_variation = [a for a in engine_variation['annees'] if a in annees_selectionnees]
+        if len(annees_variation) < 2:
+            annees_variation = engine_variation['annees']
+
+        pivot_variation = engine_variation['pivot'][annees_variation]
+        top5 = pivot_variation.sum(axis=1).nlargest(5).index
+        df_top5_evol = pivot_variation.loc[top5].rename_axis(columns='Annee').stack().rename('Effectif').reset_index()
 
         fig = px.bar(
             df_top5_evol,
             x='Annee',
             y='Effectif',
-            color='Libelle',
+            color=dimension_variation,
             barmode='group',
-            title="Évolution des 5 Libellés Principaux",
+            title=f"Évolution des 5 principaux ({label_dimension})",
             color_discrete_sequence=COLORS['palette']
         )
         fig.update_layout(
             height=450,
             xaxis=dict(title='', type='category'),
             yaxis=dict(title='Effectif'),
-            legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02),
+            legend=dict(orientation="v", yanchor="top", y=1, xanchor="left", x=1.02, title=''),
             margin=dict(l=20, r=150, t=40, b=20)
         )
-        st.plotly_chart(fig, use_container_width=True)
+        plotly_chart(fig, use_container_width=True)
 
         # Analyse des plus fortes progressions/régressions
         st.markdown('<div class="section-title">Plus Fortes Variations</div>', unsafe_allow_html=True)
 
-        # Calculer les variations entre première et dernière année
-        annee_debut = min(annees_selectionnees)
-        annee_fin = max(annees_selectionnees)
+        if len(annees_variation) < 2:
+            st.info("Une seule année disponible : pas de variation calculable.")
+        else:
+            col_base, col_cible = st.columns(2)
+            with col_base:
+                annee_debut = st.selectbox("Année de référence", options=annees_variation[:-1], index=0, key="variation_annee_base")
+            with col_cible:
+                annees_cibles = [a for a in annees_variation if a > annee_debut]
+                annee_fin = st.selectbox("Année comparée", options=annees_cibles, index=len(annees_cibles) - 1, key="variation_annee_cible")
 
-        df_debut = df_filtered[df_filtered['Annee'] == annee_debut].groupby('Libelle')['Effectif'].sum()
-        df_fin = df_filtered[df_filtered['Annee'] == annee_fin].groupby('Libelle')['Effectif'].sum()
+            df_variation = get_variation_table(engine_variation, annee_debut, annee_fin)
 
-        df_variation = pd.DataFrame({
-            'Effectif_debut': df_debut,
-            'Effectif_fin': df_fin
-        }).dropna()
+            col1, col2 = st.columns(2)
 
-        df_variation = df_variation[df_variation['Effectif_debut'] >= 5]  # Filtrer les petits effectifs
-        df_variation['Variation_abs'] = df_variation['Effectif_fin'] - df_variation['Effectif_debut']
-        df_variation['Variation_pct'] = (df_variation['Variation_abs'] / df_variation['Effectif_debut'] * 100)
-        df_variation = df_variation.reset_index()
+            with col1:
+                # Top progressions
+                df_prog = df_variation.nlargest(10, 'Variation_abs')
 
-        col1, col2 = st.columns(2)
+                fig = px.bar(
+                    df_prog,
+                    x='Variation_abs',
+                    y=dimension_variation,
+                    orientation='h',
+                    title=f"Top 10 Progressions ({annee_debut} → {annee_fin})",
+                    color='Variation_abs',
+                    color_continuous_scale=[[0, COLORS['tertiary']], [1, COLORS['secondary']]],
+                    text='Variation_abs'
+                )
+                fig.update_traces(texttemplate='%{text:+.0f}', textposition='outside')
+                fig.update_layout(
+                    height=450,
+                    showlegend=False,
+                    yaxis=dict(title=''),
+                    xaxis=dict(title='Variation effectif'),
+                    margin=dict(l=20, r=20, t=40, b=20)
+                )
+                plotly_chart(fig, use_container_width=True)
 
-        with col1:
-            # Top progressions
-            df_prog = df_variation.sort_values('Variation_abs', ascending=False).head(10)
+            with col2:
+                # Top régressions
+                df_regr = df_variation.nsmallest(10, 'Variation_abs')
 
-            fig = px.bar(
-                df_prog,
-                x='Variation_abs',
-                y='Libelle',
-                orientation='h',
-                title=f"Top 10 Progressions ({annee_debut} → {annee_fin})",
-                color='Variation_abs',
-                color_continuous_scale=[[0, COLORS['tertiary']], [1, COLORS['secondary']]],
-                text='Variation_abs'
-            )
-            fig.update_traces(texttemplate='%{text:+.0f}', textposition='outside')
-            fig.update_layout(
-                height=450,
-                showlegend=False,
-                yaxis=dict(title=''),
-                xaxis=dict(title='Variation effectif'),
-                margin=dict(l=20, r=20, t=40, b=20)
+                fig = px.bar(
+                    df_regr,
+                    x='Variation_abs',
+                    y=dimension_variation,
+                    orientation='h',
+                    title=f"Top 10 Régressions ({annee_debut} → {annee_fin})",
+                    color='Variation_abs',
+                    color_continuous_scale=[[0, COLORS['primary']], [1, COLORS['quaternary']]],
+                    text='Variation_abs'
+                )
+                fig.update_traces(texttemplate='%{text:+.0f}', textposition='outside')
+                fig.update_layout(
+                    height=450,
+                    showlegend=False,
+                    yaxis=dict(title=''),
+                    xaxis=dict(title='Variation effectif'),
+                    margin=dict(l=20, r=20, t=40, b=20)
+                )
+                plotly_chart(fig, use_container_width=True)
+
+            # Tableau complet des variations
+            st.markdown(f"### 📋 Variations {annee_debut} → {annee_fin} par {label_dimension}")
+            df_variation_display = df_variation.sort_values('Variation_abs', ascending=False).rename(columns={
+                dimension_variation: label_dimension,
+                'Effectif_debut': f'Effectif {annee_debut}',
+                'Effectif_fin': f'Effectif {annee_fin}',
+                'Variation_abs': 'Variation',
+                'Variation_pct': 'Variation (%)',
+                'TCAM': 'TCAM (%)',
+                'Rang_debut': f'Rang {annee_debut}',
+                'Rang_fin': f'Rang {annee_fin}',
+                'Gain_rang': 'Gain de rang'
+            })
+            st.dataframe(
+                df_variation_display.round({'Variation (%)': 1, 'TCAM (%)': 1}),
+                width="stretch",
+                hide_index=True,
+                height=400
             )
-            st.plotly_chart(fig, use_container_width=True)
 
-        with col2:
-            # Top régressions
-            df_regr = df_variation.sort_values('Variation_abs', ascending=True).head(10)
+    # Projections : tendance log-linéaire par (établissement, racine), toutes années observées
+    st.markdown('<div class="section-title">🔮 Projections d\'Activité</div>', unsafe_allow_html=True)
+    st.info(
+        f"Effectif projeté sur {HORIZON_PREVISION} ans à partir de toutes les années disponibles, indépendamment des années "
+        "sélectionnées (les années non déclarées par l'établissement sont ignorées). Le total de l'établissement et chaque "
+        "racine GHM suivent leur tendance récente, rapprochée de la tendance nationale quand le volume est faible ; les "
+        "racines sont calées sur le total. La bande couvre 80 % des évolutions plausibles."
+    )
 
-            fig = px.bar(
-                df_regr,
-                x='Variation_abs',
-                y='Libelle',
-                orientation='h',
-                title=f"Top 10 Régressions ({annee_debut} → {annee_fin})",
-                color='Variation_abs',
-                color_continuous_scale=[[0, COLORS['primary']], [1, COLORS['quaternary']]],
-                text='Variation_abs'
-            )
-            fig.update_traces(texttemplate='%{text:+.0f}', textposition='outside')
-            fig.update_layout(
-                height=450,
-                showlegend=False,
-                yaxis=dict(title=''),
-                xaxis=dict(title='Variation effectif'),
-                margin=dict(l=20, r=20, t=40, b=20)
-            )
-            st.plotly_chart(fig, use_container_width=True)
+    df_prev = get_previsions(etablissement_selectionne)
+    df_prev_observe = df_prev[df_prev['Type'] == 'Observé']
+    # La courbe projetée part du dernier point observé pour une lecture continue
+    df_trace_prevu = pd.concat([df_prev_observe.tail(1), df_prev[df_prev['Type'] == 'Projeté']])
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(
+        x=list(df_trace_prevu['Annee']) + list(df_trace_prevu['Annee'][::-1]),
+        y=list(df_trace_prevu['Borne_Haute']) + list(df_trace_prevu['Borne_Basse'][::-1]),
+        fill='toself', fillcolor='rgba(128, 128, 128, 0.2)', line=dict(width=0),
+        hoverinfo='skip', name='Intervalle 80 %'
+    ))
+    fig.add_trace(go.Scatter(
+        x=df_prev_observe['Annee'], y=df_prev_observe['Effectif'],
+        mode='lines+markers', name='Observé', line=dict(color=COLORS['primary'], width=3), marker=dict(size=10)
+    ))
+    fig.add_trace(go.Scatter(
+        x=df_trace_prevu['Annee'], y=df_trace_prevu['Effectif'],
+        mode='lines+markers', name='Projeté', line=dict(color=COLORS['primary'], width=3, dash='dash'), marker=dict(size=10)
+    ))
+    fig.update_layout(
+        title="Effectif observé et projeté",
+        height=400,
+        xaxis=dict(title='', dtick=1),
+        yaxis=dict(title='Effectif'),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+        margin=dict(l=20, r=20, t=60, b=20)
+    )
+    plotly_chart(fig, use_container_width=True)
 
+    if etablissement_selectionne == TOUS_ETABLISSEMENTS:
+        st.caption("Sélectionnez un établissement pour le détail des projections par racine GHM.")
     else:
-        st.info("Sélectionnez plusieurs années pour voir l'évolution temporelle")
+        annee_base_prev = max(filter_opts['annees'])
+        df_prev_racines = get_previsions_racines(etablissement_selectionne)
+        st.markdown(f"### 📋 Projections par racine GHM (base {annee_base_prev})")
+        st.dataframe(
+            df_prev_racines.round(1).assign(
+                Probabilite_Activite=df_prev_racines['Probabilite_Activite'], Credibilite=df_prev_racines['Credibilite']
+            ).rename(columns={
+                'Effectif_Dernier': f'Effectif {annee_base_prev}',
+                'Tendance_Pct': 'Tendance retenue (%/an)',
+                'Tendance_Propre_Pct': 'Tendance propre (%/an)',
+                'Tendance_Nationale_Pct': 'Tendance nationale (%/an)',
+                'Probabilite_Activite': "Probabilité d'activité",
+                'Credibilite': 'Poids tendance propre',
+                **{c: f"Projeté {c.split('_')[1]}" for c in df_prev_racines.columns if c.startswith('Prevu_')}
+            }),
+            width="stretch",
+            hide_index=True,
+            height=400,
+            column_config={
+                "Probabilité d'activité": st.column_config.ProgressColumn(min_value=0, max_value=1, format="%.2f"),
+                'Poids tendance propre': st.column_config.ProgressColumn(min_value=0, max_value=1, format="%.2f")
+            }
+        )
 
 # TAB 7: EXPORT DONNÉES
-with tab7:
+with tab7, mesures_rerun.mesurer('onglet_export'):
     st.markdown('<div class="section-title">Export des Données</div>', unsafe_allow_html=True)
 
     # Options d'affichage
     col1, col2, col3 = st.columns([2, 1, 1])
 
     with col1:
-        recherche_table = st.text_input("Rechercher dans le tableau", "")
+        recherche_table = st.text_input("Rechercher dans le tableau", "", placeholder="Libellé ou code GHM, sans accents ni mots complets")
 
     with col2:
         nb_lignes = st.selectbox("Nombre de lignes", [100, 500, 1000, "Toutes"], index=0)
@@ -2313,12 +3593,10 @@ with tab7:
     with col3:
         tri_colonne = st.selectbox("Trier par", ['Effectif', 'DMS', 'Age_Moyen', 'Taux_Deces'], index=0)
 
-    # Filtrer par recherche
-    df_export = df_filtered.copy()
+    # Filtrer par recherche (index insensible aux accents, ~2 500 GHM au lieu d'un scan des lignes)
+    df_export = df_filtered
     if recherche_table:
-        df_export = df_export[
-            df_export['Libelle'].str.contains(recherche_table, case=False, na=False)
-        ]
+        df_export = df_export[compute_search_mask(df_export['Code_GHM'], search_ghm(recherche_table))]
 
     # Trier
     df_export = df_export.sort_values(tri_colonne, ascending=False)
@@ -2367,62 +3645,26 @@ with tab7:
     col1, col2, col3 = st.columns([1, 1, 2])
 
     with col1:
-        csv = df_export_display.to_csv(index=False, sep=';').encode('utf-8-sig')
-        st.download_button(
-            label="Télécharger CSV",
-            data=csv,
-            file_name=f"casemix_{etablissement_selectionne}_{pd.Timestamp.now().strftime('%Y%m%d')}.csv",
-            mime="text/csv",
-            width="stretch"
+        format_export = st.selectbox(
+            "Format",
+            options=list(FORMATS_EXPORT),
+            format_func=lambda x: FORMATS_EXPORT[x][0],
+            key="export_format"
         )
 
     with col2:
-        # Export Excel avec formatage
-        from io import BytesIO
-
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Écrire les données
-            df_export_display.to_excel(writer, sheet_name='Données Casemix', index=False)
-
-            # Obtenir le workbook et la feuille
-            workbook = writer.book
-            worksheet = writer.sheets['Données Casemix']
-
-            # Formatage de l'en-tête
-            from openpyxl.styles import Font, PatternFill, Alignment
-            header_fill = PatternFill(start_color='823B8A', end_color='823B8A', fill_type='solid')
-            header_font = Font(bold=True, color='FFFFFF', size=11)
-
-            for cell in worksheet[1]:
-                cell.fill = header_fill
-                cell.font = header_font
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-
-            # Ajuster largeur colonnes
-            for column in worksheet.columns:
-                max_length = 0
-                column_letter = column[0].column_letter
-                for cell in column:
-                    try:
-                        if len(str(cell.value)) > max_length:
-                            max_length = len(str(cell.value))
-                    except:
-                        pass
-                adjusted_width = min(max_length + 2, 50)
-                worksheet.column_dimensions[column_letter].width = adjusted_width
-
-            # Figer la première ligne
-            worksheet.freeze_panes = 'A2'
-
-        excel_data = output.getvalue()
-
+        # Fichier construit uniquement au clic (callable), puis mis en cache par sélection
+        selection_hash = compute_selection_hash(
+            etablissement_selectionne, annees_selectionnees, recherche_table, nb_lignes, tri_colonne
+        )
+        label_format, extension, mime = FORMATS_EXPORT[format_export]
         st.download_button(
-            label="📥 Télécharger Excel",
-            data=excel_data,
-            file_name=f"casemix_{etablissement_selectionne}_{pd.Timestamp.now().strftime('%Y%m%d')}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True
+            label=f"📥 Télécharger {label_format}",
+            data=lambda: get_cached_export(selection_hash, format_export, df_export_display),
+            file_name=f"casemix_{etablissement_selectionne}_{pd.Timestamp.now().strftime('%Y%m%d')}.{extension}",
+            mime=mime,
+            on_click="ignore",
+            width="stretch"
         )
 
     with col3:
@@ -2436,7 +3678,75 @@ with tab7:
 st.markdown("---")
 st.markdown(f"""
 <div style="text-align: center; padding: 20px; color: #999; font-size: 0.85rem;">
-    <p style="margin: 0;">Dashboard Casemix GHM v5.0 | {len(df):,} lignes | {df['Finess'].nunique()} établissements</p>
+    <p style="margin: 0;">Dashboard Casemix GHM v5.0 | {filter_opts['nb_lignes']:,} lignes | {filter_opts['nb_etablissements']} établissements</p>
     <p style="margin: 5px 0 0 0;">Enterprise Accounts - Jérémy Indelicato</p>
 </div>
 """, unsafe_allow_html=True)
+
+# ========================================
+# TÉLÉMÉTRIE DU RERUN
+# ========================================
+
+duree_rerun_ms = mesures_rerun.terminer(
+    etablissement=etablissement_selectionne,
+    annees=list(annees_selectionnees)
+)
+
+# Profil du rerun (armé au rerun précédent) : sauvegarde avec le contexte de sélection
+if profil_rerun is not None:
+    del st.session_state.profil_actif
+    onglets = {
+        m['section'].removeprefix('onglet_'): m['duree_ms']
+        for m in mesures_rerun.mesures if m['section'].startswith('onglet_')
+    }
+    st.session_state.dernier_profil = profil_rerun.terminer({
+        'horodatage': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'etablissement': etablissement_selectionne,
+        'annees': list(annees_selectionnees),
+        'duree_rerun_ms': round(duree_rerun_ms, 1),
+        'onglet_le_plus_lent': max(onglets, key=onglets.get) if onglets else None,
+        'onglets_ms': onglets
+    })
+
+# Panneau de profilage (admin) : ?admin=<CASEMIX_ADMIN_TOKEN>
+if est_admin():
+    with st.sidebar.expander("🔬 Profilage", expanded='dernier_profil' in st.session_state):
+        st.caption("Armer, puis reproduire l'action lente (établissement, années, onglet) : le rerun suivant est profilé.")
+        if st.button("Profiler le prochain rerun", key='armer_profil', width="stretch"):
+            st.session_state.profil_arme = True
+        if st.session_state.get('profil_arme'):
+            st.info("Profilage armé pour le prochain rerun")
+        dernier_profil = st.session_state.get('dernier_profil')
+        if dernier_profil:
+            contexte = dernier_profil['contexte']
+            st.markdown(
+                f"**Dernier profil** : {contexte['etablissement']} • {', '.join(map(str, contexte['annees'])) or '-'} • "
+                f"{contexte['duree_rerun_ms']:,.0f} ms (onglet le plus lent : {contexte['onglet_le_plus_lent']})"
+            )
+            st.download_button(
+                f"📥 {dernier_profil['fichier']}",
+                data=dernier_profil['contenu'],
+                file_name=dernier_profil['fichier'],
+                mime=dernier_profil['mime'],
+                width="stretch"
+            )
+            st.code(dernier_profil['resume'][:5000], language=None)
+
+# Panneau debug (opt-in) : ?debug=1
+if st.query_params.get('debug') == '1':
+    with st.sidebar.expander("⏱️ Télémétrie", expanded=True):
+        stats_reruns = get_telemetrie().stats_reruns()
+        st.caption(
+            f"Ce rerun : {duree_rerun_ms:,.0f} ms • "
+            f"processus : p50 {stats_reruns['p50_ms']:,.0f} ms, p95 {stats_reruns['p95_ms']:,.0f} ms "
+            f"({stats_reruns['nb']} reruns)"
+        )
+        df_mesures = pd.DataFrame(mesures_rerun.mesures)
+        st.dataframe(df_mesures.sort_values('duree_ms', ascending=False), hide_index=True, width="stretch")
+        st.markdown("**Toutes sessions**")
+        st.dataframe(
+            get_telemetrie().stats_sections(),
+            hide_index=True,
+            width="stretch",
+            column_config={'Succès cache': st.column_config.NumberColumn(format="percent")}
+        )
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark des calculs du dashboard Casemix par scénario (sans interface)
+Latences (p50/p95/p99) et pic mémoire par scénario, enregistrés en JSON pour
+comparer deux commits.
+
+Utilisation :
+    python benchmark_casemix.py                          # tous les scénarios
+    python benchmark_casemix.py --repeat 10 --filtre tab3
+    python benchmark_casemix.py --compare bench_results/avant.json bench_results/apres.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from casemix_engine import (
+    DATA_FILE, TOUS_ETABLISSEMENTS, DIMENSIONS_VARIATION, CasemixEngine, load_dataset,
+    build_variation_engine, get_variation_table, compute_search_mask
+)
+
+# Configurer l'encodage de sortie
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+FINESS_DEFAUT = '010007300'
+RESULTS_DIR = Path("bench_results")
+
+# Filtres locaux de l'onglet "Sélection Filtrée"
+FACETTES_TAB2 = ['Code_GHM', 'MCO', 'CAS', 'DA', 'GP', 'GA', 'Classif PKCS', 'Libracine', 'Regroupement GHM PH']
+
+# ========================================
+# SÉLECTIONS DE RÉFÉRENCE
+# ========================================
+
+def trouver_plus_gros_chu(engine):
+    """FINESS du CHU/CHR au plus gros effectif (à défaut, le plus gros établissement)"""
+    effectifs = engine.df.groupby(engine.df['Finess'].astype(str), observed=True)['Effectif'].sum()
+    try:
+        mapping = pd.read_csv('etablissements_finess.csv', sep=',', encoding='utf-8-sig', dtype=str)
+        noms = dict(zip(mapping['Finess'], mapping['Raison sociale'].fillna('')))
+    except (OSError, KeyError):
+        noms = {}
+    chu = [f for f in effectifs.index if any(m in noms.get(f, '').upper().split() for m in ('CHU', 'CHR', 'CHRU'))]
+    candidats = effectifs.loc[chu] if chu else effectifs
+    return candidats.idxmax()
+
+def selections_reference(engine):
+    """Sélections (nom, finess, années) couvrant les cas de volume du dashboard"""
+    annees = engine.options()['annees']
+    selections = [
+        ('defaut', FINESS_DEFAUT, annees),
+        ('plus_gros_chu', trouver_plus_gros_chu(engine), annees),
+        ('national_une_annee', TOUS_ETABLISSEMENTS, [max(annees)]),
+        ('national_toutes_annees', TOUS_ETABLISSEMENTS, annees),
+    ]
+    if FINESS_DEFAUT not in engine.options()['finess']:
+        selections[0] = ('defaut', engine.options()['finess'][0], annees)
+    return selections
+
+# ========================================
+# SCÉNARIOS (UN PAR ONGLET ET PAR FACETTE)
+# ========================================
+
+# Règles de l'exemple du simulateur de campagne tarifaire (onglet 3)
+REGLES_EXEMPLE = [
+    {'dimension': 'MCO', 'valeur': 'Chirurgie', 'variation_pct': -2.0, 'grille': None},
+    {'dimension': 'MCO', 'valeur': 'Médecine', 'variation_pct': 1.0, 'grille': None}
+]
+
+def scenario_tab1(engine, finess, annees):
+    """Vue d'ensemble : KPIs, indices standardisés, top 10, détail et références, histogrammes, corrélation, arbre GHM"""
+    engine.kpis(finess, annees)
+    if finess != TOUS_ETABLISSEMENTS:
+        engine.performance(finess, annees)
+    engine.top_libelles(finess, annees, 10)
+    engine.detail_libelles(finess, annees, 20)
+    engine.references_selection(finess, annees, 'Libelle')
+    data = engine.selection(finess, annees)
+    for col in ['Age_Moyen', 'DMS']:
+        valides = data[data[col].notna() & (data['Effectif'] > 0)]
+        np.median(np.repeat(valides[col].values, valides['Effectif'].astype(int).values))
+    engine.correlation(finess, annees)
+    engine.hierarchie_ghm(finess, annees)
+
+def scenario_tab2(engine, finess, annees, facette=None):
+    """Sélection filtrée : listes des 9 filtres, puis filtrage sur une facette et effectif par année"""
+    data = engine.selection(finess, annees)
+    valeurs = {}
+    for col in FACETTES_TAB2:
+        valeurs[col] = sorted(x for x in data[col].unique() if pd.notna(x) and x != 'Non renseigné')
+    if facette and valeurs[facette]:
+        # Valeur la plus fréquente : cas le plus défavorable pour le filtrage
+        valeur = data[facette].value_counts().index[0]
+        data = data[data[facette] == valeur]
+    data.groupby('Annee')['Effectif'].sum()
+
+def scenario_tab3(engine, finess, annees):
+    """Analyse financière : top 30 GHM par CA public et privé, décomposition du CA, simulateur (volumes observés et projetés)"""
+    for statut in ['Public', 'Privé']:
+        engine.financier(finess, annees, statut)
+    toutes_annees = engine.options()['annees']
+    if len(toutes_annees) >= 2:
+        engine.decomposition_ca(toutes_annees[0], toutes_annees[-1])
+    engine.valeurs_tarif('MCO')
+    engine.simulation_tarifs(REGLES_EXEMPLE, max(toutes_annees))
+    engine.simulation_tarifs(REGLES_EXEMPLE, horizon=1)
+
+def scenario_tab4(engine, finess, annees):
+    """Carte : choropleth départemental, maille régionale, exploration et concentration (HHI)"""
+    finess_carte = None if finess == TOUS_ETABLISSEMENTS else finess
+    engine.departements(finess_carte)
+    engine.departements(finess_carte, annee=max(annees))
+    engine.rollup('Region')
+    engine.rollup('Region', max(annees))
+    engine.concentration('Code_GHM', max(annees))
+
+def scenario_tab5(engine, finess, annees):
+    """Comparaison : pairs, GHM au plus gros effectif de la sélection, top 50 établissements, références, parts de marché"""
+    if finess != TOUS_ETABLISSEMENTS:
+        engine.etablissements_similaires(finess, annees[0] if len(annees) == 1 else None)
+    data = engine.selection(finess, annees)
+    if len(data):
+        code = data.groupby(data['Code_GHM'].astype(str))['Effectif'].sum().idxmax()
+    else:
+        code = engine.ghm_options()['Code_GHM'].iloc[0]
+    etablissements = engine.comparaison_etablissements(code)['Finess'].head(50).tolist()
+    engine.comparaison(code, etablissements)
+    engine.references(code)
+    engine.parts_de_marche('Code_GHM', code, etablissements)
+
+def scenario_tab6(engine, finess, annees):
+    """Évolution : séries annuelles, tables de variations pour les 4 dimensions, projections d'activité"""
+    engine.evolution(finess, annees)
+    for dimension in DIMENSIONS_VARIATION:
+        moteur = build_variation_engine(engine.variation_pivot(dimension, finess, annees))
+        if len(moteur['annees']) >= 2:
+            get_variation_table(moteur, moteur['annees'][0], moteur['annees'][-1])
+    engine.previsions(finess)
+    if finess != TOUS_ETABLISSEMENTS:
+        engine.previsions_racines(finess)
+
+def scenario_tab7(engine, finess, annees):
+    """Export : recherche, tri, 1 000 lignes sérialisées en CSV"""
+    data = engine.selection(finess, annees)
+    codes = engine.recherche_ghm('intervention')
+    data = data[compute_search_mask(data['Code_GHM'], codes)]
+    data = data.sort_values('Effectif', ascending=False).head(1000)
+    data.to_csv(BytesIO(), index=False)
+
+SCENARIOS_ONGLETS = {
+    'tab1': scenario_tab1,
+    'tab2': scenario_tab2,
+    'tab3': scenario_tab3,
+    'tab4': scenario_tab4,
+    'tab5': scenario_tab5,
+    'tab6': scenario_tab6,
+    'tab7': scenario_tab7,
+}
+
+def lister_scenarios(engine):
+    """Liste (nom, fonction) de tous les scénarios nommés"""
+    scenarios = []
+    for nom_sel, finess, annees in selections_reference(engine):
+        scenarios.append((f"{nom_sel}/selection", lambda f=finess, a=annees: engine.selection(f, a)))
+        for nom_tab, fonction in SCENARIOS_ONGLETS.items():
+            scenarios.append((f"{nom_sel}/{nom_tab}", lambda fn=fonction, f=finess, a=annees: fn(engine, f, a)))
+        for facette in FACETTES_TAB2:
+            scenarios.append((
+                f"{nom_sel}/tab2_facette/{facette}",
+                lambda f=finess, a=annees, fa=facette: scenario_tab2(engine, f, a, fa)
+            ))
+    return scenarios
+
+# ========================================
+# MESURE
+# ========================================
+
+def mesurer(engine, fonction, repeat):
+    """Latences de `repeat` exécutions (cache de sélections vidé) et pic mémoire d'une exécution"""
+    durees = []
+    for _ in range(repeat):
+        engine.vider_selections()
+        debut = time.perf_counter()
+        fonction()
+        durees.append(time.perf_counter() - debut)
+
+    # Pic mémoire mesuré à part : tracemalloc ralentit les allocations
+    engine.vider_selections()
+    tracemalloc.start()
+    fonction()
+    _, pic = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    durees_ms = np.array(durees) * 1000
+    return {
+        'repeat': repeat,
+        'p50_ms': float(np.percentile(durees_ms, 50)),
+        'p95_ms': float(np.percentile(durees_ms, 95)),
+        'p99_ms': float(np.percentile(durees_ms, 99)),
+        'moyenne_ms': float(durees_ms.mean()),
+        'min_ms': float(durees_ms.min()),
+        'pic_memoire_mb': pic / (1024 * 1024)
+    }
+
+def contexte_execution(engine, data_path):
+    """Commit, versions et volumétrie : pour ne comparer que des mesures comparables"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'inconnu'
+    return {
+        'commit': commit,
+        'date': pd.Timestamp.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'fichier': str(data_path),
+        'lignes': len(engine.df)
+    }
+
+def comparer(fichier_avant, fichier_apres, seuil=0.10):
+    """Tableau des ratios p50/p95 entre deux fichiers de résultats"""
+    avant = json.loads(Path(fichier_avant).read_text(encoding='utf-8'))
+    apres = json.loads(Path(fichier_apres).read_text(encoding='utf-8'))
+    print(f"Avant : {avant['contexte']['commit']} ({avant['contexte']['lignes']:,} lignes)")
+    print(f"Après : {apres['contexte']['commit']} ({apres['contexte']['lignes']:,} lignes)")
+    print()
+    print(f"{'Scénario':55s} {'p50 avant':>10s} {'p50 après':>10s} {'ratio':>7s} {'p95 ratio':>10s}")
+    for nom, mesure in apres['scenarios'].items():
+        if nom not in avant['scenarios']:
+            continue
+        ref = avant['scenarios'][nom]
+        ratio_p50 = mesure['p50_ms'] / ref['p50_ms'] if ref['p50_ms'] else float('nan')
+        ratio_p95 = mesure['p95_ms'] / ref['p95_ms'] if ref['p95_ms'] else float('nan')
+        alerte = ' ⚠️' if ratio_p50 > 1 + seuil else (' ✓' if ratio_p50 < 1 - seuil else '')
+        print(f"{nom:55s} {ref['p50_ms']:10.1f} {mesure['p50_ms']:10.1f} {ratio_p50:7.2f} {ratio_p95:10.2f}{alerte}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark des calculs du dashboard Casemix par scénario")
+    parser.add_argument('--data', default=str(DATA_FILE), help="Fichier Parquet casemix")
+    parser.add_argument('--repeat', type=int, default=5, help="Exécutions mesurées par scénario (défaut : 5)")
+    parser.add_argument('--filtre', help="Ne lancer que les scénarios dont le nom contient ce texte")
+    parser.add_argument('--output', help="Fichier de résultats JSON (défaut : bench_results/bench_<commit>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('AVANT', 'APRES'), help="Compare deux fichiers de résultats")
+    args = parser.parse_args()
+
+    if args.compare:
+        comparer(*args.compare)
+        return
+
+    print("=" * 80)
+    print("BENCHMARK DASHBOARD CASEMIX")
+    print("=" * 80)
+
+    debut = time.perf_counter()
+    engine = CasemixEngine(load_dataset(args.data))
+    chargement_s = time.perf_counter() - debut
+    debut = time.perf_counter()
+    engine.warmup()
+    index_s = time.perf_counter() - debut
+    print(f"📊 {len(engine.df):,} lignes chargées en {chargement_s:.2f}s, index construits en {index_s:.2f}s")
+    # Contrôle de cohérence des projections : la somme doit suivre la tendance agrégée
+    controle = engine.controle_previsions()
+    ecart_max = controle['Ecart_Pct'].abs().max()
+    statut = '✓' if controle['Conforme'].all() else '⚠️ hors tolérance'
+    print(f"🔮 Projections : écart max {ecart_max:.2f}% entre la somme des établissements et la tendance nationale {statut}")
+    print()
+
+    resultats = {}
+    for nom, fonction in lister_scenarios(engine):
+        if args.filtre and args.filtre not in nom:
+            continue
+        resultats[nom] = mesurer(engine, fonction, args.repeat)
+        m = resultats[nom]
+        print(f"  {nom:55s} p50 {m['p50_ms']:8.1f} ms | p95 {m['p95_ms']:8.1f} ms | pic {m['pic_memoire_mb']:7.1f} Mo")
+
+    contexte = contexte_execution(engine, args.data)
+    contexte.update({'chargement_s': chargement_s, 'index_s': index_s})
+    output = Path(args.output) if args.output else RESULTS_DIR / f"bench_{contexte['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({'contexte': contexte, 'scenarios': resultats}, indent=2, ensure_ascii=False), encoding='utf-8')
+    print()
+    print(f"✅ {len(resultats)} scénarios → {output}")
+
+if __name__ == '__main__':
+    main()
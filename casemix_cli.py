@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ligne de commande Casemix - les vues du dashboard sans Streamlit
+Même moteur que le dashboard (casemix_engine), en local ou via le service d'agrégation
+
+Exemples :
+    python casemix_cli.py query --finess 010007300 --years 2023 2024 --view kpis --format json
+    python casemix_cli.py query --view financier --statut Privé --years 2024 --format csv -o ca_prive.csv
+    python casemix_cli.py query --finess 010007300 --view variation --dimension Libracine --base 2022 --cible 2024
+    python casemix_cli.py views
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import pandas as pd
+
+from casemix_engine import (
+    DATA_FILE, TOUS_ETABLISSEMENTS, DIMENSIONS_VARIATION, NIVEAUX_PROFIL, NIVEAUX_MARCHE, NIVEAUX_GEO, GRILLES_TARIF, CasemixEngine, json_default, load_dataset,
+    build_variation_engine, get_variation_table
+)
+
+# Configurer l'encodage de sortie
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+# Alias acceptés pour la sélection nationale
+ALIAS_NATIONAL = {'tous', 'national', 'all', TOUS_ETABLISSEMENTS.lower()}
+
+# ========================================
+# VUES
+# ========================================
+# Chaque vue renvoie un DataFrame, un dict, ou un tuple (DataFrame, dict)
+
+def _exiger(args, *noms):
+    manquants = [f"--{n.replace('_', '-')}" for n in noms if getattr(args, n) is None]
+    if manquants:
+        raise ValueError(f"La vue {args.view} nécessite {', '.join(manquants)}")
+
+def vue_variation(backend, args):
+    pivot = backend.variation_pivot(args.dimension, args.finess, args.years)
+    if args.base is None and args.cible is None:
+        return pivot.reset_index()
+    _exiger(args, 'base', 'cible')
+    return get_variation_table(build_variation_engine(pivot), args.base, args.cible, args.effectif_min)
+
+def vue_comparaison(backend, args):
+    _exiger(args, 'ghm')
+    if args.comparer:
+        finess_list = args.comparer
+    else:
+        finess_list = backend.comparaison_etablissements(args.ghm)['Finess'].head(args.top).tolist()
+    return backend.comparaison(args.ghm, finess_list)
+
+def vue_references(backend, args):
+    _exiger(args, 'ghm')
+    return backend.references(args.ghm, args.departement)
+
+def vue_parts_de_marche(backend, args):
+    _exiger(args, 'activite', 'comparer')
+    return backend.parts_de_marche(args.marche, args.activite, args.comparer)
+
+def lire_regle(texte):
+    """DIMENSION=VALEUR:POURCENTAGE[:Public|Privé] → règle tarifaire"""
+    dimension, separateur, reste = texte.partition('=')
+    morceaux = reste.rsplit(':', 2)
+    grille = None
+    if len(morceaux) == 3 and morceaux[2] in ('Public', 'Privé'):
+        grille = morceaux.pop()
+    else:
+        morceaux = reste.rsplit(':', 1)
+    if not separateur or len(morceaux) != 2:
+        raise ValueError(f"Règle invalide : {texte} (attendu DIMENSION=VALEUR:POURCENTAGE[:Public|Privé])")
+    return {'dimension': dimension, 'valeur': morceaux[0], 'variation_pct': float(morceaux[1]), 'grille': grille}
+
+def vue_simulation(backend, args):
+    return backend.simulation_tarifs([lire_regle(r) for r in args.regle or []], args.annee, args.grille, args.horizon)
+
+def vue_decomposition(backend, args):
+    _exiger(args, 'base', 'cible')
+    return backend.decomposition_ca(args.base, args.cible, args.grille)
+
+def vue_correlation(backend, args):
+    correlation, nb_lignes = backend.correlation(args.finess, args.years)
+    return (correlation.rename_axis('Variable').reset_index() if correlation is not None else None), {'nb_lignes': nb_lignes}
+
+def vue_recherche(backend, args):
+    _exiger(args, 'texte')
+    codes = set(backend.recherche_ghm(args.texte))
+    ghm = backend.ghm_options()
+    return ghm[ghm['Code_GHM'].isin(codes)].reset_index(drop=True)
+
+VUES = {
+    'options': ("Filtres disponibles et volumétrie", lambda b, a: b.options()),
+    'selection': ("Lignes brutes de la sélection", lambda b, a: b.selection(a.finess, a.years)),
+    'kpis': ("KPIs et écarts vs l'année précédente", lambda b, a: b.kpis(a.finess, a.years)),
+    'top': ("Top N libellés par effectif", lambda b, a: b.top_libelles(a.finess, a.years, a.top)),
+    'detail': ("Top N libellés avec DMS, âge, décès pondérés", lambda b, a: b.detail_libelles(a.finess, a.years, a.top)),
+    'evolution': ("Effectif et moyennes pondérées par année", lambda b, a: b.evolution(a.finess, a.years)),
+    'financier': ("Top N GHM par CA estimé (--statut)", lambda b, a: b.financier(a.finess, a.years, a.statut, a.top)),
+    'departements': (
+        "Agrégation par département (--region, --departement, --annee)",
+        lambda b, a: b.departements(None if a.finess == TOUS_ETABLISSEMENTS else a.finess, a.departement, a.annee, a.region)
+    ),
+    'regions': ("Départements et leur région", lambda b, a: b.regions()),
+    'rollup': (
+        "Agrégats établissement/département/région/national (--maille, --region, --departement, --annee, --activite)",
+        lambda b, a: b.rollup(a.maille, a.annee, a.marche if a.activite else None, a.activite, a.region, a.departement)
+    ),
+    'ghm': ("GHM triés par effectif national", lambda b, a: b.ghm_options()),
+    'etablissements-ghm': ("Établissements actifs sur un GHM (--ghm)", lambda b, a: b.comparaison_etablissements(a.ghm)),
+    'comparaison': ("Comparaison d'établissements sur un GHM (--ghm, --comparer)", vue_comparaison),
+    'performance': ("IP-DMS, journées économisables et mortalité standardisée", lambda b, a: b.performance(a.finess, a.years)),
+    'pairs': (
+        "Établissements au casemix le plus proche (--annee, --top, --niveau)",
+        lambda b, a: b.etablissements_similaires(a.finess, a.annee, a.top, a.niveau)
+    ),
+    'concentration': (
+        "HHI par département (--marche, --activite, --annee)",
+        lambda b, a: b.concentration(a.marche, a.annee, a.activite)
+    ),
+    'parts-marche': ("Parts de marché départementales (--marche, --activite, --comparer)", vue_parts_de_marche),
+    'references': ("Références nationales/départementales d'un GHM (--ghm, --departement)", vue_references),
+    'simulation': (
+        "Impact par établissement de règles tarifaires (--regle, --grille, --annee, --horizon)", vue_simulation
+    ),
+    'previsions': ("Effectif observé et projeté (intervalle à 80 %) par année", lambda b, a: b.previsions(a.finess)),
+    'previsions-racines': (
+        "Tendance et projections par racine GHM d'un établissement (--finess)",
+        lambda b, a: b.previsions_racines(a.finess)
+    ),
+    'previsions-controle': (
+        "Somme des projections d'établissements vs tendance du total national", lambda b, a: b.controle_previsions()
+    ),
+    'decomposition': (
+        "Variation de CA par établissement : effets prix, volume, structure (--base, --cible, --grille)", vue_decomposition
+    ),
+    'hierarchie': ("Arbre MCO → CAS → DA → GP → GA → racine → GHM de la sélection", lambda b, a: b.hierarchie_ghm(a.finess, a.years)),
+    'variation': ("Pivot ou variations entre deux années (--dimension, --base, --cible)", vue_variation),
+    'correlation': ("Corrélation pondérée des indicateurs", vue_correlation),
+    'recherche': ("Recherche de GHM par code ou libellé (--texte)", vue_recherche)
+}
+
+# ========================================
+# SORTIE
+# ========================================
+
+def formater(resultat, format_sortie, contexte):
+    """Résultat d'une vue → texte (json, csv ou table)"""
+    data, meta = None, None
+    if isinstance(resultat, pd.DataFrame):
+        data = resultat
+    elif isinstance(resultat, tuple):
+        data, meta = resultat
+    else:
+        meta = resultat
+
+    if format_sortie == 'json':
+        corps = dict(contexte)
+        if meta is not None:
+            corps['meta'] = meta
+        if data is not None:
+            # NaN → null (to_json), puis relu pour une seule sérialisation
+            corps['data'] = json.loads(data.to_json(orient='records', force_ascii=False))
+        return json.dumps(corps, ensure_ascii=False, indent=2, default=json_default)
+
+    resume = meta if data is not None else None
+    if data is None:
+        # Dict seul : une ligne par indicateur scalaire
+        data = pd.DataFrame(
+            [(cle, valeur) for cle, valeur in meta.items() if not isinstance(valeur, (list, dict))],
+            columns=['Indicateur', 'Valeur']
+        )
+    if format_sortie == 'csv':
+        return data.to_csv(index=False)
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 200):
+        texte = data.to_string(index=False)
+    if resume:
+        texte += "\n\n" + "\n".join(f"{cle} : {valeur}" for cle, valeur in resume.items())
+    return texte
+
+# ========================================
+# LANCEMENT
+# ========================================
+
+def creer_backend(args):
+    """Service d'agrégation si une URL est fournie, sinon moteur local sur l'instantané"""
+    if args.service:
+        from casemix_service import ServiceClient
+        return ServiceClient(args.service)
+    return CasemixEngine(load_dataset(args.data))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vues Casemix en ligne de commande (sans Streamlit)")
+    sous_commandes = parser.add_subparsers(dest='commande', required=True)
+
+    query = sous_commandes.add_parser('query', help="Calcule une vue pour une sélection")
+    query.add_argument('--finess', default=TOUS_ETABLISSEMENTS,
+                       help="FINESS de l'établissement (défaut : tous ; alias : national)")
+    query.add_argument('--years', nargs='*', type=int, default=[],
+                       help="Années (défaut : toutes pour un établissement, la plus récente en national)")
+    query.add_argument('--view', required=True, choices=list(VUES), help="Vue à calculer (voir : views)")
+    query.add_argument('--format', default='table', choices=['json', 'csv', 'table'], help="Format de sortie (défaut : table)")
+    query.add_argument('-o', '--output', help="Fichier de sortie (défaut : sortie standard)")
+    query.add_argument('--top', type=int, default=20, help="Nombre de lignes des vues top/detail/financier/comparaison/pairs (défaut : 20)")
+    query.add_argument('--statut', default='Public', choices=['Public', 'Privé'], help="Statut de la vue financier (défaut : Public)")
+    query.add_argument('--departement', help="Nom du département (vues departements, rollup, references)")
+    query.add_argument('--region', help="Nom de la région (vues departements, rollup)")
+    query.add_argument('--maille', default='Region', choices=list(NIVEAUX_GEO), help="Niveau géographique de la vue rollup (défaut : Region)")
+    query.add_argument('--annee', type=int, help="Année unique (vues departements, rollup, pairs, concentration)")
+    query.add_argument('--marche', default='Code_GHM', choices=list(NIVEAUX_MARCHE), help="Niveau d'activité des vues concentration/parts-marche/rollup (défaut : Code_GHM)")
+    query.add_argument('--activite', help="GHM, racine ou DA (vues concentration, parts-marche, rollup)")
+    query.add_argument('--niveau', default='Code_GHM', choices=list(NIVEAUX_PROFIL), help="Profil de la vue pairs (défaut : Code_GHM)")
+    query.add_argument('--regle', action='append', metavar='DIMENSION=VALEUR:PCT[:GRILLE]',
+                       help="Règle tarifaire de la vue simulation, répétable (ex. MCO=Chirurgie:-2, DA=Digestif:1:Privé)")
+    query.add_argument('--horizon', type=int, default=0,
+                       help="Vue simulation : volumes projetés à dernière année + N (1 à 3, défaut : 0 = observés)")
+    query.add_argument('--grille', default='statut', choices=list(GRILLES_TARIF), help="Grille de valorisation des vues simulation et decomposition (défaut : statut)")
+    query.add_argument('--ghm', help="Code GHM (vues etablissements-ghm, comparaison, references)")
+    query.add_argument('--comparer', nargs='+', help="FINESS à comparer (vue parts-marche ; vue comparaison : défaut les --top plus gros sur le GHM)")
+    query.add_argument('--dimension', default='Libelle', choices=list(DIMENSIONS_VARIATION), help="Dimension de la vue variation")
+    query.add_argument('--base', type=int, help="Année de base (vues variation, decomposition)")
+    query.add_argument('--cible', type=int, help="Année cible (vues variation, decomposition)")
+    query.add_argument('--effectif-min', type=int, default=5, help="Effectif minimum l'année de base (défaut : 5)")
+    query.add_argument('--texte', help="Texte recherché (vue recherche)")
+    query.add_argument('--data', default=str(DATA_FILE), help="Fichier Parquet casemix (instantané .arrow utilisé s'il est à jour)")
+    query.add_argument('--service', default=os.environ.get('CASEMIX_SERVICE_URL'),
+                       help="URL du service d'agrégation (défaut : $CASEMIX_SERVICE_URL)")
+
+    sous_commandes.add_parser('views', help="Liste les vues disponibles")
+    args = parser.parse_args(argv)
+
+    if args.commande == 'views':
+        for nom, (description, _) in VUES.items():
+            print(f"{nom:<20} {description}")
+        return 0
+
+    if args.finess.lower() in ALIAS_NATIONAL:
+        args.finess = TOUS_ETABLISSEMENTS
+    args.years = sorted(set(args.years))
+
+    try:
+        resultat = VUES[args.view][1](creer_backend(args), args)
+    except (ValueError, KeyError) as e:
+        print(f"❌ {e}", file=sys.stderr)
+        return 2
+
+    contexte = {'view': args.view, 'finess': args.finess, 'annees': args.years}
+    texte = formater(resultat, args.format, contexte)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(texte)
+        print(f"✅ {args.view} → {args.output}", file=sys.stderr)
+    else:
+        print(texte)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1929 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Moteur d'agrégation Casemix - sans dépendance à Streamlit
+Fonctions pures sur le dataset et moteur possédant les données et leurs index
+(utilisé par le dashboard et par le service d'agrégation)
+"""
+
+import bisect
+import difflib
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+DATA_FILE = Path("data_casemix_2022_2024.parquet")
+# Instantané Arrow IPC non compressé, trié par Finess, lu par memory-map
+SNAPSHOT_FILE = Path("data_casemix_2022_2024.arrow")
+# Numéros et noms des départements (N°, Département)
+DEPARTEMENTS_FILE = Path("departement.csv")
+
+TOUS_ETABLISSEMENTS = "Tous les établissements"
+
+METRIQUES_PONDEREES = ['DMS', 'Age_Moyen', 'Taux_Deces']
+
+VARIABLES_CORRELATION = ['Effectif', 'DMS', 'Age_Moyen', 'Sexe_Ratio', 'Taux_Deces']
+
+DIMENSIONS_VARIATION = {
+    'Libelle': 'Libellé',
+    'Code_GHM': 'Code GHM',
+    'Libracine': 'Racine GHM',
+    'DA': "Domaine d'activité"
+}
+
+# ========================================
+# CHARGEMENT
+# ========================================
+
+def snapshot_path(path):
+    """Chemin de l'instantané Arrow associé à un fichier Parquet"""
+    return Path(path).with_suffix('.arrow')
+
+def write_snapshot(df, path=SNAPSHOT_FILE):
+    """Écrit l'instantané Arrow IPC (non compressé) du dataset, trié par Finess
+
+    Non compressé pour être lu par memory-map sans décompression ; trié pour
+    que le moteur n'ait pas à réordonner (donc copier) les colonnes au chargement.
+    Écriture dans un fichier temporaire puis remplacement atomique : les
+    processus qui ont déjà mappé l'ancien fichier le conservent.
+    """
+    import pyarrow as pa
+
+    ordre = np.argsort(pd.factorize(df['Finess'].astype(str), sort=True)[0], kind='stable')
+    table = pa.Table.from_pandas(df.iloc[ordre], preserve_index=False)
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with pa.OSFile(str(tmp_path), 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    tmp_path.replace(path)
+    return path
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """Lit l'instantané par memory-map : les colonnes pointent vers le page cache
+
+    Les pages du fichier sont partagées entre tous les processus de la machine ;
+    les colonnes numériques sans valeur manquante ne sont pas copiées.
+    """
+    import pyarrow as pa
+
+    source = pa.memory_map(str(path), 'r')
+    table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(split_blocks=True)
+
+def load_dataset(path=DATA_FILE):
+    """Charge le dataset : instantané Arrow s'il est à jour, sinon le Parquet
+
+    Données déjà nettoyées et typées. L'instantané est ignoré s'il est plus
+    ancien que le Parquet (ETL relancé sans le régénérer).
+    """
+    path = Path(path)
+    snapshot = snapshot_path(path)
+    if snapshot.exists() and (not path.exists() or snapshot.stat().st_mtime >= path.stat().st_mtime):
+        return load_snapshot(snapshot)
+    return pd.read_parquet(path)
+
+def json_default(obj):
+    """Scalaires numpy/pandas vers types JSON (json.dumps(..., default=json_default) du service et du CLI)"""
+    if hasattr(obj, 'item'):
+        return obj.item()
+    if pd.isna(obj):
+        return None
+    return str(obj)
+
+# ========================================
+# AGRÉGATIONS PAR CODES ENTIERS
+# ========================================
+
+def compute_bornes(codes):
+    """Bornes (début, fin) de chaque valeur dans une colonne triée : lookup par slice"""
+    codes = np.asarray(codes)
+    if len(codes) == 0:
+        return {}
+    debuts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    fins = np.r_[debuts[1:], len(codes)]
+    return {codes[d]: (d, f) for d, f in zip(debuts, fins)}
+
+def factorize_keys(data, keys):
+    """Code entier par groupe de clés (-1 si une clé manque) et une ligne représentative par groupe"""
+    codes = np.zeros(len(data), dtype='int64')
+    manquant = np.zeros(len(data), dtype=bool)
+    for key in keys:
+        serie = data[key]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            codes_cle, nb_valeurs = serie.cat.codes.to_numpy(dtype='int64'), len(serie.cat.categories)
+        else:
+            codes_cle, valeurs = pd.factorize(serie)
+            nb_valeurs = len(valeurs)
+        manquant |= codes_cle < 0
+        codes = codes * nb_valeurs + codes_cle
+
+    # Renumérotation compacte 0..n-1 (les catégories absentes de la sélection disparaissent)
+    compacts = np.full(len(data), -1, dtype='int64')
+    compacts[~manquant], groupes = pd.factorize(codes[~manquant])
+    representants = np.empty(len(groupes), dtype='int64')
+    representants[compacts[~manquant]] = np.flatnonzero(~manquant)
+    return compacts, representants
+
+def compute_top_k(data, keys, order_col, k=10, sums=(), means=(), weighted_means=(), weight_col='Effectif'):
+    """Top k exact des groupes `keys` selon la somme de `order_col`
+
+    Agrégation linéaire : codes entiers + np.bincount pondéré, sans groupby ni
+    tri complet (seuls les k groupes retenus sont triés). Exact quelle que soit
+    la taille de la sélection.
+    """
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    codes, representants = factorize_keys(data, keys)
+    valides = codes >= 0
+    codes = codes[valides]
+    nb_groupes = len(representants)
+
+    def bincount(col, poids=None):
+        valeurs = data[col].to_numpy(dtype='float64')[valides]
+        presents = ~np.isnan(valeurs)
+        if poids is not None:
+            presents &= ~np.isnan(poids)
+            valeurs = valeurs * poids
+        total = np.bincount(codes[presents], weights=valeurs[presents], minlength=nb_groupes)
+        return total, presents
+
+    colonnes = {}
+    for col in sums:
+        colonnes[col] = bincount(col)[0]
+    for col in means:
+        total, presents = bincount(col)
+        nombre = np.bincount(codes[presents], minlength=nb_groupes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            colonnes[col] = np.where(nombre > 0, total / nombre, np.nan)
+    if weighted_means:
+        poids = data[weight_col].to_numpy(dtype='float64')[valides]
+        for col in weighted_means:
+            total, presents = bincount(col, poids)
+            poids_total = np.bincount(codes[presents], weights=poids[presents], minlength=nb_groupes)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                colonnes[col] = np.where(poids_total > 0, total / poids_total, 0)
+
+    k = min(k, nb_groupes)
+    ordre = colonnes[order_col]
+    top = np.argpartition(-ordre, k - 1)[:k] if k > 0 else np.array([], dtype='int64')
+    top = top[np.argsort(-ordre[top], kind='stable')]
+
+    result = data[keys].iloc[representants[top]].reset_index(drop=True)
+    for col, valeurs in colonnes.items():
+        valeurs = valeurs[top]
+        if col in sums and pd.api.types.is_integer_dtype(data[col]):
+            valeurs = np.rint(valeurs).astype('int64')
+        result[col] = valeurs
+    return result
+
+def compute_kpis(data):
+    """Effectif, GHM distincts et moyennes pondérées (DMS, âge, décès) d'une sélection"""
+    total_effectif = data['Effectif'].sum()
+    kpis = {'effectif': total_effectif, 'nb_ghm': data['Code_GHM'].nunique()}
+    for cle, col in [('dms', 'DMS'), ('age_moyen', 'Age_Moyen'), ('taux_deces', 'Taux_Deces')]:
+        kpis[cle] = (data[col] * data['Effectif']).sum() / total_effectif if total_effectif > 0 else 0
+    return kpis
+
+# ========================================
+# MOTEUR DE VARIATIONS ANNUELLES
+# ========================================
+
+def build_variation_pivot(data, dimension):
+    """Pivot dimension × Annee des effectifs (codes entiers + un seul bincount)"""
+    codes, representants = factorize_keys(data, [dimension])
+    codes_annee, annees = pd.factorize(data['Annee'], sort=True)
+    valides = codes >= 0
+    cellules = codes[valides] * len(annees) + codes_annee[valides]
+    effectif = data['Effectif'].to_numpy(dtype='float64')[valides]
+    matrice = np.bincount(
+        cellules, weights=np.nan_to_num(effectif), minlength=len(representants) * len(annees)
+    ).reshape(len(representants), len(annees))
+
+    pivot = pd.DataFrame(
+        matrice,
+        index=pd.Index(data[dimension].iloc[representants].to_numpy(), name=dimension),
+        columns=pd.Index(annees, name='Annee')
+    )
+    return pivot[~pivot.index.isin(['Non renseigné'])]
+
+def build_variation_engine(pivot):
+    """Variations absolues/relatives, TCAM et rangs pour toutes les paires d'années"""
+    valeurs = pivot.to_numpy(dtype='float64')
+    annees = [int(a) for a in pivot.columns]
+    # Rang 1 = plus gros effectif de l'année
+    rangs = pivot.rank(axis=0, ascending=False, method='min').to_numpy(dtype='int64')
+    # Tenseurs [élément, année de base, année cible]
+    base = valeurs[:, :, None]
+    cible = valeurs[:, None, :]
+    ecart_annees = np.subtract.outer(annees, annees).T.astype('float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variation_pct = np.where(base > 0, (cible - base) / base * 100, np.nan)
+        tcam = np.where(
+            (base > 0) & (ecart_annees > 0),
+            (np.power(cible / base, 1 / ecart_annees) - 1) * 100,
+            np.nan
+        )
+    return {
+        'pivot': pivot,
+        'annees': annees,
+        'variation_abs': cible - base,
+        'variation_pct': variation_pct,
+        'tcam': tcam,
+        'rangs': rangs
+    }
+
+def get_variation_table(engine, annee_base, annee_cible, effectif_min=5):
+    """Table de variations entre deux années (slice du moteur, sans recalcul)"""
+    i = engine['annees'].index(annee_base)
+    j = engine['annees'].index(annee_cible)
+    pivot = engine['pivot']
+    table = pd.DataFrame({
+        pivot.index.name: pivot.index,
+        'Effectif_debut': pivot.iloc[:, i].to_numpy(),
+        'Effectif_fin': pivot.iloc[:, j].to_numpy(),
+        'Variation_abs': engine['variation_abs'][:, i, j],
+        'Variation_pct': engine['variation_pct'][:, i, j],
+        'TCAM': engine['tcam'][:, i, j],
+        'Rang_debut': engine['rangs'][:, i],
+        'Rang_fin': engine['rangs'][:, j],
+        'Gain_rang': engine['rangs'][:, i] - engine['rangs'][:, j]
+    })
+    return table[table['Effectif_debut'] >= effectif_min].reset_index(drop=True)
+
+# ========================================
+# INDEX DE COMPARAISON GHM × ÉTABLISSEMENT × ANNÉE
+# ========================================
+
+def build_ghm_compare_index(df):
+    """Index GHM → établissements (classés par volume) × années, métriques additives"""
+    effectif = df['Effectif'].to_numpy(dtype='float64')
+    facts = pd.DataFrame({
+        'Code_GHM': df['Code_GHM'].astype(str).to_numpy(),
+        'Finess': df['Finess'].astype(str).to_numpy(),
+        'Annee': df['Annee'].to_numpy(),
+        'Effectif': effectif
+    })
+    # Sommes pondérées (Σ valeur × effectif) : additives, la moyenne se déduit au lookup
+    for col in METRIQUES_PONDEREES:
+        facts[f'{col}_x_Eff'] = np.nan_to_num(df[col].to_numpy(dtype='float64')) * effectif
+    facts = facts.groupby(['Code_GHM', 'Finess', 'Annee'], sort=False).sum().reset_index()
+
+    # Classement des établissements par volume au sein de chaque GHM
+    etab_rank = facts.groupby(['Code_GHM', 'Finess'], sort=False)['Effectif'].sum().reset_index()
+    etab_rank = etab_rank.sort_values(['Code_GHM', 'Effectif'], ascending=[True, False], ignore_index=True)
+    etab_rank['Rang'] = etab_rank.groupby('Code_GHM', sort=False).cumcount()
+
+    facts = facts.merge(etab_rank[['Code_GHM', 'Finess', 'Rang']], on=['Code_GHM', 'Finess'])
+    facts = facts.sort_values(['Code_GHM', 'Rang', 'Annee'], ignore_index=True)
+
+    df_libelles = df[['Code_GHM', 'Libelle']].drop_duplicates('Code_GHM')
+    ghm_effectifs = etab_rank.groupby('Code_GHM')['Effectif'].sum().sort_values(ascending=False)
+    ghm_options = ghm_effectifs.rename_axis('Code_GHM').reset_index()
+    ghm_options.insert(1, 'Libelle', ghm_options['Code_GHM'].map(dict(zip(df_libelles['Code_GHM'].astype(str), df_libelles['Libelle']))))
+
+    return {
+        'ghm_options': ghm_options,
+        'etab_rank': etab_rank,
+        'etab_bornes': compute_bornes(etab_rank['Code_GHM']),
+        'facts': facts,
+        'facts_bornes': compute_bornes(facts['Code_GHM'])
+    }
+
+def lookup_ghm_etablissements(index, code_ghm):
+    """Établissements ayant une activité sur le GHM, triés par effectif décroissant"""
+    debut, fin = index['etab_bornes'].get(code_ghm, (0, 0))
+    return index['etab_rank'].iloc[debut:fin][['Finess', 'Effectif']].reset_index(drop=True)
+
+def lookup_ghm_comparaison(index, code_ghm, finess_list):
+    """Effectif et moyennes pondérées par (Finess, Annee) pour un GHM et des établissements"""
+    debut, fin = index['facts_bornes'].get(code_ghm, (0, 0))
+    facts = index['facts'].iloc[debut:fin]
+    facts = facts[facts['Finess'].isin(list(finess_list))]
+
+    result = facts[['Finess', 'Annee', 'Effectif']].reset_index(drop=True)
+    effectif = facts['Effectif'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for col in METRIQUES_PONDEREES:
+            result[col] = np.where(effectif > 0, facts[f'{col}_x_Eff'].to_numpy() / effectif, 0)
+    return result
+
+# ========================================
+# RÉFÉRENCES NATIONALES ET DÉPARTEMENTALES PAR GHM × ANNÉE
+# ========================================
+
+QUANTILES_REFERENCE = {'P10': 0.10, 'P25': 0.25, 'Mediane': 0.50, 'P75': 0.75, 'P90': 0.90}
+
+def compute_group_quantiles(groupes, valeurs, nb_groupes, quantiles):
+    """Quantiles (interpolation linéaire) de `valeurs` au sein de chaque groupe, en un seul tri
+
+    Tri lexicographique (groupe, valeur) puis lecture directe des rangs : pas de
+    boucle sur les groupes. Les NaN sont ignorés (rangés en fin de groupe).
+    """
+    ordre = np.lexsort((valeurs, groupes))
+    tries = valeurs[ordre]
+    debuts = np.concatenate([[0], np.cumsum(np.bincount(groupes, minlength=nb_groupes))[:-1]])
+    nb_valides = np.bincount(groupes[~np.isnan(valeurs)], minlength=nb_groupes)
+    resultats = {}
+    for nom, q in quantiles.items():
+        position = q * np.maximum(nb_valides - 1, 0)
+        bas = np.floor(position).astype('int64')
+        haut = np.minimum(bas + 1, np.maximum(nb_valides - 1, 0))
+        fraction = position - bas
+        # Groupes sans valeur : index 0 factice, masqué ensuite
+        v_bas = tries[np.where(nb_valides > 0, debuts + bas, 0)] if len(tries) else np.zeros(nb_groupes)
+        v_haut = tries[np.where(nb_valides > 0, debuts + haut, 0)] if len(tries) else np.zeros(nb_groupes)
+        resultats[nom] = np.where(nb_valides > 0, v_bas + fraction * (v_haut - v_bas), np.nan)
+    return resultats
+
+def build_ghm_references(facts, finess_departement):
+    """Références par (Code_GHM, Annee) à partir des faits GHM × établissement × année
+
+    National : moyennes pondérées par l'effectif et quantiles P10-P90 des valeurs
+    des établissements. Département : moyennes pondérées par (Code_GHM, Annee,
+    Nom_Departement). Tout est vectorisé sur l'ensemble des établissements.
+    """
+    effectif = facts['Effectif'].to_numpy(dtype='float64')
+    codes, representants = factorize_keys(facts, ['Code_GHM', 'Annee'])
+    nb_groupes = len(representants)
+    actifs = effectif > 0
+
+    national = facts[['Code_GHM', 'Annee']].iloc[representants].reset_index(drop=True)
+    national['Nb_Etablissements'] = np.bincount(codes[actifs], minlength=nb_groupes)
+    effectif_groupe = np.bincount(codes, weights=effectif, minlength=nb_groupes)
+    national['Effectif'] = np.rint(effectif_groupe).astype('int64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for col in METRIQUES_PONDEREES:
+            somme = np.bincount(codes, weights=facts[f'{col}_x_Eff'].to_numpy(), minlength=nb_groupes)
+            national[f'{col}_National'] = np.where(effectif_groupe > 0, somme / effectif_groupe, np.nan)
+            valeurs_etab = np.where(actifs, facts[f'{col}_x_Eff'].to_numpy() / effectif, np.nan)
+            for nom, valeurs in compute_group_quantiles(codes, valeurs_etab, nb_groupes, QUANTILES_REFERENCE).items():
+                national[f'{col}_{nom}'] = valeurs
+    national = national.sort_values(['Code_GHM', 'Annee'], ignore_index=True)
+
+    faits_dept = facts[['Code_GHM', 'Annee', 'Effectif'] + [f'{col}_x_Eff' for col in METRIQUES_PONDEREES]].copy()
+    faits_dept['Nom_Departement'] = facts['Finess'].map(finess_departement)
+    departement = faits_dept.groupby(['Code_GHM', 'Annee', 'Nom_Departement'], sort=False).sum().reset_index()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for col in METRIQUES_PONDEREES:
+            departement[f'{col}_Departement'] = np.where(
+                departement['Effectif'] > 0, departement.pop(f'{col}_x_Eff') / departement['Effectif'], np.nan
+            )
+    departement = departement.rename(columns={'Effectif': 'Effectif_Departement'})
+    departement = departement.sort_values(['Code_GHM', 'Annee'], ignore_index=True)
+
+    return {
+        'national': national,
+        'national_bornes': compute_bornes(national['Code_GHM']),
+        'position': pd.MultiIndex.from_frame(national[['Code_GHM', 'Annee']]),
+        'departement': departement,
+        'departement_bornes': compute_bornes(departement['Code_GHM'])
+    }
+
+def lookup_ghm_references(index, code_ghm, departement=None):
+    """Références d'un GHM par année ; colonnes départementales si un département est donné"""
+    debut, fin = index['national_bornes'].get(code_ghm, (0, 0))
+    result = index['national'].iloc[debut:fin].reset_index(drop=True)
+    if departement is not None:
+        debut, fin = index['departement_bornes'].get(code_ghm, (0, 0))
+        dept = index['departement'].iloc[debut:fin]
+        dept = dept[dept['Nom_Departement'] == departement].drop(columns=['Code_GHM', 'Nom_Departement'])
+        result = result.merge(dept, on='Annee', how='left')
+    return result
+
+def compute_reference_attendue(index, data, cle):
+    """Valeurs nationales attendues par `cle` à case-mix identique
+
+    Chaque ligne de la sélection reçoit la moyenne nationale de son (GHM, année),
+    puis la moyenne est pondérée par l'effectif de la sélection.
+    """
+    position = index['position'].get_indexer(pd.MultiIndex.from_arrays([data['Code_GHM'].astype(str), data['Annee']]))
+    trouve = position >= 0
+    colonnes_ref = {}
+    for col in METRIQUES_PONDEREES:
+        valeurs = np.full(len(data), np.nan)
+        valeurs[trouve] = index['national'][f'{col}_National'].to_numpy()[position[trouve]]
+        colonnes_ref[f'{col}_National'] = valeurs
+    attendu = pd.DataFrame({cle: data[cle].to_numpy(), 'Effectif': data['Effectif'].to_numpy(), **colonnes_ref})
+    result = compute_top_k(
+        attendu, cle, 'Effectif', attendu[cle].nunique(), sums=['Effectif'], weighted_means=list(colonnes_ref)
+    )
+    return result.drop(columns=['Effectif'])
+
+# ========================================
+# INDICES STANDARDISÉS (IP-DMS, MORTALITÉ)
+# ========================================
+# Standardisation indirecte : chaque (GHM, année) d'un établissement est valorisé à la
+# DMS et au taux de décès nationaux du même (GHM, année), puis observé / attendu.
+
+def compute_ratios_performance(table):
+    """IP-DMS et ratio de mortalité standardisé (observé / attendu)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['IP_DMS'] = np.where(table['Journees_Attendues'] > 0, table['Journees_Observees'] / table['Journees_Attendues'], np.nan)
+        table['SMR'] = np.where(table['Deces_Attendus'] > 0, table['Deces_Observes'] / table['Deces_Attendus'], np.nan)
+    return table
+
+def build_performance_index(facts, references):
+    """Journées et décès observés / attendus par (Finess, Annee), sur toute la table de faits"""
+    position = references['position'].get_indexer(pd.MultiIndex.from_arrays([facts['Code_GHM'], facts['Annee']]))
+    national = references['national']
+    effectif = facts['Effectif'].to_numpy(dtype='float64')
+    dms_attendue = national['DMS_National'].to_numpy()[position]
+    deces_attendu = national['Taux_Deces_National'].to_numpy()[position]
+
+    codes, representants = factorize_keys(facts, ['Finess', 'Annee'])
+    nb_groupes = len(representants)
+
+    def somme(valeurs):
+        return np.bincount(codes, weights=np.nan_to_num(valeurs), minlength=nb_groupes)
+
+    table = facts[['Finess', 'Annee']].iloc[representants].reset_index(drop=True)
+    table['Effectif'] = np.rint(somme(effectif)).astype('int64')
+    table['Journees_Observees'] = somme(facts['DMS_x_Eff'].to_numpy())
+    table['Journees_Attendues'] = somme(effectif * dms_attendue)
+    table['Deces_Observes'] = somme(facts['Taux_Deces_x_Eff'].to_numpy()) / 100
+    table['Deces_Attendus'] = somme(effectif * deces_attendu) / 100
+    # Journées potentiellement économisables : excédent de journées de l'établissement sur l'année
+    table['Journees_Economisables'] = np.maximum(table['Journees_Observees'] - table['Journees_Attendues'], 0)
+    table = compute_ratios_performance(table.sort_values(['Finess', 'Annee'], ignore_index=True))
+    return {'table': table, 'bornes': compute_bornes(table['Finess'])}
+
+# ========================================
+# ÉTABLISSEMENTS SIMILAIRES (PROFILS DE CASEMIX)
+# ========================================
+
+NIVEAUX_PROFIL = {'Code_GHM': 'GHM', 'Racine': 'Racine GHM'}
+NB_VOISINS_INDEX = 50  # Voisins conservés par établissement dans l'index
+TAILLE_BLOC_SIMILARITE = 512  # Lignes de la matrice de similarité calculées à la fois
+
+def build_peer_index(facts, annee=None, niveau='Code_GHM'):
+    """Index des plus proches voisins (similarité cosinus des parts d'effectif par GHM ou racine)
+
+    La table de faits ne contient que les cellules non nulles (GHM × établissement) ;
+    la matrice des parts (établissements × GHM, float32) reste petite et le produit
+    de Gram par blocs passe par BLAS. Seuls les NB_VOISINS_INDEX meilleurs voisins
+    de chaque établissement sont conservés.
+    """
+    if annee is not None:
+        facts = facts[facts['Annee'] == annee]
+    codes_profil = facts['Code_GHM'].str[:5] if niveau == 'Racine' else facts['Code_GHM']
+    lignes, finess = pd.factorize(facts['Finess'], sort=True)
+    colonnes, _ = pd.factorize(codes_profil)
+    nb_etab = len(finess)
+
+    nb_colonnes = int(colonnes.max()) + 1 if len(colonnes) else 0
+    matrice = np.bincount(
+        lignes * nb_colonnes + colonnes, weights=facts['Effectif'].to_numpy(dtype='float64'),
+        minlength=nb_etab * nb_colonnes
+    ).reshape(nb_etab, nb_colonnes).astype('float32')
+    totaux = matrice.sum(axis=1)
+    normes = np.linalg.norm(matrice, axis=1)
+    matrice /= np.where(normes > 0, normes, 1)[:, None]
+
+    k = min(NB_VOISINS_INDEX, max(nb_etab - 1, 0))
+    voisins = np.zeros((nb_etab, k), dtype='int32')
+    similarites = np.zeros((nb_etab, k), dtype='float32')
+    for debut in range(0, nb_etab if k > 0 else 0, TAILLE_BLOC_SIMILARITE):
+        fin = min(debut + TAILLE_BLOC_SIMILARITE, nb_etab)
+        bloc = matrice[debut:fin] @ matrice.T
+        bloc[np.arange(fin - debut), np.arange(debut, fin)] = -np.inf  # Pas soi-même
+        top = np.argpartition(-bloc, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(bloc, top, axis=1)
+        ordre = np.argsort(-scores, axis=1, kind='stable')
+        voisins[debut:fin] = np.take_along_axis(top, ordre, axis=1)
+        similarites[debut:fin] = np.take_along_axis(scores, ordre, axis=1)
+
+    return {
+        'finess': np.asarray(finess, dtype=object),
+        'position': {f: i for i, f in enumerate(finess)},
+        'effectif': totaux,
+        'voisins': voisins,
+        'similarites': similarites
+    }
+
+def lookup_peers(index, finess, k=10):
+    """Top k établissements les plus proches (Finess, Similarite, Effectif)"""
+    i = index['position'].get(str(finess))
+    if i is None or index['effectif'][i] == 0:
+        return pd.DataFrame({'Finess': pd.Series(dtype='str'), 'Similarite': pd.Series(dtype='float64'), 'Effectif': pd.Series(dtype='int64')})
+    voisins = index['voisins'][i, :k]
+    similarites = index['similarites'][i, :k].astype('float64')
+    actifs = np.isfinite(similarites) & (index['effectif'][voisins] > 0)
+    return pd.DataFrame({
+        'Finess': index['finess'][voisins[actifs]].astype(str),
+        'Similarite': similarites[actifs],
+        'Effectif': np.rint(index['effectif'][voisins[actifs]]).astype('int64')
+    })
+
+# ========================================
+# PARTS DE MARCHÉ ET CONCENTRATION (HHI)
+# ========================================
+# Marché = (année, département, activité) ; activité = GHM, racine ou domaine d'activité.
+# Seules les cellules non nulles (établissement × activité × année) sont agrégées.
+
+NIVEAUX_MARCHE = {'Code_GHM': 'GHM', 'Racine': 'Racine GHM', 'DA': "Domaine d'activité"}
+
+def colonne_activite(data, niveau):
+    """Activité d'une ligne au niveau demandé (racine = 5 premiers caractères du GHM)"""
+    if niveau == 'Racine':
+        return data['Code_GHM'].astype(str).str[:5]
+    return data[niveau].astype(str)
+
+def rangs_par_groupe(groupes, valeurs):
+    """Ordre (groupe, valeur décroissante) et rang 1..n de chaque élément dans son groupe"""
+    ordre = np.lexsort((-valeurs, groupes))
+    tries = groupes[ordre]
+    debuts = np.flatnonzero(np.r_[True, tries[1:] != tries[:-1]])
+    rangs = np.empty(len(groupes), dtype='int64')
+    rangs[ordre] = np.arange(len(groupes)) - np.repeat(debuts, np.diff(np.r_[debuts, len(groupes)])) + 1
+    return ordre, debuts, rangs
+
+def build_market_index(df, niveau):
+    """Parts de marché départementales, HHI par marché et spécialisation des établissements"""
+    base = pd.DataFrame({
+        'Annee': df['Annee'].to_numpy(),
+        'Nom_Departement': df['Nom_Departement'].to_numpy(),
+        'Activite': colonne_activite(df, niveau).to_numpy(),
+        'Finess': df['Finess'].astype(str).to_numpy(),
+        'Effectif': df['Effectif'].to_numpy(dtype='float64')
+    })
+    base = base[base['Activite'] != 'Non renseigné']
+    numeros = df[['Nom_Departement', 'Departement_Number']].dropna().drop_duplicates('Nom_Departement')
+    numeros = dict(zip(numeros['Nom_Departement'], numeros['Departement_Number']))
+
+    # Cellules établissement × activité × année (un établissement appartient à un seul département)
+    codes, representants = factorize_keys(base, ['Annee', 'Nom_Departement', 'Activite', 'Finess'])
+    valides = codes >= 0
+    cellules = base[['Annee', 'Nom_Departement', 'Activite', 'Finess']].iloc[representants].reset_index(drop=True)
+    cellules['Effectif'] = np.bincount(
+        codes[valides], weights=np.nan_to_num(base['Effectif'].to_numpy()[valides]), minlength=len(representants)
+    )
+    cellules = cellules[cellules['Effectif'] > 0].reset_index(drop=True)
+    effectif = cellules['Effectif'].to_numpy()
+
+    # Marchés : part de chaque établissement, HHI (0-10 000), leader
+    marche, representants = factorize_keys(cellules, ['Annee', 'Nom_Departement', 'Activite'])
+    total_marche = np.bincount(marche, weights=effectif)
+    part = effectif / total_marche[marche]
+    ordre, debuts, rangs = rangs_par_groupe(marche, part)
+    cellules['Part'] = part
+    cellules['Rang'] = rangs
+
+    marches = cellules[['Annee', 'Nom_Departement', 'Activite']].iloc[representants].reset_index(drop=True)
+    marches.insert(1, 'Departement_Number', marches['Nom_Departement'].map(numeros))
+    marches['Effectif'] = total_marche
+    marches['Nb_Etablissements'] = np.bincount(marche)
+    marches['HHI'] = np.bincount(marche, weights=part ** 2) * 10000
+    leaders = ordre[debuts]
+    marches['Finess_Leader'] = cellules['Finess'].to_numpy()[leaders][np.argsort(marche[leaders])]
+    marches['Part_Leader'] = part[leaders][np.argsort(marche[leaders])]
+    cellules['HHI'] = marches['HHI'].to_numpy()[marche]
+    cellules['Nb_Etablissements'] = marches['Nb_Etablissements'].to_numpy()[marche]
+
+    # Spécialisation : quotient de localisation par activité et indice de Krugman
+    # (demi-somme des écarts entre le portefeuille de l'établissement et le mix national, 0 à 1)
+    etab_annee, representants = factorize_keys(cellules, ['Finess', 'Annee'])
+    activite_annee, _ = factorize_keys(cellules, ['Annee', 'Activite'])
+    codes_annee, _ = pd.factorize(cellules['Annee'])
+    part_etab = effectif / np.bincount(etab_annee, weights=effectif)[etab_annee]
+    part_nationale = np.bincount(activite_annee, weights=effectif)[activite_annee] / np.bincount(codes_annee, weights=effectif)[codes_annee]
+    cellules['Quotient_Localisation'] = part_etab / part_nationale
+    specialisation = cellules[['Finess', 'Annee']].iloc[representants].reset_index(drop=True)
+    specialisation['Nb_Activites'] = np.bincount(etab_annee)
+    specialisation['Indice_Specialisation'] = 0.5 * (
+        np.bincount(etab_annee, weights=np.abs(part_etab - part_nationale)) + 1 - np.bincount(etab_annee, weights=part_nationale)
+    )
+
+    # Concentration moyenne par département (HHI des marchés pondéré par leur effectif)
+    marches['HHI_x_Eff'] = marches['HHI'] * marches['Effectif']
+    departements = marches.groupby(['Annee', 'Departement_Number', 'Nom_Departement'], as_index=False, sort=False).agg(
+        Effectif=('Effectif', 'sum'), HHI_x_Eff=('HHI_x_Eff', 'sum'), Nb_Marches=('Activite', 'size')
+    )
+    departements['HHI'] = departements.pop('HHI_x_Eff') / departements['Effectif']
+    nb_etab = cellules[['Annee', 'Nom_Departement', 'Finess']].drop_duplicates().groupby(['Annee', 'Nom_Departement']).size()
+    departements = departements.merge(nb_etab.rename('Nb_Etablissements').reset_index(), on=['Annee', 'Nom_Departement'])
+    marches = marches.drop(columns=['HHI_x_Eff'])
+    for table in (cellules, marches, departements):
+        table['Effectif'] = np.rint(table['Effectif']).astype('int64')
+
+    cellules = cellules.sort_values(['Activite', 'Annee', 'Nom_Departement', 'Rang'], ignore_index=True)
+    marches = marches.sort_values(['Activite', 'Annee'], ignore_index=True)
+    return {
+        'cellules': cellules,
+        'cellules_bornes': compute_bornes(cellules['Activite']),
+        'marches': marches,
+        'marches_bornes': compute_bornes(marches['Activite']),
+        'departements': departements,
+        'specialisation': specialisation.set_index(['Finess', 'Annee'])['Indice_Specialisation'],
+        'activites': marches.groupby('Activite')['Effectif'].sum().sort_values(ascending=False).index.tolist()
+    }
+
+def lookup_concentration(index, annee, activite=None):
+    """HHI par département pour une activité (avec leader), ou moyen toutes activités"""
+    if activite is None:
+        departements = index['departements']
+        return departements[departements['Annee'] == annee].drop(columns=['Annee']).reset_index(drop=True)
+    debut, fin = index['marches_bornes'].get(activite, (0, 0))
+    marches = index['marches'].iloc[debut:fin]
+    return marches[marches['Annee'] == annee].drop(columns=['Annee', 'Activite']).reset_index(drop=True)
+
+def lookup_parts_de_marche(index, activite, finess_list):
+    """Part de marché départementale, rang et HHI d'établissements sur une activité, par année"""
+    debut, fin = index['cellules_bornes'].get(activite, (0, 0))
+    cellules = index['cellules'].iloc[debut:fin]
+    cellules = cellules[cellules['Finess'].isin(list(finess_list))].drop(columns=['Activite'])
+    result = cellules.sort_values(['Finess', 'Annee'], ignore_index=True)
+    result['Indice_Specialisation'] = index['specialisation'].reindex(
+        pd.MultiIndex.from_frame(result[['Finess', 'Annee']])
+    ).to_numpy()
+    return result
+
+# ========================================
+# HIÉRARCHIE GÉOGRAPHIQUE : ÉTABLISSEMENT → DÉPARTEMENT → RÉGION → NATIONAL
+# ========================================
+# Agrégats additifs (effectif, sommes pondérées, nb d'établissements) : chaque
+# niveau est la somme du niveau inférieur, les moyennes sont recalculées à la lecture.
+
+REGIONS = {
+    'Auvergne-Rhône-Alpes': ('01', '03', '07', '15', '26', '38', '42', '43', '63', '69', '73', '74'),
+    'Bourgogne-Franche-Comté': ('21', '25', '39', '58', '70', '71', '89', '90'),
+    'Bretagne': ('22', '29', '35', '56'),
+    'Centre-Val de Loire': ('18', '28', '36', '37', '41', '45'),
+    'Corse': ('2A', '2B'),
+    'Grand Est': ('08', '10', '51', '52', '54', '55', '57', '67', '68', '88'),
+    'Hauts-de-France': ('02', '59', '60', '62', '80'),
+    'Île-de-France': ('75', '77', '78', '91', '92', '93', '94', '95'),
+    'Normandie': ('14', '27', '50', '61', '76'),
+    'Nouvelle-Aquitaine': ('16', '17', '19', '23', '24', '33', '40', '47', '64', '79', '86', '87'),
+    'Occitanie': ('09', '11', '12', '30', '31', '32', '34', '46', '48', '65', '66', '81', '82'),
+    'Pays de la Loire': ('44', '49', '53', '72', '85'),
+    "Provence-Alpes-Côte d'Azur": ('04', '05', '06', '13', '83', '84'),
+    'Guadeloupe': ('971',),
+    'Martinique': ('972',),
+    'Guyane': ('973',),
+    'La Réunion': ('974',),
+    'Mayotte': ('976',)
+}
+
+NIVEAUX_GEO = {'Etablissement': 'Établissement', 'Departement': 'Département', 'Region': 'Région', 'National': 'National'}
+CLES_GEO = {
+    'Etablissement': ['Region', 'Departement_Number', 'Nom_Departement', 'Finess'],
+    'Departement': ['Region', 'Departement_Number', 'Nom_Departement'],
+    'Region': ['Region'],
+    'National': []
+}
+
+def load_regions(path=DEPARTEMENTS_FILE):
+    """Départements de departement.csv avec leur région (Departement_Number, Nom_Departement, Region)"""
+    regions = pd.read_csv(path, dtype=str, encoding='utf-8-sig')
+    regions.columns = ['Departement_Number', 'Nom_Departement']
+    region_par_numero = {numero: region for region, numeros in REGIONS.items() for numero in numeros}
+    regions['Region'] = regions['Departement_Number'].map(region_par_numero).fillna('Non renseigné')
+    return regions
+
+def colonnes_rollup():
+    """Colonnes additives : effectif, puis somme pondérée et poids de chaque métrique"""
+    colonnes = ['Effectif']
+    for col in METRIQUES_PONDEREES:
+        colonnes += [f'{col}_x_Eff', f'{col}_Poids']
+    return colonnes
+
+def build_geo_rollups(df, regions, niveau=None):
+    """Agrégats par année (et activité) de l'établissement au national
+
+    Le niveau établissement est agrégé une fois depuis les lignes (codes entiers +
+    bincount) ; département, région et national sont les sommes du niveau inférieur.
+    Un établissement appartient à un seul département : les nb d'établissements
+    s'additionnent aussi.
+    """
+    region_par_numero = dict(zip(regions['Departement_Number'], regions['Region']))
+    numeros = df['Departement_Number'].astype(str).to_numpy()
+    base = pd.DataFrame({
+        'Annee': df['Annee'].to_numpy(),
+        'Region': pd.Series(numeros).map(region_par_numero).fillna('Non renseigné').to_numpy(),
+        'Departement_Number': numeros,
+        'Nom_Departement': df['Nom_Departement'].fillna('Non renseigné').to_numpy(),
+        'Finess': df['Finess'].astype(str).to_numpy()
+    })
+    activite = []
+    if niveau is not None:
+        base['Activite'] = colonne_activite(df, niveau).to_numpy()
+        activite = ['Activite']
+
+    effectif = df['Effectif'].to_numpy(dtype='float64')
+    valeurs = {'Effectif': np.nan_to_num(effectif)}
+    for col in METRIQUES_PONDEREES:
+        presents = ~np.isnan(df[col].to_numpy(dtype='float64')) & ~np.isnan(effectif)
+        valeurs[f'{col}_x_Eff'] = np.where(presents, df[col].to_numpy(dtype='float64') * effectif, 0)
+        valeurs[f'{col}_Poids'] = np.where(presents, effectif, 0)
+
+    cles = activite + ['Annee'] + CLES_GEO['Etablissement']
+    codes, representants = factorize_keys(base, cles)
+    valides = codes >= 0
+    etablissements = base[cles].iloc[representants].reset_index(drop=True)
+    for col, poids in valeurs.items():
+        etablissements[col] = np.bincount(codes[valides], weights=poids[valides], minlength=len(representants))
+    if niveau is not None:
+        etablissements = etablissements[etablissements['Activite'] != 'Non renseigné']
+    etablissements['Nb_Etablissements'] = 1
+
+    rollups = {'Etablissement': etablissements}
+    for niveau_geo, inferieur in (('Departement', 'Etablissement'), ('Region', 'Departement'), ('National', 'Region')):
+        cles = activite + ['Annee'] + CLES_GEO[niveau_geo]
+        rollups[niveau_geo] = rollups[inferieur].groupby(cles, as_index=False, sort=False)[
+            colonnes_rollup() + ['Nb_Etablissements']
+        ].sum()
+
+    index = {}
+    for niveau_geo, table in rollups.items():
+        table = table.sort_values(activite + ['Annee'] + CLES_GEO[niveau_geo], ignore_index=True)
+        index[niveau_geo] = table
+        if niveau is not None:
+            index[f'{niveau_geo}_bornes'] = compute_bornes(table['Activite'])
+    return index
+
+def lookup_rollup(index, niveau_geo, annee=None, activite=None, region=None, departement=None):
+    """Effectif, moyennes pondérées et nb d'établissements à un niveau géographique
+
+    Sans année : somme des années ; le nb d'établissements est alors recompté
+    (établissements distincts) depuis le niveau établissement.
+    """
+    def filtrer(niveau):
+        table = index[niveau]
+        if activite is not None:
+            debut, fin = index[f'{niveau}_bornes'].get(activite, (0, 0))
+            table = table.iloc[debut:fin]
+        masque = np.ones(len(table), dtype=bool)
+        if annee is not None:
+            masque &= (table['Annee'] == int(annee)).to_numpy()
+        if region is not None and 'Region' in table.columns:
+            masque &= (table['Region'] == region).to_numpy()
+        if departement is not None and 'Nom_Departement' in table.columns:
+            masque &= (table['Nom_Departement'] == departement).to_numpy()
+        return table[masque]
+
+    # Région ou département filtrés : le national devient le total de la zone
+    niveau_lecture = niveau_geo
+    if niveau_geo == 'National' and (region is not None or departement is not None):
+        niveau_lecture = 'Departement' if departement is not None else 'Region'
+    table = filtrer(niveau_lecture)
+    cles = CLES_GEO[niveau_geo]
+
+    if annee is None or niveau_lecture != niveau_geo:
+        colonnes = colonnes_rollup() + ['Nb_Etablissements']
+        table = table.groupby(cles, as_index=False, sort=False)[colonnes].sum() if cles else table[colonnes].sum().to_frame().T
+        if annee is None and niveau_geo == 'Etablissement':
+            table['Nb_Etablissements'] = 1
+        elif annee is None and cles:
+            nb = filtrer('Etablissement').groupby(cles, sort=False)['Finess'].nunique().rename('Nb_Etablissements')
+            table = table.drop(columns=['Nb_Etablissements']).merge(nb.reset_index(), on=cles)
+        elif annee is None:
+            table['Nb_Etablissements'] = filtrer('Etablissement')['Finess'].nunique()
+
+    result = table[cles].reset_index(drop=True)
+    result['Effectif'] = np.rint(table['Effectif'].to_numpy(dtype='float64')).astype('int64')
+    for col in METRIQUES_PONDEREES:
+        poids = table[f'{col}_Poids'].to_numpy(dtype='float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[col] = np.where(poids > 0, table[f'{col}_x_Eff'].to_numpy(dtype='float64') / poids, 0)
+    result['Nb_Etablissements'] = table['Nb_Etablissements'].to_numpy(dtype='int64')
+    return result.sort_values('Effectif', ascending=False, ignore_index=True)
+
+# ========================================
+# HIÉRARCHIE DE CLASSIFICATION GHM (MCO → GHM)
+# ========================================
+# L'arbre est construit une fois (nœud de chaque GHM à chaque niveau) ; pour une
+# sélection, les sommes par GHM sont reportées sur tous les niveaux par bincount.
+
+NIVEAUX_HIERARCHIE = {
+    'MCO': 'MCO',
+    'CAS': 'Catégorie (CAS)',
+    'DA': "Domaine d'activité",
+    'GP': 'Groupe de planification',
+    'GA': "Groupe d'activité",
+    'Racine': 'Racine',
+    'Code_GHM': 'GHM'
+}
+SEPARATEUR_NOEUD = ' / '
+
+def build_ghm_hierarchy(df):
+    """Nœuds de l'arbre (Noeud, Parent, Niveau, Libelle) et nœud de chaque GHM par niveau"""
+    ghm = df.drop_duplicates('Code_GHM')
+    codes_ghm = ghm['Code_GHM'].astype(str)
+    libelles = {
+        niveau: ghm[niveau].fillna('Non renseigné').astype(str)
+        for niveau in ['MCO', 'CAS', 'DA', 'GP', 'GA']
+    }
+    libelles['Racine'] = codes_ghm.str[:5] + ' - ' + ghm['Libracine'].fillna('Non renseigné').astype(str)
+    libelles['Code_GHM'] = codes_ghm + ' - ' + ghm['Libelle'].fillna('').astype(str)
+
+    noeuds = []
+    ghm_noeuds = np.empty((len(ghm), len(NIVEAUX_HIERARCHIE)), dtype='int64')
+    chemins = None
+    for profondeur, niveau in enumerate(NIVEAUX_HIERARCHIE):
+        parents = chemins
+        chemins = libelles[niveau] if parents is None else parents + SEPARATEUR_NOEUD + libelles[niveau]
+        codes, valeurs = pd.factorize(chemins)
+        representants = np.unique(codes, return_index=True)[1]
+        ghm_noeuds[:, profondeur] = sum(len(n) for n in noeuds) + codes
+        noeuds.append(pd.DataFrame({
+            'Noeud': valeurs,
+            'Parent': '' if parents is None else parents.to_numpy()[representants],
+            'Niveau': niveau,
+            'Libelle': libelles[niveau].to_numpy()[representants]
+        }))
+
+    return {
+        'noeuds': pd.concat(noeuds, ignore_index=True),
+        'ghm_index': pd.Index(codes_ghm),
+        'ghm_noeuds': ghm_noeuds
+    }
+
+def compute_hierarchy_totals(index, data):
+    """Effectif, moyennes pondérées et nb de GHM de la sélection à chaque nœud non vide"""
+    positions = index['ghm_index'].get_indexer(data['Code_GHM'].astype(str))
+    valides = positions >= 0
+    positions = positions[valides]
+    nb_ghm, nb_noeuds = len(index['ghm_index']), len(index['noeuds'])
+
+    effectif = data['Effectif'].to_numpy(dtype='float64')[valides]
+    sommes_ghm = {'Effectif': np.bincount(positions, weights=np.nan_to_num(effectif), minlength=nb_ghm)}
+    for col in METRIQUES_PONDEREES:
+        valeurs = data[col].to_numpy(dtype='float64')[valides]
+        presents = ~np.isnan(valeurs) & ~np.isnan(effectif)
+        sommes_ghm[f'{col}_x_Eff'] = np.bincount(positions[presents], weights=valeurs[presents] * effectif[presents], minlength=nb_ghm)
+        sommes_ghm[f'{col}_Poids'] = np.bincount(positions[presents], weights=effectif[presents], minlength=nb_ghm)
+    sommes_ghm['Nb_GHM'] = (sommes_ghm['Effectif'] > 0).astype('float64')
+
+    # Chaque GHM contribue une fois à chaque niveau : sommes additives de la feuille à la racine
+    noeuds_ghm = index['ghm_noeuds'].ravel(order='F')
+    totaux = {
+        col: np.bincount(noeuds_ghm, weights=np.tile(valeurs, len(NIVEAUX_HIERARCHIE)), minlength=nb_noeuds)
+        for col, valeurs in sommes_ghm.items()
+    }
+
+    result = index['noeuds'].copy()
+    result['Effectif'] = np.rint(totaux['Effectif']).astype('int64')
+    for col in METRIQUES_PONDEREES:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[col] = np.where(totaux[f'{col}_Poids'] > 0, totaux[f'{col}_x_Eff'] / totaux[f'{col}_Poids'], 0)
+    result['Nb_GHM'] = np.rint(totaux['Nb_GHM']).astype('int64')
+    result = result[result['Effectif'] > 0]
+    return result.sort_values(['Parent', 'Effectif'], ascending=[True, False], ignore_index=True)
+
+# ========================================
+# SIMULATION DE CAMPAGNE TARIFAIRE
+# ========================================
+# Revalorisation à volumes constants : CA = effectif × tarif GHS de l'année (tarifs
+# du référentiel GHS déjà portés par chaque ligne) × coefficient des règles.
+
+DIMENSIONS_TARIF = {
+    'Code_GHM': 'GHM',
+    'Racine': 'Racine GHM',
+    'DA': "Domaine d'activité",
+    'CAS': 'Catégorie (CAS)',
+    'MCO': 'Secteur (MCO)'
+}
+GRILLES_TARIF = {
+    'statut': "Grille du statut de l'établissement",
+    'public': 'Tarifs publics pour tous',
+    'prive': 'Tarifs privés pour tous',
+    'inverse': 'Grilles inversées (public ↔ privé)'
+}
+
+def build_tariff_simulator(df):
+    """Faits compacts pour la revalorisation : codes entiers par dimension, tarifs des deux grilles"""
+    codes_finess, finess = pd.factorize(df['Finess'].astype(str))
+    statut = df['Statut_Etablissement'].astype(str).to_numpy()
+    dimensions = {}
+    for dimension in DIMENSIONS_TARIF:
+        codes, valeurs = pd.factorize(colonne_activite(df, dimension))
+        dimensions[dimension] = (codes, pd.Index(valeurs))
+    return {
+        'annee': df['Annee'].to_numpy(),
+        'codes_finess': codes_finess,
+        'finess': np.asarray(finess, dtype=object),
+        'statut_finess': statut[np.unique(codes_finess, return_index=True)[1]],
+        # Statut inconnu : valorisé à la grille publique
+        'prive': statut == 'Privé',
+        'effectif': np.nan_to_num(df['Effectif'].to_numpy(dtype='float64')),
+        'tarif_public': np.nan_to_num(df['Tarif_Public'].to_numpy(dtype='float64')),
+        'tarif_prive': np.nan_to_num(df['Tarif_Prive'].to_numpy(dtype='float64')),
+        'dimensions': dimensions
+    }
+
+def simulate_tariffs(index, regles, annee, grille='statut', ratios_volume=None):
+    """CA actuel et simulé de chaque établissement pour une année
+
+    Chaque règle (dimension, valeur, variation_pct, grille Public/Privé ou None pour
+    les deux) multiplie le tarif des lignes concernées ; les règles qui se
+    recouvrent se cumulent. Tout est vectorisé sur les lignes de l'année.
+    `ratios_volume` (un par ligne) remplace les volumes de l'année par des volumes
+    projetés : l'effet volume (CA projeté aux tarifs actuels - CA actuel) est alors
+    séparé de l'impact des règles, calculé sur les volumes projetés.
+    """
+    masque = index['annee'] == annee
+    prive_actuel = index['prive'][masque]
+    prive_simule = grille_privee(prive_actuel, grille)
+
+    coef_public = np.ones(len(prive_actuel))
+    coef_prive = np.ones(len(prive_actuel))
+    nb_lignes_touchees = np.zeros(len(prive_actuel), dtype=bool)
+    for regle in regles:
+        dimension = regle['dimension']
+        if dimension not in DIMENSIONS_TARIF:
+            raise ValueError(f"Dimension de règle inconnue : {dimension}")
+        codes, valeurs = index['dimensions'][dimension]
+        position = valeurs.get_indexer([str(regle['valeur'])])[0]
+        if position < 0:
+            raise ValueError(f"{DIMENSIONS_TARIF[dimension]} inconnu : {regle['valeur']}")
+        touchees = codes[masque] == position
+        facteur = 1 + float(regle['variation_pct']) / 100
+        if regle.get('grille') in (None, 'Public'):
+            coef_public[touchees] *= facteur
+        if regle.get('grille') in (None, 'Privé'):
+            coef_prive[touchees] *= facteur
+        nb_lignes_touchees |= touchees
+
+    effectif = index['effectif'][masque]
+    tarif_public = index['tarif_public'][masque]
+    tarif_prive = index['tarif_prive'][masque]
+    ca_actuel = effectif * np.where(prive_actuel, tarif_prive, tarif_public)
+    codes_finess = index['codes_finess'][masque]
+    nb_finess = len(index['finess'])
+    actifs = np.bincount(codes_finess, weights=effectif, minlength=nb_finess) > 0
+    ca_projete = ca_actuel
+    if ratios_volume is not None:
+        effectif = effectif * ratios_volume[masque]
+        ca_projete = effectif * np.where(prive_actuel, tarif_prive, tarif_public)
+    ca_simule = effectif * np.where(prive_simule, tarif_prive * coef_prive, tarif_public * coef_public)
+
+    def par_finess(valeurs):
+        return np.bincount(codes_finess, weights=valeurs, minlength=nb_finess)[actifs]
+
+    table = pd.DataFrame({
+        'Finess': index['finess'][actifs],
+        'Statut': index['statut_finess'][actifs],
+        'Effectif': np.rint(par_finess(effectif)).astype('int64'),
+        'CA_Actuel': par_finess(ca_actuel)
+    })
+    if ratios_volume is not None:
+        table['CA_Projete'] = par_finess(ca_projete)
+        table['Effet_Volume'] = table['CA_Projete'] - table['CA_Actuel']
+    table['CA_Simule'] = par_finess(ca_simule)
+    # Impact des règles, à volumes constants (ceux de l'année ou projetés)
+    reference = table['CA_Projete'] if ratios_volume is not None else table['CA_Actuel']
+    table['Impact'] = table['CA_Simule'] - reference
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['Impact_Pct'] = np.where(reference > 0, table['Impact'] / reference * 100, np.nan)
+    table = table.sort_values('Impact', ignore_index=True)
+
+    total_actuel, total_projete, total_simule = float(ca_actuel.sum()), float(ca_projete.sum()), float(ca_simule.sum())
+    synthese = {
+        'annee': int(annee),
+        'grille': grille,
+        'ca_actuel': total_actuel,
+        'ca_simule': total_simule,
+        'impact': total_simule - total_projete,
+        'impact_pct': (total_simule - total_projete) / total_projete * 100 if total_projete > 0 else None,
+        'nb_etablissements': int(actifs.sum()),
+        'nb_etablissements_perdants': int((table['Impact'] < 0).sum()),
+        'nb_etablissements_gagnants': int((table['Impact'] > 0).sum()),
+        'nb_lignes_touchees': int(nb_lignes_touchees.sum())
+    }
+    if ratios_volume is not None:
+        synthese.update({
+            'ca_projete': total_projete,
+            'effet_volume': total_projete - total_actuel,
+            'effet_volume_pct': (total_projete - total_actuel) / total_actuel * 100 if total_actuel > 0 else None
+        })
+    return table, synthese
+
+def grille_privee(prive, grille):
+    """Lignes valorisées au tarif privé selon la grille (statut, public, prive, inverse)"""
+    if grille not in GRILLES_TARIF:
+        raise ValueError(f"Grille inconnue : {grille}")
+    return {
+        'statut': prive,
+        'public': np.zeros_like(prive),
+        'prive': np.ones_like(prive),
+        'inverse': ~prive
+    }[grille]
+
+# ========================================
+# DÉCOMPOSITION PRIX / VOLUME / STRUCTURE DU CA
+# ========================================
+# Chaque année est revalorisée aux tarifs de l'autre (colonnes Tarif_<grille>_<année>)
+# et les effets sont moyennés sur les deux ordres (Laspeyres / Paasche) :
+#   prix      = ½ [(CA_cible - CA_cible au tarif base) + (CA_base au tarif cible - CA_base)]
+#   volume    = (N_cible / N_base - 1) × ½ (CA_base + CA_base au tarif cible)
+#   structure = variation - prix - volume
+# La somme des trois effets est exactement la variation de CA de l'établissement.
+
+def build_tariff_years(df):
+    """Tarif de chaque ligne dans la grille de chaque année du référentiel (NaN si GHM absent)"""
+    annees = sorted(int(c.rsplit('_', 1)[1]) for c in df.columns if c.startswith('Tarif_Public_'))
+    return {
+        (grille, annee): df[f'Tarif_{grille}_{annee}'].to_numpy(dtype='float64')
+        for annee in annees for grille in ('Public', 'Prive') if f'Tarif_{grille}_{annee}' in df.columns
+    }
+
+def decompose_ca(index, tarifs, annee_base, annee_cible, grille='statut'):
+    """Variation de CA de chaque établissement entre deux années : effets prix, volume, structure
+
+    Un GHM sans tarif l'autre année garde son tarif de l'année (pas d'effet prix).
+    """
+    for annee in (annee_base, annee_cible):
+        if ('Public', annee) not in tarifs:
+            raise ValueError(f"Tarifs {annee} absents du référentiel")
+    nb_finess = len(index['finess'])
+    prive = grille_privee(index['prive'], grille)
+
+    def valoriser(annee, annee_tarif):
+        """Effectif et CA des lignes de `annee`, valorisées aux tarifs de `annee_tarif`, par établissement"""
+        masque = index['annee'] == annee
+        tarif_annee = np.where(prive, tarifs[('Prive', annee)], tarifs[('Public', annee)])[masque]
+        tarif = np.where(prive, tarifs[('Prive', annee_tarif)], tarifs[('Public', annee_tarif)])[masque]
+        tarif = np.where(np.isnan(tarif), tarif_annee, tarif)
+        codes = index['codes_finess'][masque]
+        effectif = index['effectif'][masque]
+        return (
+            np.bincount(codes, weights=effectif, minlength=nb_finess),
+            np.bincount(codes, weights=effectif * np.nan_to_num(tarif), minlength=nb_finess)
+        )
+
+    effectif_base, ca_base = valoriser(annee_base, annee_base)
+    _, ca_base_tarif_cible = valoriser(annee_base, annee_cible)
+    effectif_cible, ca_cible = valoriser(annee_cible, annee_cible)
+    _, ca_cible_tarif_base = valoriser(annee_cible, annee_base)
+
+    actifs = (effectif_base > 0) | (effectif_cible > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio_volume = np.where(effectif_base > 0, effectif_cible / effectif_base - 1, 0)
+    variation = ca_cible - ca_base
+    effet_prix = 0.5 * ((ca_cible - ca_cible_tarif_base) + (ca_base_tarif_cible - ca_base))
+    # Établissement absent l'année de base : toute la variation hors prix est du volume
+    effet_volume = np.where(
+        effectif_base > 0, ratio_volume * 0.5 * (ca_base + ca_base_tarif_cible), variation - effet_prix
+    )
+    effet_structure = variation - effet_prix - effet_volume
+
+    table = pd.DataFrame({
+        'Finess': index['finess'][actifs],
+        'Statut': index['statut_finess'][actifs],
+        'Effectif_Base': np.rint(effectif_base[actifs]).astype('int64'),
+        'Effectif_Cible': np.rint(effectif_cible[actifs]).astype('int64'),
+        'CA_Base': ca_base[actifs],
+        'CA_Cible': ca_cible[actifs],
+        'Variation': variation[actifs],
+        'Effet_Prix': effet_prix[actifs],
+        'Effet_Volume': effet_volume[actifs],
+        'Effet_Structure': effet_structure[actifs]
+    })
+    with np.errstate(divide='ignore', invalid='ignore'):
+        table['Variation_Pct'] = np.where(table['CA_Base'] > 0, table['Variation'] / table['CA_Base'] * 100, np.nan)
+    table = table.sort_values('Variation', ascending=False, ignore_index=True)
+
+    synthese = {'annee_base': int(annee_base), 'annee_cible': int(annee_cible), 'grille': grille}
+    for col in ['CA_Base', 'CA_Cible', 'Variation', 'Effet_Prix', 'Effet_Volume', 'Effet_Structure']:
+        synthese[col.lower()] = float(table[col].sum())
+    synthese['nb_etablissements'] = len(table)
+    return table, synthese
+
+# ========================================
+# PROJECTIONS D'ACTIVITÉ PAR ÉTABLISSEMENT × RACINE
+# ========================================
+# Modèle en deux parties de chaque série (Finess, racine) : probabilité d'activité
+# (part pondérée des années déclarées où la racine est présente) et tendance
+# log-linéaire pondérée (années récentes plus lourdes) des années actives. La
+# pente est rapprochée de la tendance de référence de la racine d'autant plus que
+# la série est petite (crédibilité N / (N + K)), bornée puis amortie à chaque
+# année projetée pour ne pas extrapoler un saut ponctuel. Les années où
+# l'établissement n'a rien déclaré sont ignorées, pas comptées comme des zéros.
+# Les projections sont des espérances (correction de retransformation
+# exp(σ²/2)) ; celles des racines sont calées sur la projection du total de
+# l'établissement, ajusté par le même modèle. Toutes les séries sont ajustées
+# ensemble sur une matrice série × année.
+
+HORIZON_PREVISION = 3  # Années projetées après la dernière année observée
+POIDS_RECENCE = 0.7  # Poids d'une année relativement à la suivante
+CREDIBILITE_PREVISION = 30  # Séjours annuels pour lesquels la pente propre pèse 50 %
+NIVEAU_INTERVALLE = 0.8  # Intervalle de prévision à 80 % (P10-P90)
+QUANTILE_INTERVALLE = NormalDist().inv_cdf(0.5 + NIVEAU_INTERVALLE / 2)
+VARIANCE_MIN_PREVISION = 0.01  # Plancher de variance résiduelle (échelle log)
+PENTE_MAX_PREVISION = np.log(1.5)  # Croissance annuelle retenue au plus de ×1,5 (÷1,5 en baisse)
+AMORTISSEMENT_PREVISION = 0.8  # Part de la pente conservée d'une année projetée à la suivante
+ECART_MAX_CONTROLE = 0.05  # Écart toléré entre la somme des projections et la tendance nationale
+
+def fit_weighted_trends(z, poids):
+    """Pentes et centres de régressions pondérées z ~ a + b·t, une par ligne (t = 0..n-1)"""
+    t = np.arange(z.shape[1], dtype='float64')
+    somme = poids.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_moyen = (poids * t).sum(axis=1) / somme
+        z_moyen = (poids * z).sum(axis=1) / somme
+        ecart_t = t - t_moyen[:, None]
+        stt = (poids * ecart_t ** 2).sum(axis=1)
+        pente = np.where(stt > 0, (poids * ecart_t * (z - z_moyen[:, None])).sum(axis=1) / stt, np.nan)
+    return pente, t_moyen, z_moyen, stt
+
+def mixture_quantiles(z, ecart, activite, niveau):
+    """Quantile `niveau` d'un mélange : 0 avec probabilité 1 - activite, log-normale(z, ecart) sinon"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = np.where(activite > 0, (niveau - (1 - activite)) / activite, 0)
+    positif = u > 0
+    # Peu de probabilités distinctes (rapports de sommes de poids de récence) : inversion par valeur unique
+    uniques, inverse = np.unique(np.clip(u[positif], 1e-9, 1 - 1e-9), return_inverse=True)
+    loi = NormalDist()
+    quantiles = np.zeros(u.shape)
+    quantiles[positif] = np.exp(z[positif] + ecart[positif] * np.array([loi.inv_cdf(x) for x in uniques])[inverse])
+    return quantiles
+
+def fit_activity_trends(effectif, valide, groupe, nb_groupes, horizon):
+    """Ajustement en bloc du modèle en deux parties sur une matrice lignes × années
+
+    `valide` marque les années déclarées de chaque ligne ; la tendance de référence
+    d'un groupe est la moyenne des pentes propres de ses lignes pondérée par leur
+    volume. Retourne les paramètres par ligne et l'espérance, la variance et les
+    bornes projetées (lignes × horizon).
+    """
+    nb_annees = effectif.shape[1]
+    t = np.arange(nb_annees, dtype='float64')
+    recence = POIDS_RECENCE ** (nb_annees - 1 - t)
+    actif = valide & (effectif > 0)
+    poids = actif * recence
+    poids_valide = (valide * recence).sum(axis=1)
+    activite = np.divide(poids.sum(axis=1), poids_valide, out=np.zeros(len(effectif)), where=poids_valide > 0)
+
+    pente, t_moyen, z_moyen, stt = fit_weighted_trends(np.log(np.where(actif, effectif, 1)), poids)
+    t_moyen, z_moyen = np.nan_to_num(t_moyen), np.nan_to_num(z_moyen)
+    avec_pente = stt > 0
+    pente_propre = np.clip(np.nan_to_num(pente), -PENTE_MAX_PREVISION, PENTE_MAX_PREVISION)
+
+    nb_actif = actif.sum(axis=1)
+    volume_moyen = np.divide((effectif * actif).sum(axis=1), nb_actif, out=np.zeros(len(effectif)), where=nb_actif > 0)
+    somme_pentes = np.bincount(groupe, weights=volume_moyen * pente_propre * avec_pente, minlength=nb_groupes)
+    somme_volumes = np.bincount(groupe, weights=volume_moyen * avec_pente, minlength=nb_groupes)
+    reference = np.divide(somme_pentes, somme_volumes, out=np.zeros(nb_groupes), where=somme_volumes > 0)[groupe]
+    credibilite = np.where(avec_pente, volume_moyen / (volume_moyen + CREDIBILITE_PREVISION), 0)
+    pente_retenue = np.clip(
+        credibilite * pente_propre + (1 - credibilite) * reference, -PENTE_MAX_PREVISION, PENTE_MAX_PREVISION
+    )
+    constante = z_moyen - pente_retenue * t_moyen
+
+    # Variance résiduelle mise en commun par groupe, sur les lignes d'au moins 2 années actives
+    z = np.log(np.where(actif, effectif, 1))
+    residus = (poids * (z - constante[:, None] - pente_retenue[:, None] * t) ** 2).sum(axis=1)
+    plusieurs = nb_actif >= 2
+    degres = np.where(plusieurs, poids.sum(axis=1) * (nb_actif - 1) / np.maximum(nb_actif, 1), 0)
+    somme_residus = np.bincount(groupe, weights=np.where(plusieurs, residus, 0), minlength=nb_groupes)
+    somme_degres = np.bincount(groupe, weights=degres, minlength=nb_groupes)
+    variance = np.divide(somme_residus, somme_degres, out=np.zeros(nb_groupes), where=somme_degres > 0)[groupe]
+
+    # Distance effective à la dernière année observée : 1, 1 + φ, 1 + φ + φ², ...
+    pas = nb_annees - 1 + np.cumsum(AMORTISSEMENT_PREVISION ** np.arange(horizon))
+    z_prevu = constante[:, None] + pente_retenue[:, None] * pas
+    effet_pente = np.divide(credibilite, stt, out=np.zeros(len(effectif)), where=avec_pente)
+    # Variance de prévision (échelle log) : résiduelle, plus l'incertitude sur le niveau et la pente
+    variance_log = np.maximum(variance, VARIANCE_MIN_PREVISION)[:, None] * (
+        1 + 1 / np.maximum(nb_actif, 1)[:, None] + effet_pente[:, None] * (pas - t_moyen[:, None]) ** 2
+    )
+    # Espérance du mélange (0 ou log-normale) : correction de retransformation par la seule
+    # variance résiduelle, celle des paramètres d'une série de 2 ou 3 points étant trop instable
+    niveau = np.exp(z_prevu + variance[:, None] / 2)
+    probabilite = activite[:, None] * np.ones(horizon)
+    esperance = probabilite * niveau
+    ecart = np.sqrt(variance_log)
+    return {
+        'pente': pente,
+        'pente_retenue': pente_retenue,
+        'reference': reference,
+        'credibilite': credibilite,
+        'activite': activite,
+        'esperance': esperance,
+        'variance': probabilite * niveau ** 2 * np.exp(variance_log) - esperance ** 2,
+        'borne_basse': mixture_quantiles(z_prevu, ecart, probabilite, 0.5 - NIVEAU_INTERVALLE / 2),
+        'borne_haute': mixture_quantiles(z_prevu, ecart, probabilite, 0.5 + NIVEAU_INTERVALLE / 2)
+    }
+
+def build_forecasts(index, horizon=HORIZON_PREVISION):
+    """Projections des séries (Finess, racine) et des établissements sur `horizon` années, intervalle à 80 %"""
+    annees = np.unique(index['annee'])
+    nb_annees = len(annees)
+    annees_prevues = annees[-1] + np.arange(1, horizon + 1)
+    rang_annee = np.searchsorted(annees, index['annee'])
+    codes_finess = index['codes_finess']
+    nb_finess = len(index['finess'])
+    codes_racine, racines = index['dimensions']['Racine']
+    racines = np.asarray(racines)
+    series, cles = pd.factorize(codes_finess * len(racines) + codes_racine)
+    nb_series = len(cles)
+    finess_serie = cles // len(racines)
+    racine_serie = cles % len(racines)
+
+    # Matrices établissement × année et série × année ; une année sans aucune ligne
+    # de l'établissement n'est pas déclarée, une racine absente une année déclarée vaut 0
+    cellule_finess = codes_finess * nb_annees + rang_annee
+    declare = np.bincount(cellule_finess, minlength=nb_finess * nb_annees).reshape(nb_finess, nb_annees) > 0
+    effectif_finess = np.bincount(
+        cellule_finess, weights=index['effectif'], minlength=nb_finess * nb_annees
+    ).reshape(nb_finess, nb_annees)
+    effectif = np.bincount(
+        series * nb_annees + rang_annee, weights=index['effectif'], minlength=nb_series * nb_annees
+    ).reshape(nb_series, nb_annees)
+    # Avant la première activité de la racine, l'établissement ne la pratiquait pas
+    valide = declare[finess_serie] & (np.cumsum(effectif > 0, axis=1) > 0)
+
+    modele_series = fit_activity_trends(effectif, valide, racine_serie, len(racines), horizon)
+    modele_finess = fit_activity_trends(
+        effectif_finess, declare, np.zeros(nb_finess, dtype='int64'), 1, horizon
+    )
+
+    # Calage des racines sur le total de l'établissement (même facteur pour l'espérance et les bornes)
+    somme_series = np.zeros((nb_finess, horizon))
+    np.add.at(somme_series, finess_serie, modele_series['esperance'])
+    calage = np.divide(
+        modele_finess['esperance'], somme_series, out=np.ones_like(somme_series), where=somme_series > 0
+    )[finess_serie]
+    esperance = modele_series['esperance'] * calage
+
+    finess = index['finess'][finess_serie]
+    previsions = pd.DataFrame({
+        'Finess': np.repeat(finess, horizon),
+        'Racine': np.repeat(racines[racine_serie], horizon),
+        'Annee': np.tile(annees_prevues, nb_series),
+        'Effectif_Prevu': esperance.ravel(),
+        'Borne_Basse': (modele_series['borne_basse'] * calage).ravel(),
+        'Borne_Haute': (modele_series['borne_haute'] * calage).ravel()
+    })
+    series_table = pd.DataFrame({
+        'Finess': finess,
+        'Racine': racines[racine_serie],
+        'Effectif_Dernier': effectif[:, -1],
+        'Probabilite_Activite': modele_series['activite'],
+        'Tendance_Pct': np.expm1(modele_series['pente_retenue']) * 100,
+        'Tendance_Propre_Pct': np.expm1(modele_series['pente']) * 100,  # NaN pour moins de 2 années actives
+        'Tendance_Nationale_Pct': np.expm1(modele_series['reference']) * 100,
+        'Credibilite': modele_series['credibilite']
+    })
+    observes = pd.DataFrame({
+        'Finess': np.repeat(finess, nb_annees),
+        'Racine': np.repeat(racines[racine_serie], nb_annees),
+        'Annee': np.tile(annees, nb_series),
+        'Effectif': effectif.ravel()
+    })
+    observes = observes[observes['Effectif'] > 0]
+    etablissements = pd.DataFrame({
+        'Finess': np.repeat(index['finess'], horizon),
+        'Annee': np.tile(annees_prevues, nb_finess),
+        'Effectif_Prevu': modele_finess['esperance'].ravel(),
+        'Borne_Basse': modele_finess['borne_basse'].ravel(),
+        'Borne_Haute': modele_finess['borne_haute'].ravel(),
+        'Variance': modele_finess['variance'].ravel()
+    })
+
+    ordre = np.argsort(finess, kind='stable')
+    series_table = series_table.iloc[ordre].reset_index(drop=True)
+    previsions = previsions.iloc[(ordre[:, None] * horizon + np.arange(horizon)).ravel()].reset_index(drop=True)
+    observes = observes.sort_values('Finess', kind='stable', ignore_index=True)
+    etablissements = etablissements.sort_values('Finess', kind='stable', ignore_index=True)
+    # Simulateur : seules les racines actives la dernière année ont des lignes à valoriser,
+    # leurs volumes sont calés sur le total projeté de l'établissement
+    dernier = effectif[:, -1:]
+    somme_actives = np.zeros((nb_finess, horizon))
+    np.add.at(somme_actives, finess_serie, esperance * (dernier > 0))
+    calage_lignes = np.divide(
+        modele_finess['esperance'], somme_actives, out=np.ones_like(somme_actives), where=somme_actives > 0
+    )[finess_serie]
+    ratios = np.divide(esperance * calage_lignes, dernier, out=np.ones_like(esperance), where=dernier > 0)
+    return {
+        'annee_base': int(annees[-1]),
+        'series': series_table,
+        'series_bornes': compute_bornes(series_table['Finess']),
+        'previsions': previsions,
+        'previsions_bornes': compute_bornes(previsions['Finess']),
+        'etablissements': etablissements,
+        'etablissements_bornes': compute_bornes(etablissements['Finess']),
+        'observes': observes,
+        'observes_bornes': compute_bornes(observes['Finess']),
+        # Ratio volume projeté / volume de la dernière année, par ligne du simulateur et horizon
+        'ratios_lignes': ratios[series],
+        'controle': check_forecast_totals(effectif_finess, declare, annees_prevues, modele_finess['esperance'])
+    }
+
+def check_forecast_totals(effectif_finess, declare, annees_prevues, esperance_finess):
+    """Somme des projections d'établissements face à la tendance du total national
+
+    Le total national est ajusté par le même modèle, à périmètre constant : les
+    évolutions annuelles ne portent que sur les établissements qui ont déclaré les
+    deux années, chaînées jusqu'au total de la dernière année. Seuls les
+    établissements déclarés la dernière année entrent dans la somme comparée.
+    """
+    communs = declare[:, 1:] & declare[:, :-1]
+    avant = (effectif_finess[:, :-1] * communs).sum(axis=0)
+    apres = (effectif_finess[:, 1:] * communs).sum(axis=0)
+    evolution = np.divide(apres, avant, out=np.ones(len(avant)), where=avant > 0)
+    total = effectif_finess[:, -1].sum() / np.concatenate([np.cumprod(evolution[::-1])[::-1], [1]])
+    modele = fit_activity_trends(
+        total[None, :], np.ones((1, len(total)), dtype=bool), np.zeros(1, dtype='int64'), 1, len(annees_prevues)
+    )
+    tendance = modele['esperance'][0]
+    somme = esperance_finess[declare[:, -1]].sum(axis=0)
+    ecart = somme / tendance - 1
+    return pd.DataFrame({
+        'Annee': annees_prevues,
+        'Somme_Etablissements': somme,
+        'Tendance_Nationale': tendance,
+        'Ecart_Pct': ecart * 100,
+        'Conforme': np.abs(ecart) <= ECART_MAX_CONTROLE
+    })
+
+def lookup_forecasts(index, finess=None):
+    """Effectif observé puis projeté par année (établissement ou somme nationale) avec intervalle à 80 %"""
+    def tranche(nom):
+        table = index[nom]
+        if finess is None:
+            return table
+        debut, fin = index[f'{nom}_bornes'].get(str(finess), (0, 0))
+        return table.iloc[debut:fin]
+
+    observes = tranche('observes').groupby('Annee', as_index=False)['Effectif'].sum()
+    observes['Borne_Basse'] = observes['Borne_Haute'] = observes['Effectif']
+    observes['Type'] = 'Observé'
+    prevus = tranche('etablissements')
+    if finess is None:
+        # Somme d'établissements indépendants : espérances et variances additives, approximation normale
+        prevus = prevus.groupby('Annee', as_index=False)[['Effectif_Prevu', 'Variance']].sum()
+        ecart = QUANTILE_INTERVALLE * np.sqrt(prevus['Variance'])
+        prevus = prevus.assign(
+            Borne_Basse=np.maximum(prevus['Effectif_Prevu'] - ecart, 0), Borne_Haute=prevus['Effectif_Prevu'] + ecart
+        )
+    prevus = pd.DataFrame({
+        'Annee': prevus['Annee'].to_numpy(),
+        'Effectif': prevus['Effectif_Prevu'].to_numpy(),
+        'Borne_Basse': prevus['Borne_Basse'].to_numpy(),
+        'Borne_Haute': prevus['Borne_Haute'].to_numpy(),
+        'Type': 'Projeté'
+    })
+    return pd.concat([observes, prevus], ignore_index=True)
+
+def lookup_forecast_detail(index, finess):
+    """Tendance et projections de chaque racine d'un établissement (une colonne par année projetée)"""
+    debut, fin = index['series_bornes'].get(str(finess), (0, 0))
+    series = index['series'].iloc[debut:fin].drop(columns=['Finess']).reset_index(drop=True)
+    debut, fin = index['previsions_bornes'].get(str(finess), (0, 0))
+    prevus = index['previsions'].iloc[debut:fin].pivot(index='Racine', columns='Annee', values='Effectif_Prevu')
+    prevus.columns = [f'Prevu_{annee}' for annee in prevus.columns]
+    return series.merge(prevus.reset_index(), on='Racine').sort_values('Effectif_Dernier', ascending=False, ignore_index=True)
+
+# ========================================
+# MOMENTS PONDÉRÉS POUR LA CORRÉLATION
+# ========================================
+
+def build_correlation_moments(df):
+    """Statistiques suffisantes par (Finess, Annee), pondérées par l'effectif
+
+    Par partition : nombre de lignes complètes, Σw, Σw·x et co-moments centrés
+    Σw·(x-μ)(y-μ). Centrer dans chaque partition évite les pertes de précision
+    de Σw·x·y sur de grands effectifs ; la fusion se fait par la formule de Chan.
+    """
+    complet = df[VARIABLES_CORRELATION].notna().all(axis=1).to_numpy()
+    data = df.loc[complet, ['Finess', 'Annee'] + VARIABLES_CORRELATION]
+    codes, representants = factorize_keys(data, ['Finess', 'Annee'])
+    nb_partitions = len(representants)
+
+    w = data['Effectif'].to_numpy(dtype='float64')
+    x = data[VARIABLES_CORRELATION].to_numpy(dtype='float64')
+    nb_vars = len(VARIABLES_CORRELATION)
+
+    nb_lignes = np.bincount(codes, minlength=nb_partitions)
+    somme_w = np.bincount(codes, weights=w, minlength=nb_partitions)
+    somme_wx = np.column_stack([np.bincount(codes, weights=w * x[:, i], minlength=nb_partitions) for i in range(nb_vars)])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        moyennes = np.where(somme_w[:, None] > 0, somme_wx / somme_w[:, None], 0)
+    ecarts = x - moyennes[codes]
+    comoments = np.zeros((nb_partitions, nb_vars, nb_vars))
+    for i in range(nb_vars):
+        for j in range(i, nb_vars):
+            comoments[:, i, j] = np.bincount(codes, weights=w * ecarts[:, i] * ecarts[:, j], minlength=nb_partitions)
+            comoments[:, j, i] = comoments[:, i, j]
+
+    return {
+        'finess': data['Finess'].astype(str).to_numpy()[representants],
+        'annee': data['Annee'].to_numpy()[representants],
+        'nb_lignes': nb_lignes,
+        'somme_w': somme_w,
+        'somme_wx': somme_wx,
+        'comoments': comoments
+    }
+
+def merge_correlation_moments(moments, masque):
+    """Matrice de corrélation pondérée des partitions retenues (formule de Chan)"""
+    masque = masque & (moments['somme_w'] > 0)
+    nb_lignes = int(moments['nb_lignes'][masque].sum())
+    somme_w = moments['somme_w'][masque]
+    poids_total = somme_w.sum()
+    if poids_total <= 0:
+        return None, nb_lignes
+
+    # Co-moments intra-partitions + dispersion des moyennes de partitions
+    moyennes = moments['somme_wx'][masque] / somme_w[:, None]
+    moyenne_globale = moments['somme_wx'][masque].sum(axis=0) / poids_total
+    ecarts = moyennes - moyenne_globale
+    comoment = moments['comoments'][masque].sum(axis=0) + np.einsum('p,pi,pj->ij', somme_w, ecarts, ecarts)
+
+    ecart_types = np.sqrt(np.diag(comoment))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlation = comoment / np.outer(ecart_types, ecart_types)
+    return pd.DataFrame(correlation, index=VARIABLES_CORRELATION, columns=VARIABLES_CORRELATION), nb_lignes
+
+# ========================================
+# INDEX DE RECHERCHE GHM / LIBELLÉS
+# ========================================
+
+def normaliser_texte(texte):
+    """Minuscules sans accents ni ligatures (é → e, œ → oe)"""
+    texte = str(texte).lower().replace('œ', 'oe').replace('æ', 'ae')
+    texte = unicodedata.normalize('NFKD', texte)
+    return ''.join(c for c in texte if not unicodedata.combining(c))
+
+def tokeniser(texte):
+    """Découpe un texte normalisé en mots alphanumériques"""
+    return re.findall(r'[a-z0-9]+', normaliser_texte(texte))
+
+MOTIF_CODE_GHM = re.compile(r'\d{2}[a-z]\w*')  # Début de code GHM : CMD puis type (16m, 16m08, 16m082)
+LONGUEUR_SOUS_CHAINE = 3  # À partir de 3 lettres, un mot est aussi cherché à l'intérieur des mots
+
+def build_search_index(df):
+    """Index inversés mot → GHM sur les couples (Code_GHM, Libellé) distincts, codes et libellés séparés"""
+    df_ghm = df[['Code_GHM', 'Libelle']].drop_duplicates('Code_GHM')
+    codes = pd.Index(df_ghm['Code_GHM'].astype(str))
+
+    postings = {'code': {}, 'libelle': {}}
+    for position, (code, libelle) in enumerate(zip(codes, df_ghm['Libelle'])):
+        for champ, texte in (('code', code), ('libelle', libelle)):
+            for token in set(tokeniser(texte)):
+                postings[champ].setdefault(token, []).append(position)
+
+    index = {'codes': codes}
+    for champ, table in postings.items():
+        index[f'postings_{champ}'] = {token: np.array(positions) for token, positions in table.items()}
+        index[f'vocabulaire_{champ}'] = sorted(table)
+    return index
+
+def search_libelle_index(index, recherche):
+    """Positions des GHM dont le code ou le libellé contient tous les mots recherchés
+
+    Règles par mot, indépendantes du contenu du référentiel :
+    - un début de code GHM (16m, 16m08) est cherché en préfixe des codes seulement ;
+    - un nombre doit être un mot entier du libellé (« niveau 1 » ne trouve ni
+      « niveau 2 » ni « 17 ans ») ;
+    - un mot de 1 ou 2 lettres est cherché en début de mot du libellé, un mot plus
+      long n'importe où dans un mot du libellé ;
+    - sans aucun résultat, un mot d'au moins 4 lettres est cherché en approché
+      (faute de frappe).
+    La recherche porte sur ~2 500 entrées, pas sur les lignes.
+    """
+    tokens = tokeniser(recherche)
+    if len(tokens) > 1:
+        # Les mots d'une lettre (l', d'...) n'apportent rien à une recherche multi-mots, les chiffres si
+        tokens = [t for t in tokens if len(t) > 1 or t.isdigit()] or tokens
+
+    def prefixe(vocabulaire, token):
+        return vocabulaire[bisect.bisect_left(vocabulaire, token):bisect.bisect_left(vocabulaire, token + '\uffff')]
+
+    resultat = None
+    for token in tokens:
+        champ = 'code' if MOTIF_CODE_GHM.fullmatch(token) else 'libelle'
+        vocabulaire = index[f'vocabulaire_{champ}']
+        if champ == 'code':
+            candidats = prefixe(vocabulaire, token)
+        elif token.isdigit():
+            candidats = [token] if token in index['postings_libelle'] else []
+        elif len(token) < LONGUEUR_SOUS_CHAINE:
+            candidats = prefixe(vocabulaire, token)
+        else:
+            candidats = [mot for mot in vocabulaire if token in mot]
+            if not candidats and len(token) >= 4:
+                candidats = difflib.get_close_matches(token, vocabulaire, n=5, cutoff=0.8)
+        postings = index[f'postings_{champ}']
+        positions = np.unique(np.concatenate([postings[mot] for mot in candidats])) if candidats else np.array([], dtype=int)
+        resultat = positions if resultat is None else np.intersect1d(resultat, positions)
+    return resultat if resultat is not None else np.array([], dtype=int)
+
+def compute_search_mask(serie_ghm, codes_trouves):
+    """Masque des lignes dont le GHM est trouvé, via les codes catégoriels si disponibles"""
+    if isinstance(serie_ghm.dtype, pd.CategoricalDtype):
+        # Test sur les ~2 500 catégories, puis simple gather par code de ligne
+        trouve = np.append(serie_ghm.cat.categories.astype(str).isin(codes_trouves), False)
+        return trouve[serie_ghm.cat.codes.to_numpy()]
+    return serie_ghm.astype(str).isin(codes_trouves).to_numpy()
+
+# ========================================
+# MOTEUR (DONNÉES + INDEX)
+# ========================================
+
+class CasemixEngine:
+    """Possède le dataset et ses index ; chaque méthode répond à une vue du dashboard
+
+    Les index sont construits à la première demande puis conservés (thread-safe).
+    Les résultats retournés sont partagés : ne pas les modifier en place.
+    """
+
+    NB_SELECTIONS_CACHE = 4
+
+    def __init__(self, df):
+        # Tri par Finess : la sélection d'un établissement devient un slice
+        # (déjà trié si chargé depuis l'instantané : pas de copie des colonnes mappées)
+        codes_finess, _ = pd.factorize(df['Finess'].astype(str), sort=True)
+        if (np.diff(codes_finess) >= 0).all():
+            self.df = df.reset_index(drop=True)
+        else:
+            ordre = np.argsort(codes_finess, kind='stable')
+            self.df = df.iloc[ordre].reset_index(drop=True)
+        self._finess_bornes = compute_bornes(self.df['Finess'].astype(str).to_numpy())
+        self._index = {}
+        # Un verrou par index : la construction de l'un ne bloque ni les autres, ni les sélections
+        self._index_locks = {}
+        self._registre_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._selections = OrderedDict()
+
+    def _get_index(self, nom, builder):
+        """Index construit une seule fois, même en cas d'appels concurrents"""
+        if nom not in self._index:
+            with self._registre_lock:
+                verrou = self._index_locks.setdefault(nom, threading.Lock())
+            with verrou:
+                if nom not in self._index:
+                    self._index[nom] = builder()
+        return self._index[nom]
+
+    def warmup(self):
+        """Construit les index (démarrage à chaud du service)
+
+        Restent paresseux les index de pairs d'une année donnée (`pairs_<niveau>_<annee>`) :
+        seuls ceux de la dernière année et de toutes les années sont construits.
+        """
+        self.options()
+        self._get_index('ghm', lambda: build_ghm_compare_index(self.df))
+        self._performance()
+        for niveau in [None, *NIVEAUX_MARCHE]:
+            self._rollups(niveau)
+        for niveau in NIVEAUX_MARCHE:
+            self._marche(niveau)
+        facts = self._get_index('ghm', lambda: build_ghm_compare_index(self.df))['facts']
+        for niveau in NIVEAUX_PROFIL:
+            for annee in [max(self.options()['annees']), None]:
+                self._get_index(f'pairs_{niveau}_{annee}', lambda: build_peer_index(facts, annee, niveau))
+        for dimension in DIMENSIONS_VARIATION:
+            self._get_index(f'variation_{dimension}', lambda: build_variation_pivot(self.df, dimension))
+        self._previsions()
+        self._get_index('tarifs_annuels', lambda: build_tariff_years(self.df))
+        self._get_index('hierarchie', lambda: build_ghm_hierarchy(self.df))
+        self._get_index('correlation', lambda: build_correlation_moments(self.df))
+        self._get_index('recherche', lambda: build_search_index(self.df))
+
+    def vider_selections(self):
+        """Oublie les sélections récentes (mesures à froid)"""
+        with self._lock:
+            self._selections.clear()
+
+    def selection(self, finess, annees=()):
+        """Lignes d'un établissement (slice) ou de tous, filtrées par années
+
+        Sans année choisie : toutes les années pour un établissement, seulement la
+        plus récente pour l'ensemble national (volume).
+        """
+        if finess == TOUS_ETABLISSEMENTS and not annees:
+            annees = [max(self.options()['annees'])]
+        key = (str(finess), tuple(sorted(int(a) for a in annees)))
+        with self._lock:
+            if key in self._selections:
+                self._selections.move_to_end(key)
+                return self._selections[key]
+
+        if finess == TOUS_ETABLISSEMENTS:
+            data = self.df
+        else:
+            debut, fin = self._finess_bornes.get(str(finess), (0, 0))
+            data = self.df.iloc[debut:fin]
+        if annees:
+            data = data[data['Annee'].isin(list(annees))]
+
+        with self._lock:
+            self._selections[key] = data
+            while len(self._selections) > self.NB_SELECTIONS_CACHE:
+                self._selections.popitem(last=False)
+        return data
+
+    def options(self):
+        """Listes de filtres et volumétrie (calculées une fois)"""
+        def build():
+            df = self.df
+            regions = self.regions()
+            region_par_numero = dict(zip(regions['Departement_Number'], regions['Region']))
+            df_etab = df[['Finess', 'Departement_Number', 'Nom_Departement']].drop_duplicates('Finess') if 'Nom_Departement' in df.columns else pd.DataFrame(columns=['Finess', 'Departement_Number', 'Nom_Departement'])
+            region_etab = df_etab['Departement_Number'].astype(str).map(region_par_numero).fillna('Non renseigné')
+            return {
+                'annees': sorted(int(a) for a in df['Annee'].unique()),
+                'finess': sorted(df['Finess'].astype(str).unique()),
+                'da': ['Tous'] + sorted([x for x in df['DA'].unique() if x != 'Non renseigné']) if 'DA' in df.columns else ['Tous'],
+                'classif': ['Tous'] + sorted([x for x in df['Classif PKCS'].unique() if x != 'Non renseigné']) if 'Classif PKCS' in df.columns else ['Tous'],
+                'departements': sorted(df['Nom_Departement'].dropna().unique().tolist()) if 'Nom_Departement' in df.columns else [],
+                'finess_departement': {
+                    str(f): (None if pd.isna(d) else d) for f, d in zip(df_etab['Finess'], df_etab['Nom_Departement'])
+                },
+                'regions': sorted(region_etab.unique().tolist()),
+                'finess_region': dict(zip(df_etab['Finess'].astype(str), region_etab)),
+                'departements_region': {
+                    region: sorted(groupe.dropna().unique().tolist())
+                    for region, groupe in df_etab['Nom_Departement'].groupby(region_etab.to_numpy())
+                },
+                'lignes_par_annee': {int(a): int(n) for a, n in df['Annee'].value_counts().items()},
+                'nb_lignes': len(df),
+                'nb_etablissements': len(self._finess_bornes)
+            }
+        return self._get_index('options', build)
+
+    def kpis(self, finess, annees):
+        """KPIs de la sélection et écarts bruts vs l'année précédente (None si indisponible)"""
+        kpis = compute_kpis(self.selection(finess, annees))
+        for cle in ['delta_effectif_pct', 'delta_ghm', 'delta_dms', 'delta_age', 'delta_deces']:
+            kpis[cle] = None
+
+        if annees:
+            annee_max = max(annees)
+            data_cur = self.selection(finess, [annee_max])
+            data_prec = self.selection(finess, [annee_max - 1])
+            if len(data_prec) > 0 and len(data_cur) > 0:
+                cur = compute_kpis(data_cur)
+                prec = compute_kpis(data_prec)
+                if prec['effectif'] > 0:
+                    kpis['delta_effectif_pct'] = (cur['effectif'] - prec['effectif']) / prec['effectif'] * 100
+                if prec['dms'] > 0:
+                    kpis['delta_dms'] = cur['dms'] - prec['dms']
+                kpis['delta_age'] = cur['age_moyen'] - prec['age_moyen']
+                kpis['delta_deces'] = cur['taux_deces'] - prec['taux_deces']
+                kpis['delta_ghm'] = cur['nb_ghm'] - prec['nb_ghm']
+        return kpis
+
+    def top_libelles(self, finess, annees, top_n=10):
+        """Top N des libellés par effectif"""
+        return compute_top_k(self.selection(finess, annees), 'Libelle', 'Effectif', top_n, sums=['Effectif'])
+
+    def detail_libelles(self, finess, annees, top_n=20):
+        """Top N des libellés avec moyennes pondérées par l'effectif"""
+        return compute_top_k(
+            self.selection(finess, annees), 'Libelle', 'Effectif', top_n,
+            sums=['Effectif'], weighted_means=METRIQUES_PONDEREES
+        )
+
+    def evolution(self, finess, annees):
+        """Effectif et moyennes pondérées par année"""
+        data = self.selection(finess, annees)
+        result = compute_top_k(data, 'Annee', 'Effectif', data['Annee'].nunique(), sums=['Effectif'], weighted_means=METRIQUES_PONDEREES)
+        return result.sort_values('Annee', ignore_index=True)
+
+    def financier(self, finess, annees, statut, top_n=30):
+        """Top N GHM par CA estimé (Public ou Privé) et KPIs financiers du statut"""
+        suffixe = 'Public' if statut == 'Public' else 'Prive'
+        data = self.selection(finess, annees)
+        if finess == TOUS_ETABLISSEMENTS:
+            data = data[data['Statut_Etablissement'] == statut]
+
+        top = compute_top_k(
+            data, ['Code_GHM', 'Libelle'], f'CA_{suffixe}_Estime', top_n,
+            sums=[f'CA_{suffixe}_Estime', 'Effectif'], means=[f'Tarif_{suffixe}', 'DMS']
+        )
+        kpis = {
+            'nb_lignes': len(data),
+            'ca_total': data[f'CA_{suffixe}_Estime'].sum(),
+            'tarif_moyen': data[f'Tarif_{suffixe}'].mean(),
+            'effectif_total': data['Effectif'].sum(),
+            'nb_ghm': data['Code_GHM'].nunique()
+        }
+        return top, kpis
+
+    def departements(self, finess=None, departement=None, annee=None, region=None):
+        """Agrégation par département (effectif, moyennes pondérées, nb d'établissements)
+
+        Sans établissement : lu dans les agrégats géographiques précalculés.
+        """
+        if finess is None:
+            df_dept = self.rollup('Departement', annee, region=region, departement=departement)
+            national = self.rollup('National', annee, region=region, departement=departement)
+            nb_etablissements = int(national['Nb_Etablissements'].iloc[0]) if len(national) else 0
+            return df_dept.drop(columns=['Region']), {'nb_etablissements': nb_etablissements}
+
+        data = self.selection(finess)
+        masque = np.ones(len(data), dtype=bool)
+        if region is not None:
+            masque &= np.isin(data['Departement_Number'].astype(str).to_numpy(), self._departements_region(region))
+        if departement is not None:
+            masque &= (data['Nom_Departement'] == departement).to_numpy()
+        if annee is not None:
+            masque &= (data['Annee'] == annee).to_numpy()
+        data = data[masque] if not masque.all() else data
+
+        keys = ['Departement_Number', 'Nom_Departement']
+        df_dept = compute_top_k(data, keys, 'Effectif', len(data), sums=['Effectif'], weighted_means=METRIQUES_PONDEREES)
+        nb_etab = data.groupby('Departement_Number', observed=True)['Finess'].nunique()
+        df_dept['Nb_Etablissements'] = df_dept['Departement_Number'].map(nb_etab).fillna(0).astype(int)
+        return df_dept, {'nb_etablissements': int(data['Finess'].nunique())}
+
+    def regions(self):
+        """Départements de departement.csv et leur région"""
+        return self._get_index('regions', load_regions)
+
+    def _departements_region(self, region):
+        regions = self.regions()
+        return regions.loc[regions['Region'] == region, 'Departement_Number'].to_numpy()
+
+    def _rollups(self, niveau=None):
+        if niveau is not None and niveau not in NIVEAUX_MARCHE:
+            raise ValueError(f"Niveau d'activité inconnu : {niveau}")
+        regions = self.regions()
+        return self._get_index(f'rollups_{niveau}', lambda: build_geo_rollups(self.df, regions, niveau))
+
+    def rollup(self, niveau_geo, annee=None, niveau=None, activite=None, region=None, departement=None):
+        """Agrégats précalculés à un niveau géographique (toutes activités, ou une activité du niveau)"""
+        if niveau_geo not in NIVEAUX_GEO:
+            raise ValueError(f"Niveau géographique inconnu : {niveau_geo}")
+        if activite is not None and niveau is None:
+            raise ValueError("Une activité nécessite son niveau (Code_GHM, Racine ou DA)")
+        return lookup_rollup(self._rollups(niveau), niveau_geo, annee, activite, region, departement)
+
+    def ghm_options(self):
+        """GHM triés par effectif national décroissant (Code_GHM, Libelle, Effectif)"""
+        return self._get_index('ghm', lambda: build_ghm_compare_index(self.df))['ghm_options']
+
+    def comparaison_etablissements(self, code_ghm):
+        """Établissements actifs sur un GHM, classés par volume (Finess, Effectif)"""
+        return lookup_ghm_etablissements(self._get_index('ghm', lambda: build_ghm_compare_index(self.df)), code_ghm)
+
+    def comparaison(self, code_ghm, finess_list):
+        """Effectif et moyennes pondérées par établissement et année sur un GHM"""
+        return lookup_ghm_comparaison(self._get_index('ghm', lambda: build_ghm_compare_index(self.df)), code_ghm, finess_list)
+
+    def _references(self):
+        facts = self._get_index('ghm', lambda: build_ghm_compare_index(self.df))['facts']
+        finess_departement = self.options()['finess_departement']
+        return self._get_index('references', lambda: build_ghm_references(facts, finess_departement))
+
+    def references(self, code_ghm, departement=None):
+        """Références nationales (moyennes, P10-P90) et départementales d'un GHM par année"""
+        return lookup_ghm_references(self._references(), code_ghm, departement)
+
+    def references_selection(self, finess, annees, cle='Libelle'):
+        """Moyennes nationales attendues par `cle` au case-mix (GHM × année) de la sélection"""
+        return compute_reference_attendue(self._references(), self.selection(finess, annees), cle)
+
+    def _performance(self):
+        facts = self._get_index('ghm', lambda: build_ghm_compare_index(self.df))['facts']
+        references = self._references()
+        return self._get_index('performance', lambda: build_performance_index(facts, references))
+
+    def performance(self, finess, annees):
+        """IP-DMS et mortalité standardisée par année et sur la période (établissement ou national)
+
+        Période : sommes des journées et décès observés / attendus sur les années
+        choisies ; journées économisables = somme des excédents par établissement et année.
+        """
+        index = self._performance()
+        if finess == TOUS_ETABLISSEMENTS:
+            table = index['table']
+            annees = annees or [max(self.options()['annees'])]
+        else:
+            debut, fin = index['bornes'].get(str(finess), (0, 0))
+            table = index['table'].iloc[debut:fin]
+        if annees:
+            table = table[table['Annee'].isin(list(annees))]
+        if finess == TOUS_ETABLISSEMENTS:
+            # Agrégat national par année : IP-DMS = SMR = 1 par construction, excédents cumulés
+            table = compute_ratios_performance(
+                table.drop(columns=['Finess', 'IP_DMS', 'SMR']).groupby('Annee', as_index=False).sum()
+            )
+
+        totaux = table[['Effectif', 'Journees_Observees', 'Journees_Attendues', 'Deces_Observes', 'Deces_Attendus']].sum()
+        synthese = {
+            'effectif': int(totaux['Effectif']),
+            'journees_observees': float(totaux['Journees_Observees']),
+            'journees_attendues': float(totaux['Journees_Attendues']),
+            'ip_dms': float(totaux['Journees_Observees'] / totaux['Journees_Attendues']) if totaux['Journees_Attendues'] > 0 else None,
+            'journees_economisables': float(table['Journees_Economisables'].sum()),
+            'deces_observes': float(totaux['Deces_Observes']),
+            'deces_attendus': float(totaux['Deces_Attendus']),
+            'smr': float(totaux['Deces_Observes'] / totaux['Deces_Attendus']) if totaux['Deces_Attendus'] > 0 else None
+        }
+        return table.reset_index(drop=True), synthese
+
+    def etablissements_similaires(self, finess, annee=None, k=10, niveau='Code_GHM'):
+        """Top k établissements au casemix le plus proche (une année, ou toutes si annee=None)"""
+        if niveau not in NIVEAUX_PROFIL:
+            raise ValueError(f"Niveau de profil inconnu : {niveau}")
+        facts = self._get_index('ghm', lambda: build_ghm_compare_index(self.df))['facts']
+        annee = None if annee is None else int(annee)
+        index = self._get_index(f'pairs_{niveau}_{annee}', lambda: build_peer_index(facts, annee, niveau))
+        return lookup_peers(index, finess, k)
+
+    def _marche(self, niveau):
+        if niveau not in NIVEAUX_MARCHE:
+            raise ValueError(f"Niveau d'activité inconnu : {niveau}")
+        return self._get_index(f'marche_{niveau}', lambda: build_market_index(self.df, niveau))
+
+    def activites_marche(self, niveau):
+        """Activités du niveau, triées par effectif national décroissant"""
+        return self._marche(niveau)['activites']
+
+    def concentration(self, niveau, annee=None, activite=None):
+        """HHI par département (une activité, ou moyenne pondérée de toutes) ; dernière année par défaut"""
+        annee = int(annee) if annee is not None else max(self.options()['annees'])
+        return lookup_concentration(self._marche(niveau), annee, activite)
+
+    def parts_de_marche(self, niveau, activite, finess_list):
+        """Parts de marché départementales, rang, HHI et spécialisation d'établissements sur une activité"""
+        return lookup_parts_de_marche(self._marche(niveau), activite, finess_list)
+
+    def valeurs_tarif(self, dimension):
+        """Valeurs possibles d'une dimension de règle tarifaire (triées)"""
+        if dimension not in DIMENSIONS_TARIF:
+            raise ValueError(f"Dimension de règle inconnue : {dimension}")
+        index = self._get_index('simulation', lambda: build_tariff_simulator(self.df))
+        return sorted(index['dimensions'][dimension][1].tolist())
+
+    def simulation_tarifs(self, regles, annee=None, grille='statut', horizon=0):
+        """Impact par établissement de règles tarifaires (dernière année par défaut)
+
+        Avec un horizon (1 à HORIZON_PREVISION), le CA simulé porte sur les volumes
+        projetés de la dernière année + horizon, comparé au CA de la dernière année.
+        """
+        index = self._get_index('simulation', lambda: build_tariff_simulator(self.df))
+        ratios_volume = None
+        if horizon:
+            if not 1 <= int(horizon) <= HORIZON_PREVISION:
+                raise ValueError(f"Horizon de projection hors limites : {horizon} (1 à {HORIZON_PREVISION})")
+            previsions = self._previsions()
+            annee = previsions['annee_base']
+            ratios_volume = previsions['ratios_lignes'][:, int(horizon) - 1]
+        annee = int(annee) if annee is not None else max(self.options()['annees'])
+        table, synthese = simulate_tariffs(index, regles, annee, grille, ratios_volume)
+        synthese['annee_volumes'] = annee + int(horizon or 0)
+        return table, synthese
+
+    def _previsions(self):
+        index = self._get_index('simulation', lambda: build_tariff_simulator(self.df))
+        return self._get_index('previsions', lambda: build_forecasts(index))
+
+    def previsions(self, finess):
+        """Effectif observé puis projeté par année (établissement ou national), intervalle à 80 %"""
+        return lookup_forecasts(self._previsions(), None if finess == TOUS_ETABLISSEMENTS else finess)
+
+    def previsions_racines(self, finess):
+        """Tendance retenue, propre et nationale, et projections de chaque racine d'un établissement"""
+        return lookup_forecast_detail(self._previsions(), finess)
+
+    def controle_previsions(self):
+        """Somme des projections d'établissements face à la tendance du total national, par année"""
+        return self._previsions()['controle']
+
+    def decomposition_ca(self, annee_base, annee_cible, grille='statut'):
+        """Variation de CA de chaque établissement entre deux années : effets prix, volume, structure"""
+        index = self._get_index('simulation', lambda: build_tariff_simulator(self.df))
+        tarifs = self._get_index('tarifs_annuels', lambda: build_tariff_years(self.df))
+        return decompose_ca(index, tarifs, int(annee_base), int(annee_cible), grille)
+
+    def hierarchie_ghm(self, finess, annees):
+        """Arbre MCO → GHM de la sélection : un nœud par ligne, sommes additives à chaque niveau"""
+        index = self._get_index('hierarchie', lambda: build_ghm_hierarchy(self.df))
+        return compute_hierarchy_totals(index, self.selection(finess, annees))
+
+    def variation_pivot(self, dimension, finess, annees):
+        """Pivot dimension × Annee ; en vue nationale, précalculé sur toutes les années"""
+        if finess == TOUS_ETABLISSEMENTS:
+            return self._get_index(f'variation_{dimension}', lambda: build_variation_pivot(self.df, dimension))
+        return build_variation_pivot(self.selection(finess, annees), dimension)
+
+    def correlation(self, finess, annees):
+        """Corrélation pondérée de la sélection par fusion des moments précalculés"""
+        moments = self._get_index('correlation', lambda: build_correlation_moments(self.df))
+        masque = np.ones(len(moments['somme_w']), dtype=bool)
+        if finess == TOUS_ETABLISSEMENTS:
+            # Même règle que la sélection : sans année choisie, seule la plus récente
+            annees = annees or [max(self.options()['annees'])]
+        else:
+            masque &= moments['finess'] == str(finess)
+        if annees:
+            masque &= np.isin(moments['annee'], list(annees))
+        return merge_correlation_moments(moments, masque)
+
+    def recherche_ghm(self, texte):
+        """Codes GHM dont le code ou le libellé correspond à la recherche"""
+        index = self._get_index('recherche', lambda: build_search_index(self.df))
+        return index['codes'][search_libelle_index(index, texte)].tolist()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Service d'agrégation Casemix - un processus possède les données, les dashboards l'interrogent
+Réponses au format Arrow IPC (stream) ; écoute en HTTP local ou sur un socket Unix
+
+Lancement :
+    python casemix_service.py --port 8765
+    python casemix_service.py --socket /tmp/casemix.sock
+Puis côté dashboard : CASEMIX_SERVICE_URL=http://127.0.0.1:8765 (ou unix:///tmp/casemix.sock)
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pandas as pd
+import pyarrow as pa
+
+from casemix_engine import DATA_FILE, CasemixEngine, json_default, load_dataset
+
+# Configurer l'encodage de sortie
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+CLE_META = b'casemix_meta'
+
+# Méthodes du moteur exposées : une route POST /<méthode>, paramètres en JSON
+METHODES = [
+    'options', 'selection', 'kpis', 'top_libelles', 'detail_libelles', 'evolution',
+    'financier', 'departements', 'ghm_options', 'comparaison_etablissements',
+    'comparaison', 'variation_pivot', 'correlation', 'recherche_ghm', 'references', 'references_selection',
+    'performance', 'etablissements_similaires', 'activites_marche', 'concentration', 'parts_de_marche',
+    'regions', 'rollup', 'hierarchie_ghm', 'valeurs_tarif', 'simulation_tarifs',
+    'decomposition_ca', 'previsions', 'previsions_racines',
+    'controle_previsions'
+]
+
+# ========================================
+# ENCODAGE ARROW IPC
+# ========================================
+
+def encode_reponse(resultat):
+    """Résultat du moteur → stream Arrow IPC
+
+    Le DataFrame (s'il y en a un) forme la table ; les scalaires et dicts
+    voyagent en JSON dans les métadonnées du schéma.
+    """
+    table_df, meta = None, None
+    if isinstance(resultat, pd.DataFrame):
+        table_df = resultat
+    elif isinstance(resultat, tuple):
+        table_df, meta = resultat
+    else:
+        meta = resultat
+
+    if table_df is None:
+        table = pa.table({})
+    else:
+        # Index nommés (pivots, corrélation) et colonnes non textuelles (années) conservés
+        table_df = table_df.rename(columns=str)
+        table = pa.Table.from_pandas(table_df)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CLE_META] = json.dumps(
+        {'table': table_df is not None, 'meta': meta}, default=json_default
+    ).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+def decode_reponse(buffer):
+    """Stream Arrow IPC → (DataFrame ou None, métadonnées)"""
+    table = pa.ipc.open_stream(buffer).read_all()
+    enveloppe = json.loads(table.schema.metadata[CLE_META])
+    data = table.to_pandas() if enveloppe['table'] else None
+    return data, enveloppe['meta']
+
+# ========================================
+# SERVEUR
+# ========================================
+
+class CasemixRequestHandler(BaseHTTPRequestHandler):
+    """POST /<méthode> avec les paramètres en JSON ; GET /health"""
+
+    engine = None
+
+    def address_string(self):
+        # Socket Unix : pas d'adresse (client_address vide)
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _repondre(self, status, corps, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(corps)))
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def _erreur(self, status, message):
+        self._repondre(status, json.dumps({'erreur': message}).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        if self.path == '/health':
+            options = self.engine.options()
+            corps = {'statut': 'ok', 'lignes': options['nb_lignes'], 'etablissements': options['nb_etablissements']}
+            self._repondre(200, json.dumps(corps).encode('utf-8'), 'application/json')
+        else:
+            self._erreur(404, f"Route inconnue : {self.path}")
+
+    def do_POST(self):
+        methode = self.path.strip('/')
+        if methode not in METHODES:
+            self._erreur(404, f"Route inconnue : {self.path}")
+            return
+        try:
+            longueur = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(longueur) or b'{}')
+            resultat = getattr(self.engine, methode)(**params)
+            corps = encode_reponse(resultat)
+        except (TypeError, ValueError, KeyError) as e:
+            self._erreur(400, f"{type(e).__name__}: {e}")
+            return
+        self._repondre(200, corps.to_pybytes(), 'application/vnd.apache.arrow.stream')
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serveur HTTP multi-thread sur socket Unix"""
+    daemon_threads = True
+
+def creer_serveur(engine, host='127.0.0.1', port=8765, socket_path=None):
+    """Serveur HTTP (TCP local ou socket Unix) adossé au moteur"""
+    handler = type('Handler', (CasemixRequestHandler,), {'engine': engine})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return ThreadingUnixHTTPServer(socket_path, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+# ========================================
+# CLIENT
+# ========================================
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """Connexion HTTP sur socket Unix"""
+
+    def __init__(self, socket_path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class ServiceClient:
+    """Client du service : mêmes méthodes et mêmes retours que CasemixEngine"""
+
+    def __init__(self, url, timeout=120):
+        self.url = url
+        self.timeout = timeout
+        parsed = urlparse(url)
+        if parsed.scheme == 'unix':
+            self._connexion = lambda: _UnixHTTPConnection(parsed.path, timeout)
+        elif parsed.scheme == 'http':
+            self._connexion = lambda: http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+        else:
+            raise ValueError(f"URL de service non supportée : {url} (http:// ou unix://)")
+
+    def _appel(self, methode, **params):
+        connexion = self._connexion()
+        try:
+            connexion.request(
+                'POST', f'/{methode}', body=json.dumps(params, default=json_default),
+                headers={'Content-Type': 'application/json'}
+            )
+            reponse = connexion.getresponse()
+            corps = reponse.read()
+        finally:
+            connexion.close()
+        if reponse.status != 200:
+            raise RuntimeError(f"Service casemix ({methode}) : {corps.decode('utf-8', 'replace')}")
+        return decode_reponse(pa.py_buffer(corps))
+
+    def options(self):
+        options = self._appel('options')[1]
+        options['lignes_par_annee'] = {int(a): n for a, n in options['lignes_par_annee'].items()}
+        return options
+
+    def selection(self, finess, annees=()):
+        return self._appel('selection', finess=finess, annees=list(annees))[0]
+
+    def kpis(self, finess, annees):
+        return self._appel('kpis', finess=finess, annees=list(annees))[1]
+
+    def top_libelles(self, finess, annees, top_n=10):
+        return self._appel('top_libelles', finess=finess, annees=list(annees), top_n=top_n)[0]
+
+    def detail_libelles(self, finess, annees, top_n=20):
+        return self._appel('detail_libelles', finess=finess, annees=list(annees), top_n=top_n)[0]
+
+    def evolution(self, finess, annees):
+        return self._appel('evolution', finess=finess, annees=list(annees))[0]
+
+    def financier(self, finess, annees, statut, top_n=30):
+        return self._appel('financier', finess=finess, annees=list(annees), statut=statut, top_n=top_n)
+
+    def departements(self, finess=None, departement=None, annee=None, region=None):
+        return self._appel('departements', finess=finess, departement=departement, annee=annee, region=region)
+
+    def regions(self):
+        return self._appel('regions')[0]
+
+    def rollup(self, niveau_geo, annee=None, niveau=None, activite=None, region=None, departement=None):
+        return self._appel(
+            'rollup', niveau_geo=niveau_geo, annee=annee, niveau=niveau, activite=activite, region=region, departement=departement
+        )[0]
+
+    def ghm_options(self):
+        return self._appel('ghm_options')[0]
+
+    def comparaison_etablissements(self, code_ghm):
+        return self._appel('comparaison_etablissements', code_ghm=code_ghm)[0]
+
+    def comparaison(self, code_ghm, finess_list):
+        return self._appel('comparaison', code_ghm=code_ghm, finess_list=list(finess_list))[0]
+
+    def references(self, code_ghm, departement=None):
+        return self._appel('references', code_ghm=code_ghm, departement=departement)[0]
+
+    def references_selection(self, finess, annees, cle='Libelle'):
+        return self._appel('references_selection', finess=finess, annees=list(annees), cle=cle)[0]
+
+    def performance(self, finess, annees):
+        return self._appel('performance', finess=finess, annees=list(annees))
+
+    def etablissements_similaires(self, finess, annee=None, k=10, niveau='Code_GHM'):
+        return self._appel('etablissements_similaires', finess=finess, annee=annee, k=k, niveau=niveau)[0]
+
+    def activites_marche(self, niveau):
+        return self._appel('activites_marche', niveau=niveau)[1]
+
+    def concentration(self, niveau, annee=None, activite=None):
+        return self._appel('concentration', niveau=niveau, annee=annee, activite=activite)[0]
+
+    def parts_de_marche(self, niveau, activite, finess_list):
+        return self._appel('parts_de_marche', niveau=niveau, activite=activite, finess_list=list(finess_list))[0]
+
+    def valeurs_tarif(self, dimension):
+        return self._appel('valeurs_tarif', dimension=dimension)[1]
+
+    def simulation_tarifs(self, regles, annee=None, grille='statut', horizon=0):
+        return self._appel('simulation_tarifs', regles=list(regles), annee=annee, grille=grille, horizon=horizon)
+
+    def previsions(self, finess):
+        return self._appel('previsions', finess=finess)[0]
+
+    def previsions_racines(self, finess):
+        return self._appel('previsions_racines', finess=finess)[0]
+
+    def controle_previsions(self):
+        return self._appel('controle_previsions')[0]
+
+    def decomposition_ca(self, annee_base, annee_cible, grille='statut'):
+        return self._appel('decomposition_ca', annee_base=annee_base, annee_cible=annee_cible, grille=grille)
+
+    def hierarchie_ghm(self, finess, annees):
+        return self._appel('hierarchie_ghm', finess=finess, annees=list(annees))[0]
+
+    def variation_pivot(self, dimension, finess, annees):
+        pivot = self._appel('variation_pivot', dimension=dimension, finess=finess, annees=list(annees))[0]
+        pivot.columns = pd.Index([int(a) for a in pivot.columns], name='Annee')
+        return pivot
+
+    def correlation(self, finess, annees):
+        correlation, nb_lignes = self._appel('correlation', finess=finess, annees=list(annees))
+        return correlation, nb_lignes
+
+    def recherche_ghm(self, texte):
+        return self._appel('recherche_ghm', texte=texte)[1]
+
+# ========================================
+# LANCEMENT
+# ========================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Service d'agrégation Casemix (réponses Arrow IPC)")
+    parser.add_argument('--host', default='127.0.0.1', help="Adresse d'écoute HTTP (défaut : 127.0.0.1)")
+    parser.add_argument('--port', type=int, default=8765, help="Port HTTP (défaut : 8765)")
+    parser.add_argument('--socket', help="Chemin d'un socket Unix (remplace --host/--port)")
+    parser.add_argument('--data', default=str(DATA_FILE), help="Fichier Parquet casemix")
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print("SERVICE D'AGRÉGATION CASEMIX")
+    print("=" * 80)
+
+    debut = time.perf_counter()
+    engine = CasemixEngine(load_dataset(args.data))
+    print(f"📊 {len(engine.df):,} lignes chargées depuis {args.data}")
+    engine.warmup()
+    print(f"✅ Index construits en {time.perf_counter() - debut:.1f}s")
+
+    serveur = creer_serveur(engine, args.host, args.port, args.socket)
+    adresse = f"unix://{args.socket}" if args.socket else f"http://{args.host}:{args.port}"
+    print(f"🚀 En écoute sur {adresse} (CASEMIX_SERVICE_URL={adresse})")
+    try:
+        serveur.serve_forever()
+    except KeyboardInterrupt:
+        print("\nArrêt du service")
+    finally:
+        serveur.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == '__main__':
+    main()
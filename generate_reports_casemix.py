@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rapports d'activité par établissement en lot (Excel multi-feuilles + page HTML statique)
+Même contenu que le dashboard : KPIs et écarts, top GHM, volet financier, évolution
+
+Les workers d'un pool de processus lisent le même instantané Arrow par memory-map
+(pages partagées, pas de copie du dataset par processus) :
+    python generate_reports_casemix.py                                   # tous les établissements
+    python generate_reports_casemix.py --finess 010007300 130783293 --annees 2023 2024
+    python generate_reports_casemix.py --fichier-finess liste.txt --workers 8 --formats xlsx
+"""
+
+import argparse
+import html
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+from pathlib import Path
+
+import pandas as pd
+
+from casemix_engine import (
+    DATA_FILE, METRIQUES_PONDEREES, CasemixEngine, compute_top_k, load_dataset, snapshot_path, write_snapshot
+)
+
+# Configurer l'encodage de sortie
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+OUTPUT_DIR = Path('rapports')
+TOP_GHM = 20
+TOP_FINANCIER = 30
+COULEUR_ENTETE = '823B8A'  # Violet du dashboard
+
+# Libellés des feuilles et des tableaux
+COLONNES_FR = {
+    'Code_GHM': 'Code GHM', 'Libelle': 'Libellé', 'Annee': 'Année', 'Effectif': 'Séjours',
+    'DMS': 'DMS (j)', 'Age_Moyen': 'Âge moyen', 'Taux_Deces': 'Taux de décès (%)',
+    'CA_Public_Estime': 'CA estimé (€)', 'CA_Prive_Estime': 'CA estimé (€)',
+    'Tarif_Public': 'Tarif moyen (€)', 'Tarif_Prive': 'Tarif moyen (€)'
+}
+
+# ========================================
+# CONTENU D'UN RAPPORT
+# ========================================
+
+_ENGINE = None  # Moteur du worker (un par processus)
+
+def init_worker(data_path):
+    """Charge le moteur une fois par processus (instantané mappé en mémoire)"""
+    global _ENGINE
+    _ENGINE = CasemixEngine(load_dataset(data_path))
+
+def construire_rapport(engine, finess, annees):
+    """Tableaux du rapport d'un établissement (mêmes calculs que le dashboard)"""
+    kpis = engine.kpis(finess, annees)
+    top_ghm = compute_top_k(
+        engine.selection(finess, annees), ['Code_GHM', 'Libelle'], 'Effectif', TOP_GHM,
+        sums=['Effectif'], weighted_means=METRIQUES_PONDEREES
+    )
+    financier = {statut: engine.financier(finess, annees, statut, TOP_FINANCIER) for statut in ['Public', 'Privé']}
+    evolution = engine.evolution(finess, annees)
+
+    indicateurs = [
+        ('Séjours', kpis['effectif'], kpis['delta_effectif_pct'], '% vs N-1'),
+        ('GHM distincts', kpis['nb_ghm'], kpis['delta_ghm'], 'vs N-1'),
+        ('DMS (jours)', kpis['dms'], kpis['delta_dms'], 'j vs N-1'),
+        ('Âge moyen (ans)', kpis['age_moyen'], kpis['delta_age'], 'ans vs N-1'),
+        ('Taux de décès (%)', kpis['taux_deces'], kpis['delta_deces'], 'pts vs N-1'),
+    ]
+    for statut, (_, kpis_fin) in financier.items():
+        indicateurs.append((f'CA estimé tarifs {statut.lower()} (€)', kpis_fin['ca_total'], None, None))
+    synthese = pd.DataFrame(indicateurs, columns=['Indicateur', 'Valeur', 'Écart', 'Unité écart'])
+
+    return {
+        'Synthèse': synthese,
+        'Top GHM': top_ghm,
+        'Financier Public': financier['Public'][0],
+        'Financier Privé': financier['Privé'][0],
+        'Évolution': evolution
+    }
+
+# ========================================
+# ÉCRITURE
+# ========================================
+
+def ecrire_excel(feuilles):
+    """Classeur write-only, une feuille par tableau, en-tête aux couleurs du dashboard"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    workbook = Workbook(write_only=True)
+    header_fill = PatternFill(start_color=COULEUR_ENTETE, end_color=COULEUR_ENTETE, fill_type='solid')
+    header_font = Font(bold=True, color='FFFFFF')
+    for nom, data in feuilles.items():
+        data = data.rename(columns=COLONNES_FR)
+        worksheet = workbook.create_sheet(nom)
+        for i, col in enumerate(data.columns, start=1):
+            largeur = max([len(str(col))] + [len(str(v)) for v in data[col].head(50)])
+            worksheet.column_dimensions[get_column_letter(i)].width = min(largeur + 2, 60)
+        worksheet.freeze_panes = 'A2'
+        header = []
+        for col in data.columns:
+            cell = WriteOnlyCell(worksheet, value=str(col))
+            cell.fill = header_fill
+            cell.font = header_font
+            header.append(cell)
+        worksheet.append(header)
+        bloc = data.astype(object)
+        for row in bloc.where(bloc.notna(), None).itertuples(index=False, name=None):
+            worksheet.append(row)
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+CSS_HTML = """
+body { font-family: -apple-system, 'Segoe UI', Roboto, sans-serif; margin: 30px auto; max-width: 1100px; color: #333; }
+h1 { color: #823B8A; margin-bottom: 0; }
+h2 { color: #307E84; border-bottom: 2px solid #307E84; padding-bottom: 4px; margin-top: 32px; }
+.sous-titre { color: #777; margin-top: 4px; }
+.kpis { display: flex; flex-wrap: wrap; gap: 12px; margin-top: 20px; }
+.kpi { flex: 1 1 160px; border-left: 4px solid #823B8A; background: #f7f3f8; padding: 10px 14px; }
+.kpi .valeur { font-size: 1.5rem; font-weight: 600; }
+.kpi .ecart { color: #777; font-size: 0.85rem; }
+table { border-collapse: collapse; width: 100%; font-size: 0.85rem; }
+th { background: #823B8A; color: #fff; padding: 6px; text-align: left; }
+td { padding: 4px 6px; border-bottom: 1px solid #eee; }
+td.nombre { text-align: right; }
+footer { margin-top: 40px; color: #999; font-size: 0.8rem; text-align: center; }
+"""
+
+def formater_nombre(valeur, decimales=1):
+    if valeur is None or pd.isna(valeur):
+        return '-'
+    if float(valeur).is_integer():
+        return f"{int(valeur):,}".replace(',', ' ')
+    return f"{valeur:,.{decimales}f}".replace(',', ' ')
+
+def tableau_html(data):
+    """Tableau HTML (nombres alignés à droite, séparateur de milliers)"""
+    data = data.rename(columns=COLONNES_FR)
+    lignes = ['<tr>' + ''.join(f'<th>{html.escape(str(c))}</th>' for c in data.columns) + '</tr>']
+    for row in data.itertuples(index=False, name=None):
+        cellules = []
+        for valeur in row:
+            if isinstance(valeur, str):
+                cellules.append(f'<td>{html.escape(valeur)}</td>')
+            else:
+                cellules.append(f'<td class="nombre">{formater_nombre(valeur, 2)}</td>')
+        lignes.append('<tr>' + ''.join(cellules) + '</tr>')
+    return '<table>' + ''.join(lignes) + '</table>'
+
+def ecrire_html(feuilles, finess, nom, annees):
+    """Page HTML autonome (CSS en ligne, sans JavaScript)"""
+    cartes = []
+    for indicateur, valeur, ecart, unite in feuilles['Synthèse'].itertuples(index=False, name=None):
+        texte_ecart = f"{ecart:+.2f} {unite}" if ecart is not None and not pd.isna(ecart) else ''
+        cartes.append(
+            f'<div class="kpi"><div>{html.escape(indicateur)}</div>'
+            f'<div class="valeur">{formater_nombre(valeur, 2)}</div><div class="ecart">{texte_ecart}</div></div>'
+        )
+    sections = ''.join(
+        f'<h2>{html.escape(titre)}</h2>{tableau_html(data)}'
+        for titre, data in feuilles.items() if titre != 'Synthèse'
+    )
+    periode = ', '.join(map(str, annees))
+    return f"""<!DOCTYPE html>
+<html lang="fr"><head><meta charset="utf-8"><title>Casemix {finess} - {html.escape(nom)}</title>
+<style>{CSS_HTML}</style></head><body>
+<h1>{html.escape(nom)}</h1>
+<p class="sous-titre">FINESS {finess} • Années {periode}</p>
+<div class="kpis">{''.join(cartes)}</div>
+{sections}
+<footer>Rapport généré le {pd.Timestamp.now():%d/%m/%Y} • Dashboard Casemix GHM</footer>
+</body></html>"""
+
+def generer_rapport(finess, nom, annees, output_dir, formats):
+    """Tâche d'un worker : calcule puis écrit le rapport d'un établissement"""
+    debut = time.perf_counter()
+    annees_etab = annees or sorted(int(a) for a in _ENGINE.selection(finess)['Annee'].unique())
+    feuilles = construire_rapport(_ENGINE, finess, annees_etab)
+    fichiers = []
+    if 'xlsx' in formats:
+        fichier = output_dir / f"{finess}.xlsx"
+        fichier.write_bytes(ecrire_excel(feuilles))
+        fichiers.append(fichier.name)
+    if 'html' in formats:
+        fichier = output_dir / f"{finess}.html"
+        fichier.write_text(ecrire_html(feuilles, finess, nom, annees_etab), encoding='utf-8')
+        fichiers.append(fichier.name)
+    return {
+        'finess': finess,
+        'nom': nom,
+        'effectif': int(feuilles['Synthèse']['Valeur'].iloc[0]),
+        'fichiers': fichiers,
+        'duree_s': time.perf_counter() - debut
+    }
+
+def ecrire_index(resultats, output_dir, annees):
+    """Page d'accueil listant les rapports (triés par nombre de séjours)"""
+    lignes = []
+    for r in sorted(resultats, key=lambda r: -r['effectif']):
+        liens = ' '.join(f'<a href="{f}">{Path(f).suffix[1:]}</a>' for f in r['fichiers'])
+        lignes.append(
+            f"<tr><td>{r['finess']}</td><td>{html.escape(r['nom'])}</td>"
+            f'<td class="nombre">{formater_nombre(r["effectif"])}</td><td>{liens}</td></tr>'
+        )
+    periode = ', '.join(map(str, annees)) if annees else 'toutes années'
+    (output_dir / 'index.html').write_text(f"""<!DOCTYPE html>
+<html lang="fr"><head><meta charset="utf-8"><title>Rapports casemix</title><style>{CSS_HTML}</style></head><body>
+<h1>Rapports d'activité casemix</h1><p class="sous-titre">{len(resultats)} établissements • {periode}</p>
+<table><tr><th>FINESS</th><th>Établissement</th><th>Séjours</th><th>Fichiers</th></tr>{''.join(lignes)}</table>
+</body></html>""", encoding='utf-8')
+
+# ========================================
+# LANCEMENT
+# ========================================
+
+def preparer_instantane(data_path):
+    """Instantané Arrow à jour : les workers le mappent au lieu de relire le Parquet"""
+    data_path = Path(data_path)
+    snapshot = snapshot_path(data_path)
+    if data_path.exists() and (not snapshot.exists() or snapshot.stat().st_mtime < data_path.stat().st_mtime):
+        print(f"📦 Écriture de l'instantané {snapshot} (partagé par les workers)")
+        write_snapshot(pd.read_parquet(data_path), snapshot)
+
+def main():
+    parser = argparse.ArgumentParser(description="Rapports d'activité casemix par établissement, en parallèle")
+    parser.add_argument('--finess', nargs='+', help="FINESS à traiter (défaut : tous)")
+    parser.add_argument('--fichier-finess', help="Fichier texte d'une liste de FINESS (un par ligne)")
+    parser.add_argument('--annees', nargs='+', type=int, help="Années du rapport (défaut : toutes celles de l'établissement)")
+    parser.add_argument('--formats', nargs='+', default=['xlsx', 'html'], choices=['xlsx', 'html'], help="Formats produits")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Processus en parallèle (défaut : nb de cœurs)")
+    parser.add_argument('--output', default=str(OUTPUT_DIR), help="Dossier de sortie (défaut : rapports/)")
+    parser.add_argument('--data', default=str(DATA_FILE), help="Fichier Parquet casemix")
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print("RAPPORTS D'ACTIVITÉ PAR ÉTABLISSEMENT")
+    print("=" * 80)
+
+    debut = time.perf_counter()
+    preparer_instantane(args.data)
+    init_worker(args.data)
+    tous_finess = _ENGINE.options()['finess']
+    if args.finess or args.fichier_finess:
+        demandes = list(args.finess or [])
+        if args.fichier_finess:
+            demandes += [l.strip() for l in Path(args.fichier_finess).read_text(encoding='utf-8').splitlines() if l.strip()]
+        inconnus = sorted(set(demandes) - set(tous_finess))
+        if inconnus:
+            print(f"⚠️  {len(inconnus)} FINESS absents des données ignorés : {', '.join(inconnus[:10])}")
+        liste_finess = [f for f in dict.fromkeys(demandes) if f not in inconnus]
+    else:
+        liste_finess = tous_finess
+
+    try:
+        df_mapping = pd.read_csv('etablissements_finess.csv', encoding='utf-8-sig', dtype=str)
+        noms = dict(zip(df_mapping['Finess'], df_mapping['Raison sociale']))
+    except FileNotFoundError:
+        noms = {}
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    workers = max(1, min(args.workers, len(liste_finess)))
+    print(f"📊 {len(liste_finess):,} établissements • {workers} workers • formats {', '.join(args.formats)}")
+
+    resultats, erreurs = [], []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(args.data,)) as pool:
+        futures = {
+            pool.submit(generer_rapport, f, noms.get(f, 'Inconnu'), args.annees, output_dir, args.formats): f
+            for f in liste_finess
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            try:
+                resultats.append(future.result())
+            except Exception as e:
+                erreurs.append((futures[future], e))
+            if i % 100 == 0 or i == len(futures):
+                print(f"  {i:,}/{len(futures):,} rapports ({time.perf_counter() - debut:.1f}s)")
+
+    ecrire_index(resultats, output_dir, args.annees)
+    print()
+    for finess, e in erreurs[:10]:
+        print(f"❌ {finess} : {type(e).__name__}: {e}")
+    duree_moyenne = sum(r['duree_s'] for r in resultats) / max(len(resultats), 1)
+    print(f"✅ {len(resultats):,} rapports → {output_dir}/ en {time.perf_counter() - debut:.1f}s "
+          f"({duree_moyenne * 1000:.0f} ms par rapport et par worker)")
+    return 1 if erreurs else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Générateur de données casemix synthétiques (même schéma que data_casemix_2022_2024.parquet)
+Pour tester la montée en charge (10M, 50M, 100M lignes) sans données patients
+
+- FINESS préfixés par le département (departement.csv), taille d'établissement log-normale
+- Codes GHM et niveaux de sévérité tirés du référentiel GHS, classification via l'arbre GHM
+- Effectifs à queue longue, DMS / âge / mortalité dépendant de la sévérité
+- Tarifs joints depuis le référentiel (dérive annuelle hors 2022-2024)
+
+Écriture par blocs d'établissements (mémoire bornée), reproductible via --seed :
+    python generate_synthetic_casemix.py --rows 10000000 --annees 2015 2024 --output synth_10M.parquet
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Configurer l'encodage de sortie
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+
+ANNEES_TARIFS = [2022, 2023, 2024]
+DERIVE_TARIF_ANNUELLE = 0.01  # Évolution des tarifs hors des années du référentiel
+TAUX_PRESENCE = 0.95  # Part du portefeuille GHM d'un établissement présente chaque année
+
+COLONNES_ARBRE = ['MCO', 'CAS', 'DA', 'GP', 'GA', 'Classif PKCS', 'Libracine', 'Regroupement GHM PH']
+
+# Statuts (Statut_Etablissement, Statut_Detail) et répartition des établissements
+STATUTS = [
+    ('Public', 'Public', 0.47),
+    ('Privé', 'Privé Non Lucratif', 0.13),
+    ('Privé', 'Privé Commercial', 0.375),
+    ('Inconnu', 'Inconnu', 0.025),
+]
+
+# Sévérité (6e caractère du GHM) : DMS moyenne (j), âge ajouté (ans), taux de décès de base
+SEVERITES = {
+    '1': (2.5, 0, 0.002), '2': (6.0, 8, 0.015), '3': (10.0, 14, 0.05), '4': (16.0, 18, 0.14),
+    'A': (2.5, 0, 0.001), 'B': (5.0, 6, 0.01), 'C': (9.0, 12, 0.04), 'D': (14.0, 16, 0.10),
+    'E': (1.5, 0, 0.30), 'Z': (3.0, 0, 0.005), 'J': (0.0, 0, 0.0), 'T': (1.0, 0, 0.001),
+}
+
+# ========================================
+# RÉFÉRENTIELS
+# ========================================
+
+def charger_referentiels():
+    """GHM (référentiel GHS + arbre par racine) et départements"""
+    ghs = pd.read_csv('referentiel_ghs_2022_2024.csv', encoding='utf-8-sig')
+    arbre = pd.read_csv('Arbre-Precis-Référentiel GHM.csv', sep=';', encoding='utf-8-sig', dtype=str)
+    arbre = arbre.rename(columns={'GHM': 'Racine'}).drop(columns=['Recours'], errors='ignore')
+    arbre = arbre.drop_duplicates('Racine')
+
+    ghm = ghs.drop_duplicates('Code_GHM').reset_index(drop=True)
+    ghm['Racine'] = ghm['Code_GHM'].str[:5]
+    ghm = ghm.merge(arbre, on='Racine', how='left')
+    for col in COLONNES_ARBRE:
+        ghm[col] = ghm[col].fillna('Non renseigné').str.strip()
+
+    departements = pd.read_csv('departement.csv', dtype=str, encoding='utf-8-sig')
+    departements.columns = ['Departement_Number', 'Nom_Departement']
+    return ghm, departements
+
+def profil_ghm(ghm, rng):
+    """Paramètres cliniques par GHM : popularité, DMS, âge, sexe ratio, mortalité"""
+    n = len(ghm)
+    severite = ghm['Code_GHM'].str[5].map(lambda s: SEVERITES.get(s, (4.0, 5, 0.01)))
+    cmd = ghm['Code_GHM'].str[:2]
+    type_ghm = ghm['Code_GHM'].str[2]
+
+    # Popularité à queue longue (Zipf), plus forte pour les niveaux 1 et l'ambulatoire
+    rang = rng.permutation(n) + 1
+    popularite = 1.0 / rang ** 0.9
+    popularite *= ghm['Code_GHM'].str[5].map({'1': 3.0, 'J': 3.0, 'T': 2.0, '2': 1.5, '3': 0.7, '4': 0.3}).fillna(0.5).to_numpy()
+
+    age_base = np.clip(rng.normal(55, 15, n), 18, 85)
+    age_base = np.where(cmd == '14', rng.normal(30, 3, n), age_base)   # Obstétrique
+    age_base = np.where(cmd == '15', rng.uniform(0, 0.1, n), age_base)  # Nouveau-nés
+    age_base = age_base + np.array([s[1] for s in severite])
+
+    sexe_ratio = rng.beta(5, 5, n) * 100
+    sexe_ratio = np.where(cmd.isin(['13', '14']), 0.0, sexe_ratio)  # Gynécologie, obstétrique
+    sexe_ratio = np.where(cmd == '12', 100.0, sexe_ratio)           # Appareil génital masculin
+
+    return {
+        'popularite': popularite / popularite.sum(),
+        'chirurgical': (type_ghm == 'C').to_numpy(),
+        'dms': np.array([s[0] for s in severite]),
+        'age': np.clip(age_base, 0, 99),
+        'sexe_ratio': sexe_ratio,
+        'deces': np.array([s[2] for s in severite]),
+    }
+
+# ========================================
+# ÉTABLISSEMENTS
+# ========================================
+
+def generer_etablissements(nb_etablissements, departements, rng):
+    """FINESS (préfixe départemental), taille relative et statut des établissements"""
+    # Départements pondérés (population hétérogène), numéros uniques par département
+    poids_dept = rng.lognormal(0, 0.6, len(departements))
+    dept_idx = rng.choice(len(departements), size=nb_etablissements, p=poids_dept / poids_dept.sum())
+    numeros = rng.choice(10 ** 6, size=nb_etablissements, replace=False)
+    codes_dept = departements['Departement_Number'].to_numpy()[dept_idx]
+    finess = np.array([f"{d}{n % 10:1d}{n:06d}"[:9] for d, n in zip(codes_dept, numeros)])
+
+    probas = np.array([s[2] for s in STATUTS])
+    statut_idx = rng.choice(len(STATUTS), size=nb_etablissements, p=probas / probas.sum())
+
+    etab = pd.DataFrame({
+        'Finess': finess,
+        'dept_idx': dept_idx,
+        'statut_idx': statut_idx,
+        'taille': rng.lognormal(0, 1.2, nb_etablissements),  # Quelques CHU, beaucoup de petites structures
+        'croissance': rng.normal(0.01, 0.03, nb_etablissements),
+        'efficience': rng.lognormal(0, 0.15, nb_etablissements),  # DMS relative à la moyenne
+    })
+    return etab.sort_values('Finess', ignore_index=True)
+
+def calibrer_largeur(poids, lignes_par_annee, nb_ghm, largeur_min=5):
+    """Nombre de GHM distincts par établissement pour viser `lignes_par_annee` au total"""
+    poids = poids / poids.sum()
+    bas, haut = 0.0, float(lignes_par_annee) * 10
+    for _ in range(60):
+        echelle = (bas + haut) / 2
+        total = np.clip(poids * echelle, largeur_min, nb_ghm).sum()
+        bas, haut = (echelle, haut) if total < lignes_par_annee else (bas, echelle)
+    return np.clip(np.rint(poids * bas), largeur_min, nb_ghm).astype(int)
+
+# ========================================
+# GÉNÉRATION PAR BLOCS
+# ========================================
+
+def generer_bloc(etab, largeurs, annees, ghm, profil, rng):
+    """Lignes (Finess × Annee × GHM) d'un bloc d'établissements, en colonnes numpy"""
+    nb_ghm = len(ghm)
+    log_pop = np.log(profil['popularite'])
+    parties = {k: [] for k in ['etab', 'annee', 'ghm', 'effectif']}
+
+    for i, (ligne, largeur) in enumerate(zip(etab.itertuples(), largeurs)):
+        # Portefeuille de GHM : tirage pondéré sans remise (Gumbel top-k),
+        # orienté chirurgie pour le privé commercial
+        scores = log_pop + rng.gumbel(size=nb_ghm)
+        if STATUTS[ligne.statut_idx][1] == 'Privé Commercial':
+            scores += np.where(profil['chirurgical'], 1.0, -0.5)
+        portefeuille = np.argpartition(-scores, largeur - 1)[:largeur]
+        volume_base = rng.lognormal(0, 1.0, largeur) * ligne.taille * profil['popularite'][portefeuille] * nb_ghm * 1.5
+
+        for rang_annee, annee in enumerate(annees):
+            # Activité stable d'une année sur l'autre, quelques GHM entrent ou sortent
+            present = rng.random(largeur) < TAUX_PRESENCE
+            tendance = (1 + ligne.croissance) ** rang_annee
+            effectif = rng.poisson(volume_base[present] * tendance) + 1
+            parties['etab'].append(np.full(present.sum(), i))
+            parties['annee'].append(np.full(present.sum(), annee))
+            parties['ghm'].append(portefeuille[present])
+            parties['effectif'].append(effectif)
+
+    return {k: np.concatenate(v) for k, v in parties.items()}
+
+def colonne_texte(valeurs, indices):
+    """Colonne Arrow texte par indexation d'un petit dictionnaire (sans objets Python par ligne)"""
+    return pa.array(valeurs, type=pa.string()).take(pa.array(indices, type=pa.int32()))
+
+def construire_table(bloc, etab, ghm, profil, departements, rng):
+    """Table Arrow au schéma du dataset casemix à partir des lignes générées"""
+    e, g, effectif = bloc['etab'], bloc['ghm'], bloc['effectif']
+    annee = bloc['annee']
+    n = len(e)
+
+    # Indicateurs cliniques : base GHM + effet établissement + bruit décroissant avec l'effectif
+    bruit = 1 / np.sqrt(effectif)
+    dms = profil['dms'][g] * etab['efficience'].to_numpy()[e] * rng.lognormal(0, 0.3 * bruit + 0.05, n)
+    age = np.clip(profil['age'][g] + rng.normal(0, 8, n) * bruit, 0, 99)
+    sexe_ratio = np.clip(profil['sexe_ratio'][g] + rng.normal(0, 20, n) * bruit, 0, 100)
+    deces = rng.binomial(effectif, np.clip(profil['deces'][g], 0, 1))
+    taux_deces = deces / effectif * 100
+
+    colonnes = {
+        'Finess': colonne_texte(etab['Finess'].to_numpy(), e),
+        'Annee': pa.array(annee.astype('int64')),
+        'Code_GHM': colonne_texte(ghm['Code_GHM'].to_numpy(), g),
+        'Libelle': colonne_texte(ghm['Libelle_GHS'].to_numpy(), g),
+        'Effectif': pa.array(effectif.astype('int64')),
+        'DMS': pa.array(np.round(dms, 2)),
+        'Age_Moyen': pa.array(np.round(age, 1)),
+        'Sexe_Ratio': pa.array(np.round(sexe_ratio, 1)),
+        'Taux_Deces': pa.array(np.round(taux_deces, 2)),
+    }
+    for col in COLONNES_ARBRE:
+        colonnes[col] = colonne_texte(ghm[col].to_numpy(), g)
+    colonnes['Libelle_GHS'] = colonne_texte(ghm['Libelle_GHS'].to_numpy(), g)
+
+    tarif = {}
+    for secteur in ['Public', 'Prive']:
+        for a in ANNEES_TARIFS:
+            colonnes[f'Tarif_{secteur}_{a}'] = pa.array(ghm[f'Tarif_{secteur}_{a}'].to_numpy(dtype='float64')[g])
+        # Tarif actif : année du référentiel la plus proche, avec dérive au-delà
+        annee_ref = np.clip(annee, ANNEES_TARIFS[0], ANNEES_TARIFS[-1])
+        base = np.select(
+            [annee_ref == a for a in ANNEES_TARIFS],
+            [ghm[f'Tarif_{secteur}_{a}'].to_numpy(dtype='float64')[g] for a in ANNEES_TARIFS]
+        )
+        tarif[secteur] = np.round(base * (1 + DERIVE_TARIF_ANNUELLE) ** (annee - annee_ref), 2)
+    colonnes['Tarif_Public'] = pa.array(tarif['Public'])
+    colonnes['Tarif_Prive'] = pa.array(tarif['Prive'])
+    colonnes['CA_Public_Estime'] = pa.array(effectif * tarif['Public'])
+    colonnes['CA_Prive_Estime'] = pa.array(effectif * tarif['Prive'])
+
+    statut_idx = etab['statut_idx'].to_numpy()[e]
+    colonnes['Statut_Etablissement'] = colonne_texte([s[0] for s in STATUTS], statut_idx)
+    colonnes['Statut_Detail'] = colonne_texte([s[1] for s in STATUTS], statut_idx)
+    dept_idx = etab['dept_idx'].to_numpy()[e]
+    colonnes['Departement_Number'] = colonne_texte(departements['Departement_Number'].to_numpy(), dept_idx)
+    colonnes['Nom_Departement'] = colonne_texte(departements['Nom_Departement'].to_numpy(), dept_idx)
+    return pa.table(colonnes)
+
+def main():
+    parser = argparse.ArgumentParser(description="Génère un dataset casemix synthétique au schéma du fichier réel")
+    parser.add_argument('--rows', type=int, default=2_200_000, help="Nombre de lignes visé (défaut : 2 200 000)")
+    parser.add_argument('--annees', type=int, nargs=2, default=[2022, 2024], metavar=('DEBUT', 'FIN'), help="Années couvertes (défaut : 2022 2024)")
+    parser.add_argument('--etablissements', type=int, help="Nombre d'établissements (défaut : selon le volume)")
+    parser.add_argument('--seed', type=int, default=42, help="Graine aléatoire (défaut : 42)")
+    parser.add_argument('--bloc', type=int, default=500_000, help="Lignes par bloc d'écriture, borne la mémoire (défaut : 500 000)")
+    parser.add_argument('--output', default='data_casemix_synthetique.parquet', help="Fichier Parquet de sortie")
+    args = parser.parse_args()
+
+    annees = list(range(args.annees[0], args.annees[1] + 1))
+    lignes_par_annee = args.rows / len(annees)
+
+    print("=" * 80)
+    print("GÉNÉRATION DE DONNÉES CASEMIX SYNTHÉTIQUES")
+    print("=" * 80)
+
+    rng = np.random.default_rng(args.seed)
+    ghm, departements = charger_referentiels()
+    profil = profil_ghm(ghm, rng)
+
+    # ~1 250 établissements pour 2,2M lignes sur 3 ans ; au-delà, assez pour ne pas saturer les GHM
+    nb_etab = args.etablissements or int(max(1250, np.ceil(2 * lignes_par_annee / len(ghm))))
+    etab = generer_etablissements(nb_etab, departements, rng)
+    largeurs = calibrer_largeur(etab['taille'].to_numpy(), lignes_par_annee / TAUX_PRESENCE, len(ghm))
+    print(f"📊 {len(ghm):,} GHM, {nb_etab:,} établissements, {len(annees)} années ({annees[0]}-{annees[-1]})")
+    print(f"   Cible : {args.rows:,} lignes (~{largeurs.sum() * TAUX_PRESENCE * len(annees):,.0f} attendues)")
+
+    # Blocs d'établissements consécutifs (fichier trié par Finess)
+    cumul = np.cumsum(largeurs * TAUX_PRESENCE * len(annees))
+    coupures = np.searchsorted(cumul, np.arange(args.bloc, cumul[-1], args.bloc), side='right')
+    bornes = np.unique(np.r_[0, coupures, len(etab)])
+    debut = time.perf_counter()
+    total = 0
+    writer = None
+    try:
+        for debut_bloc, fin_bloc in zip(bornes[:-1], bornes[1:]):
+            etab_bloc = etab.iloc[debut_bloc:fin_bloc].reset_index(drop=True)
+            bloc = generer_bloc(etab_bloc, largeurs[debut_bloc:fin_bloc], annees, ghm, profil, rng)
+            table = construire_table(bloc, etab_bloc, ghm, profil, departements, rng)
+            if writer is None:
+                writer = pq.ParquetWriter(args.output, table.schema, compression='zstd')
+            writer.write_table(table)
+            total += table.num_rows
+            print(f"   {total:>12,} lignes ({fin_bloc:,}/{len(etab):,} établissements) - {time.perf_counter() - debut:.0f}s")
+    finally:
+        if writer is not None:
+            writer.close()
+
+    taille_mb = Path(args.output).stat().st_size / (1024 * 1024)
+    print()
+    print(f"✅ {total:,} lignes écrites dans {args.output} ({taille_mb:,.0f} Mo) en {time.perf_counter() - debut:.0f}s")
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,8 @@ from pathlib import Path
 import numpy as np
 import sys
 
+from casemix_engine import write_snapshot
+
 # Configurer l'encodage de sortie
 if sys.platform == 'win32':
     sys.stdout.reconfigure(encoding='utf-8')
@@ -186,6 +188,10 @@ if not Path(backup_path).exists():
 # Sauvegarder le nouveau
 df_merged.to_parquet('data_casemix_2022_2024.parquet', index=False)
 print(f"  ✓ Fichier principal mis à jour")
+
+# Instantané Arrow non compressé (memory-map partagé par les processus du dashboard)
+write_snapshot(df_merged, 'data_casemix_2022_2024.arrow')
+print(f"  ✓ Instantané Arrow mis à jour")
 print()
 
 # 10. Statistiques finales
@@ -215,6 +221,7 @@ print()
 
 print(f"📁 Fichiers générés:")
 print(f"  - data_casemix_2022_2024.parquet (enrichi avec tarifs)")
+print(f"  - data_casemix_2022_2024.arrow (instantané memory-map)")
 print(f"  - referentiel_ghs_2022_2024.parquet (référentiel seul)")
 print(f"  - referentiel_ghs_2022_2024.csv (référentiel CSV)")
 print()